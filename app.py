@@ -1,23 +1,40 @@
+import abc
 import os
 import logging
-from flask import Flask, jsonify, request as flask_request, abort as flask_abort
+import logging.handlers
+import queue
+import atexit
+import itertools
+import io
+import csv
+import socket
+import requests
+from types import MappingProxyType, UnionType
+from flask import Flask, Response, jsonify, g, has_request_context, send_from_directory, request as flask_request, abort as flask_abort
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 from dotenv import load_dotenv
 import time
 import random
 import re
 import hmac
+import struct
 import hashlib
 import telebot
 from telebot import types
-from urllib.parse import unquote, parse_qs
+from urllib.parse import unquote, parse_qs, urlparse
 from datetime import datetime as dt, timezone, timedelta
 import json
-from decimal import Decimal, ROUND_HALF_UP
-from sqlalchemy import create_engine, Column, Integer, String, Float, ForeignKey, DateTime, Boolean, UniqueConstraint, BigInteger
-from sqlalchemy.orm import sessionmaker, relationship, declarative_base
+import gzip
+import mimetypes
+from decimal import Decimal, ROUND_HALF_UP, ROUND_CEILING
+from sqlalchemy import create_engine, Column, Integer, String, Float, ForeignKey, DateTime, Date, Boolean, UniqueConstraint, Index, BigInteger, text, update, delete, bindparam
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.orm import sessionmaker, relationship, declarative_base, joinedload
+from sqlalchemy.dialects.postgresql import insert as pg_insert, JSONB
 from sqlalchemy.sql import func
-from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.exc import DBAPIError, IntegrityError, SQLAlchemyError
 from curl_cffi.requests import AsyncSession, RequestsError
 import base64
 from Crypto.Cipher import AES
@@ -26,19 +43,41 @@ from Crypto.Util.Padding import pad
 from pytoniq import LiteBalancer
 import asyncio
 import math
+import threading
+import functools
+import bisect
+import weakref
+import dataclasses
+from collections import OrderedDict, deque
 import secrets # Add this import for generating secure random strings
 
+try:
+    import redis # Optional: shared-state backend for rate limiting, idempotency keys and caches
+except ImportError:
+    redis = None
+try:
+    import orjson # Optional: fast JSON encode/decode for API bodies
+except ImportError:
+    orjson = None
+
 
 load_dotenv()
 
 # --- Configuration Constants ---
 BOT_TOKEN = os.environ.get("BOT_TOKEN")
 DATABASE_URL = os.environ.get("DATABASE_URL")
+# Skips schema creation, migrations, seeding, background reloads and webhook registration at import.
+# Used by tooling (e.g. benchmarks.py) that imports the module without a database or network.
+SKIP_STARTUP_TASKS = os.environ.get("SKIP_STARTUP_TASKS", "").lower() in ("1", "true", "yes")
 AUTH_DATE_MAX_AGE_SECONDS = 3600 * 24 # 24 hours for Telegram Mini App auth data
 TONNEL_SENDER_INIT_DATA = os.environ.get("TONNEL_SENDER_INIT_DATA")
 TONNEL_GIFT_SECRET = os.environ.get("TONNEL_GIFT_SECRET", "yowtfisthispieceofshitiiit")
-ADMIN_USER_ID = os.environ.get("TARGET_WITHDRAWER_ID")
+# Telegram chat ids are ints; compared with message.chat.id by the admin handlers
+ADMIN_USER_ID = int(os.environ["TARGET_WITHDRAWER_ID"]) if os.environ.get("TARGET_WITHDRAWER_ID", "").lstrip("-").isdigit() else None
 TARGET_WITHDRAWER_ID = os.environ.get("TARGET_WITHDRAWER_ID") # Add this line
+# Shared state across workers (rate limits, idempotency keys, caches); each falls back to in-process state without it
+REDIS_URL = os.environ.get("REDIS_URL")
+ADMIN_PROMO_PAGE_SIZE = 10 # Promocode buttons per page in the admin bot
 
 DEPOSIT_RECIPIENT_ADDRESS_RAW = os.environ.get("DEPOSIT_WALLET_ADDRESS")
 DEPOSIT_COMMENT = os.environ.get("DEPOSIT_COMMENT", "e8a1vds9yal")
@@ -109,15 +148,84 @@ KISS_FROG_MODEL_STATIC_PERCENTAGES = {
 }
 
 # --- Logging Setup ---
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("backend_app.log", encoding='utf-8'),
-        logging.StreamHandler()
+# Request threads only enqueue records; a single listener thread formats them and writes
+# to stdout and the rotating log file, so disk and pipe latency never lands on a request.
+LOG_FILE_PATH = os.environ.get("LOG_FILE_PATH", "backend_app.log")
+LOG_FILE_MAX_BYTES = int(os.environ.get("LOG_FILE_MAX_BYTES", str(50 * 1024 * 1024)))
+LOG_FILE_BACKUP_COUNT = int(os.environ.get("LOG_FILE_BACKUP_COUNT", "7"))
+LOG_FILE_ROTATE_SECONDS = int(os.environ.get("LOG_FILE_ROTATE_SECONDS", str(24 * 3600)))
+LOG_QUEUE_MAX_RECORDS = int(os.environ.get("LOG_QUEUE_MAX_RECORDS", "10000"))
+# "logger.name=N,..." keeps 1 of every N INFO/DEBUG records from that logger; warnings always pass
+LOG_SAMPLING = os.environ.get("LOG_SAMPLING", f"{__name__}.auth=100")
+
+class SizeAndTimeRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """Rolls the file over when it exceeds maxBytes or when rotate_seconds have elapsed, whichever comes first."""
+    def __init__(self, filename, max_bytes: int, backup_count: int, rotate_seconds: int):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8', delay=True)
+        self.rotate_seconds = rotate_seconds
+        self.rollover_at = time.time() + rotate_seconds
+
+    def shouldRollover(self, record):
+        if self.rotate_seconds > 0 and time.time() >= self.rollover_at:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        self.rollover_at = time.time() + self.rotate_seconds
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records (and counts them) instead of blocking when the queue is full."""
+    dropped_records = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DroppingQueueHandler.dropped_records += 1
+
+class SamplingFilter(logging.Filter):
+    """Per-logger 1-in-N sampling of records below WARNING."""
+    def __init__(self, every_n: int):
+        super().__init__()
+        self.every_n = max(1, every_n)
+        self._counter = itertools.count()
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or next(self._counter) % self.every_n == 0
+
+def setup_logging():
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_MAX_RECORDS)
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    output_handlers = [
+        SizeAndTimeRotatingFileHandler(LOG_FILE_PATH, LOG_FILE_MAX_BYTES, LOG_FILE_BACKUP_COUNT, LOG_FILE_ROTATE_SECONDS),
+        logging.StreamHandler(),
     ]
-)
+    for handler in output_handlers:
+        handler.setFormatter(formatter)
+
+    root_logger = logging.getLogger()
+    root_logger.setLevel(logging.INFO)
+    for existing_handler in list(root_logger.handlers):
+        root_logger.removeHandler(existing_handler)
+    root_logger.addHandler(DroppingQueueHandler(log_queue))
+
+    listener = logging.handlers.QueueListener(log_queue, *output_handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    for sampling_rule in filter(None, (part.strip() for part in LOG_SAMPLING.split(","))):
+        logger_name, _, every_n = sampling_rule.partition("=")
+        try:
+            logging.getLogger(logger_name.strip()).addFilter(SamplingFilter(int(every_n)))
+        except ValueError:
+            root_logger.warning("Ignoring malformed LOG_SAMPLING rule: %r", sampling_rule)
+    return listener
+
+log_listener = setup_logging()
 logger = logging.getLogger(__name__)
+auth_logger = logging.getLogger(f"{__name__}.auth") # Per-request auth successes; sampled by default
+games_logger = logging.getLogger(f"{__name__}.games") # Per-play outcomes
 
 # Basic checks for essential environment variables
 if not BOT_TOKEN:
@@ -136,8 +244,292 @@ WEBAPP_URL = NORMAL_WEBAPP_URL # Assuming normal operation on the server
 API_BASE_URL = "https://case-hznb.onrender.com" # Your backend API URL
 
 
+# --- Metrics (Prometheus text format) ---
+# Hot paths only bump plain dicts owned by the calling thread; nothing is locked while
+# recording. A scrape of /metrics merges every thread's shard into one exposition.
+# Every series carries a worker="host:pid" label, so series from different workers never
+# collide and a worker restart shows up as a counter reset on its own series only.
+LATENCY_BUCKETS_SECONDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class MetricsRegistry:
+    class Counter:
+        __slots__ = ('registry', 'name')
+
+        def __init__(self, registry, name):
+            self.registry, self.name = registry, name
+
+        def inc(self, *label_values, amount=1):
+            counters = self.registry._shard()[0]
+            key = (self.name, label_values)
+            counters[key] = counters.get(key, 0) + amount
+
+    class Histogram:
+        __slots__ = ('registry', 'name')
+
+        def __init__(self, registry, name):
+            self.registry, self.name = registry, name
+
+        def observe(self, value: float, *label_values):
+            histograms = self.registry._shard()[1]
+            key = (self.name, label_values)
+            slots = histograms.get(key)
+            if slots is None:
+                # One slot per bucket, one for +Inf, then the running sum
+                slots = histograms[key] = [0] * (len(LATENCY_BUCKETS_SECONDS) + 1) + [0.0]
+            slots[bisect.bisect_left(LATENCY_BUCKETS_SECONDS, value)] += 1
+            slots[-1] += value
+
+    def __init__(self):
+        self._descriptors = {} # name -> (type, help, label_names)
+        self._gauges = [] # (name, help, label_names, callback, type) read at scrape time
+        self._shards = [] # (weakref to owning thread, (counters, histograms))
+        self._retired = ({}, {}) # Merged shards of threads that have exited
+        self._shards_lock = threading.Lock()
+        self._local = threading.local()
+
+    def counter(self, name: str, help_text: str, label_names: tuple = ()):
+        self._descriptors[name] = ('counter', help_text, label_names)
+        return MetricsRegistry.Counter(self, name)
+
+    def histogram(self, name: str, help_text: str, label_names: tuple = ()):
+        self._descriptors[name] = ('histogram', help_text, label_names)
+        return MetricsRegistry.Histogram(self, name)
+
+    def gauge(self, name: str, help_text: str, callback, label_names: tuple = (), metric_type: str = 'gauge'):
+        """Registers a value read at scrape time. callback returns a number or [(label_values, number)]."""
+        self._gauges.append((name, help_text, label_names, callback, metric_type))
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = ({}, {})
+            with self._shards_lock:
+                self._shards.append((weakref.ref(threading.current_thread()), shard))
+        return shard
+
+    @staticmethod
+    def _merge_into(target, shard):
+        for key, value in list(shard[0].items()):
+            target[0][key] = target[0].get(key, 0) + value
+        for key, slots in list(shard[1].items()):
+            merged = target[1].get(key)
+            if merged is None:
+                target[1][key] = list(slots)
+            else:
+                for i, v in enumerate(slots):
+                    merged[i] += v
+
+    def _collect(self):
+        with self._shards_lock:
+            live_shards = []
+            for thread_ref, shard in self._shards:
+                thread = thread_ref()
+                if thread is None or not thread.is_alive():
+                    self._merge_into(self._retired, shard)
+                else:
+                    live_shards.append((thread_ref, shard))
+            self._shards = live_shards
+            merged = ({}, {})
+            self._merge_into(merged, self._retired)
+            for _, shard in live_shards:
+                self._merge_into(merged, shard)
+        return merged
+
+    @staticmethod
+    def _escape_label(value) -> str:
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    @staticmethod
+    def _format_labels(label_names, label_values, extra: str = "", const: str = ""):
+        parts = [f'{n}="{MetricsRegistry._escape_label(v)}"' for n, v in zip(label_names, label_values)]
+        if const:
+            parts.append(const)
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    @staticmethod
+    def merge_expositions(texts: list) -> str:
+        """Joins several workers' render() output, keeping each metric family's lines together."""
+        families = {} # name -> [help line, type line, samples]
+        for exposition in texts:
+            family = None
+            for line in exposition.splitlines():
+                if line.startswith("# HELP "):
+                    family = families.setdefault(line.split(" ", 3)[2], [line, None, []])
+                elif line.startswith("# TYPE "):
+                    family[1] = family[1] or line
+                elif line and family is not None:
+                    family[2].append(line)
+        lines = []
+        for help_line, type_line, samples in families.values():
+            lines.append(help_line)
+            lines.append(type_line)
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+    def render(self, worker: str = "") -> str:
+        const = f'worker="{self._escape_label(worker)}"' if worker else ""
+        counters, histograms = self._collect()
+        by_name = {}
+        for (name, label_values), value in counters.items():
+            by_name.setdefault(name, []).append((label_values, value))
+        for (name, label_values), slots in histograms.items():
+            by_name.setdefault(name, []).append((label_values, slots))
+
+        lines = []
+        for name, (metric_type, help_text, label_names) in self._descriptors.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for label_values, value in sorted(by_name.get(name, []), key=lambda item: item[0]):
+                if metric_type == 'counter':
+                    lines.append(f"{name}{self._format_labels(label_names, label_values, const=const)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS_SECONDS + (float('inf'),), value[:-1]):
+                    cumulative += count
+                    le_label = 'le="+Inf"' if bound == float('inf') else f'le="{bound}"'
+                    lines.append(f"{name}_bucket{self._format_labels(label_names, label_values, le_label, const)} {cumulative}")
+                lines.append(f"{name}_sum{self._format_labels(label_names, label_values, const=const)} {value[-1]}")
+                lines.append(f"{name}_count{self._format_labels(label_names, label_values, const=const)} {cumulative}")
+
+        for name, help_text, label_names, callback, metric_type in self._gauges:
+            try:
+                samples = callback()
+            except Exception as e:
+                logger.error(f"Metrics gauge {name} failed: {e}")
+                continue
+            if not isinstance(samples, list):
+                samples = [((), samples)]
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for label_values, value in samples:
+                lines.append(f"{name}{self._format_labels(label_names, label_values, const=const)} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+HTTP_REQUESTS_TOTAL = metrics.counter('http_requests_total', 'API requests by route, method and status.', ('route', 'method', 'status'))
+HTTP_REQUEST_DURATION = metrics.histogram('http_request_duration_seconds', 'API request latency by route.', ('route', 'method'))
+DB_POOL_CHECKOUT_WAIT = metrics.histogram('db_pool_checkout_wait_seconds', 'Time spent waiting for a pooled DB connection.')
+DB_QUERIES_TOTAL = metrics.counter('db_queries_total', 'SQL statements executed.')
+DB_QUERY_DURATION = metrics.histogram('db_query_duration_seconds', 'SQL statement execution time.')
+TONNEL_REQUEST_DURATION = metrics.histogram('tonnel_request_duration_seconds', 'Tonnel marketplace HTTP call latency by endpoint.', ('method', 'endpoint', 'outcome'))
+LITESERVER_CALL_DURATION = metrics.histogram('liteserver_call_duration_seconds', 'TON liteserver call latency by operation.', ('operation', 'outcome'))
+TELEGRAM_API_DURATION = metrics.histogram('telegram_api_duration_seconds', 'Telegram Bot API call latency by method.', ('api_method', 'outcome'))
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout waited for a free connection."""
+    def _do_get(self):
+        wait_started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            DB_POOL_CHECKOUT_WAIT.observe(time.perf_counter() - wait_started)
+
+
+# --- SQL Query Profiler (opt-in) ---
+# With SQL_PROFILING_ENABLED=1 every statement issued inside a Flask request is recorded by
+# normalized shape. A shape repeated SQL_PROFILE_REPEAT_THRESHOLD+ times in one request is
+# flagged as a likely N+1. Meant for staging; costs one regex pass per distinct statement.
+SQL_PROFILING_ENABLED = os.environ.get("SQL_PROFILING_ENABLED", "").lower() in ("1", "true", "yes")
+SQL_PROFILE_REPEAT_THRESHOLD = int(os.environ.get("SQL_PROFILE_REPEAT_THRESHOLD", "3"))
+
+_SQL_STRING_LITERAL_RE = re.compile(r"'(?:[^']|'')*'")
+_SQL_NUMBER_RE = re.compile(r"\b\d+(?:\.\d+)?\b")
+_SQL_PLACEHOLDER_RE = re.compile(r"%\(\w+\)s|%s|:\w+|\?")
+_SQL_IN_LIST_RE = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_SQL_WHITESPACE_RE = re.compile(r"\s+")
+
+@functools.lru_cache(maxsize=2048)
+def normalize_sql_shape(statement: str) -> str:
+    """Collapses literals, bind parameters and IN-lists so repeats of one query share a shape."""
+    shape = _SQL_STRING_LITERAL_RE.sub("?", statement)
+    shape = _SQL_PLACEHOLDER_RE.sub("?", shape)
+    shape = _SQL_NUMBER_RE.sub("?", shape)
+    shape = _SQL_IN_LIST_RE.sub("(?...)", shape)
+    return _SQL_WHITESPACE_RE.sub(" ", shape).strip()
+
+class RequestQueryProfile:
+    __slots__ = ('query_count', 'total_seconds', 'shapes')
+
+    def __init__(self):
+        self.query_count = 0
+        self.total_seconds = 0.0
+        self.shapes = {} # shape -> [count, total_seconds]
+
+    def record(self, statement: str, elapsed: float):
+        self.query_count += 1
+        self.total_seconds += elapsed
+        stats = self.shapes.get(statement)
+        if stats is None:
+            stats = self.shapes[statement] = [0, 0.0]
+        stats[0] += 1
+        stats[1] += elapsed
+
+    def repeated_shapes(self) -> dict:
+        """Normalizes the raw statements and returns {shape: (count, seconds)} for shapes over the threshold."""
+        by_shape = {}
+        for statement, (count, seconds) in self.shapes.items():
+            shape = normalize_sql_shape(statement)
+            prev_count, prev_seconds = by_shape.get(shape, (0, 0.0))
+            by_shape[shape] = (prev_count + count, prev_seconds + seconds)
+        return {shape: stats for shape, stats in by_shape.items() if stats[0] >= SQL_PROFILE_REPEAT_THRESHOLD}
+
+class SqlProfileReport:
+    """Per-route aggregates of request profiles since startup."""
+    def __init__(self):
+        self._routes = {}
+        self._lock = threading.Lock()
+
+    def add(self, route: str, profile: RequestQueryProfile, repeated: dict):
+        with self._lock:
+            stats = self._routes.get(route)
+            if stats is None:
+                stats = self._routes[route] = {"requests": 0, "queries": 0, "query_seconds": 0.0, "max_queries": 0, "repeated_shapes": {}}
+            stats["requests"] += 1
+            stats["queries"] += profile.query_count
+            stats["query_seconds"] += profile.total_seconds
+            stats["max_queries"] = max(stats["max_queries"], profile.query_count)
+            for shape, (count, _) in repeated.items():
+                shape_stats = stats["repeated_shapes"].setdefault(shape, {"flagged_requests": 0, "max_repeats": 0})
+                shape_stats["flagged_requests"] += 1
+                shape_stats["max_repeats"] = max(shape_stats["max_repeats"], count)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            report = {}
+            for route, stats in self._routes.items():
+                report[route] = {
+                    "requests": stats["requests"],
+                    "avg_queries": round(stats["queries"] / stats["requests"], 2),
+                    "max_queries": stats["max_queries"],
+                    "avg_query_ms": round(stats["query_seconds"] * 1000 / stats["requests"], 3),
+                    "repeated_shapes": [
+                        {"shape": shape, **shape_stats}
+                        for shape, shape_stats in sorted(stats["repeated_shapes"].items(), key=lambda kv: -kv[1]["flagged_requests"])
+                    ],
+                }
+            return report
+
+sql_profile_report = SqlProfileReport()
+
+
 # --- SQLAlchemy Database Setup ---
-engine = create_engine(DATABASE_URL, pool_recycle=3600, pool_pre_ping=True)
+engine = create_engine(DATABASE_URL, pool_recycle=3600, pool_pre_ping=True, poolclass=InstrumentedQueuePool)
+
+@event.listens_for(engine, "before_cursor_execute")
+def _record_query_start(conn, cursor, statement, parameters, context, executemany):
+    context._metrics_query_started = time.perf_counter()
+
+@event.listens_for(engine, "after_cursor_execute")
+def _record_query_end(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - context._metrics_query_started
+    DB_QUERIES_TOTAL.inc()
+    DB_QUERY_DURATION.observe(elapsed)
+    if SQL_PROFILING_ENABLED and has_request_context():
+        profile = g.get('_sql_profile')
+        if profile is not None:
+            profile.record(statement, elapsed)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
@@ -148,7 +540,7 @@ class User(Base):
     username = Column(String, nullable=True, index=True)
     first_name = Column(String, nullable=True)
     last_name = Column(String, nullable=True)
-    ton_balance = Column(Float, default=0.0, nullable=False)
+    ton_balance = Column(BigInteger, default=0, nullable=False) # nanoTON (1 TON = 10**9)
     star_balance = Column(Integer, default=0, nullable=False)
     referral_code = Column(String, unique=True, index=True, nullable=True)
     referred_by_id = Column(BigInteger, ForeignKey("users.id"), nullable=True)
@@ -210,14 +602,163 @@ class UserPromoCodeRedemption(Base):
     __tablename__ = "user_promo_code_redemptions"
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
     user_id = Column(BigInteger, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
-    promo_code_id = Column(Integer, ForeignKey("promo_codes.id", ondelete="CASCADE"), nullable=False)
+    promo_code_id = Column(Integer, ForeignKey("promo_codes.id", ondelete="CASCADE"), nullable=False, index=True) # Per-code counts; the unique constraint leads with user_id
     redeemed_at = Column(DateTime(timezone=True), server_default=func.now())
     user = relationship("User")
     promo_code = relationship("PromoCode")
     __table_args__ = (UniqueConstraint('user_id', 'promo_code_id', name='uq_user_promo_redemption'),)
 
+class FairnessSeed(Base):
+    """A user's provably-fair seed pair. server_seed stays secret (only its hash is shown) until rotated out."""
+    __tablename__ = "fairness_seeds"
+    id = Column(Integer, primary_key=True, index=True, autoincrement=True)
+    user_id = Column(BigInteger, ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True)
+    server_seed = Column(String, nullable=False)
+    server_seed_hash = Column(String, nullable=False)
+    client_seed = Column(String, nullable=False)
+    nonce = Column(Integer, nullable=False, default=0) # Games played on this pair; each game uses the incremented value
+    is_active = Column(Boolean, nullable=False, default=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    revealed_at = Column(DateTime(timezone=True), nullable=True)
+    __table_args__ = (Index('uq_fairness_seed_active_user', 'user_id', unique=True, postgresql_where=text('is_active')),)
+
+class GameEvent(Base):
+    """Append-only record of one open, spin or upgrade. Written in batches by game_ledger, never updated."""
+    __tablename__ = "game_events"
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    created_at = Column(DateTime(timezone=True), nullable=False)
+    user_id = Column(BigInteger, nullable=False) # No FK: events outlive user rows and add no lock traffic on users
+    game_type = Column(String, nullable=False) # case | slot | upgrade | upgrade_v2 | convert | withdrawal | deposit
+    game_id = Column(String, nullable=False) # Case/slot id, v1 multiplier, v2 target name, or converted/withdrawn item name
+    cost_nano = Column(BigInteger, nullable=False) # TON paid, or value of the item staked, converted or withdrawn
+    value_nano = Column(BigInteger, nullable=False) # TON value received
+    outcome = Column(String, nullable=False) # win | loss, success | failed, converted, requested | sent, credited
+    rng_ref = Column(String, nullable=False) # "csprng", "pf:<server seed hash>:<nonce>" or "none"
+    details = Column(JSONB, nullable=True)
+    # History pages are keyset scans on one of these, never more than a page of index entries
+    __table_args__ = (
+        Index('ix_game_events_user_id_id', 'user_id', 'id'),
+        Index('ix_game_events_user_id_game_type_id', 'user_id', 'game_type', 'id'),
+    )
+
+class SchemaMigration(Base):
+    """Marker row per one-shot data migration, written in the migration's own transaction."""
+    __tablename__ = "schema_migrations"
+    name = Column(String, primary_key=True)
+    applied_at = Column(DateTime(timezone=True), server_default=func.now())
+
+# Admin /stats rollups, maintained by run_stats_rollup(); the bot reads only these
+class StatsDaily(Base):
+    __tablename__ = "stats_daily"
+    day = Column(Date, primary_key=True) # UTC
+    games_played = Column(BigInteger, nullable=False, server_default=text('0'))
+    games_cost_nano = Column(BigInteger, nullable=False, server_default=text('0'))
+    games_value_nano = Column(BigInteger, nullable=False, server_default=text('0'))
+    deposits_count = Column(BigInteger, nullable=False, server_default=text('0'))
+    deposits_nano = Column(BigInteger, nullable=False, server_default=text('0'))
+    withdrawals_count = Column(BigInteger, nullable=False, server_default=text('0'))
+    active_users = Column(BigInteger, nullable=False, server_default=text('0'))
+
+class StatsDailyUser(Base):
+    """Who was active on a recent day, so active_users counts each user once. Pruned after STATS_ACTIVE_USER_RETENTION_DAYS."""
+    __tablename__ = "stats_daily_users"
+    day = Column(Date, primary_key=True)
+    user_id = Column(BigInteger, primary_key=True)
+
+class StatsTotals(Base):
+    """Single row (id=1) of whole-table totals plus the game_events watermark of the daily rollup."""
+    __tablename__ = "stats_totals"
+    id = Column(Integer, primary_key=True)
+    users = Column(BigInteger, nullable=False, server_default=text('0'))
+    balances_nano = Column(BigInteger, nullable=False, server_default=text('0'))
+    inventory_items = Column(BigInteger, nullable=False, server_default=text('0'))
+    inventory_value = Column(Float, nullable=False, server_default=text('0'))
+    pending_deposits = Column(BigInteger, nullable=False, server_default=text('0'))
+    last_event_id = Column(BigInteger, nullable=False, server_default=text('0')) # game_events up to here are in stats_daily
+    event_id_bound = Column(BigInteger, nullable=False, server_default=text('0')) # max(id) seen by the previous run
+    refreshed_at = Column(DateTime(timezone=True), nullable=True)
+
 # Create database tables
-Base.metadata.create_all(bind=engine)
+if not SKIP_STARTUP_TASKS:
+    Base.metadata.create_all(bind=engine)
+
+SCHEMA_MIGRATION_LOCK_ID = 724500001 # pg advisory lock key, serializes migrations across booting workers
+
+def migrate_ton_balance_to_nanoton():
+    """Idempotent one-off migration of users.ton_balance from Float TON to BigInteger nanoTON."""
+    try:
+        with engine.begin() as conn:
+            conn.execute(text("SELECT pg_advisory_xact_lock(:lock_id)"), {"lock_id": SCHEMA_MIGRATION_LOCK_ID})
+            data_type = conn.execute(text(
+                "SELECT data_type FROM information_schema.columns WHERE table_name = 'users' AND column_name = 'ton_balance'"
+            )).scalar()
+            if data_type == 'double precision':
+                conn.execute(text(
+                    "ALTER TABLE users "
+                    "ALTER COLUMN ton_balance TYPE BIGINT USING ROUND(ton_balance::numeric * 1000000000)::bigint, "
+                    "ALTER COLUMN ton_balance SET DEFAULT 0"
+                ))
+                logger.info("Migrated users.ton_balance from Float TON to BigInteger nanoTON.")
+    except SQLAlchemyError as e:
+        logger.error(f"Failed to migrate users.ton_balance to nanoTON: {e}", exc_info=True)
+        raise
+
+def ensure_promo_redemption_index():
+    """create_all does not add indexes to existing tables; this adds the per-code one on older databases."""
+    try:
+        with engine.begin() as conn:
+            conn.execute(text(
+                "CREATE INDEX IF NOT EXISTS ix_user_promo_code_redemptions_promo_code_id "
+                "ON user_promo_code_redemptions (promo_code_id)"
+            ))
+    except SQLAlchemyError as e:
+        logger.error(f"Failed to create the promo redemption index: {e}", exc_info=True)
+
+if not SKIP_STARTUP_TASKS:
+    migrate_ton_balance_to_nanoton()
+    ensure_promo_redemption_index()
+
+# --- Balance Helpers (nanoTON) ---
+NANOTON_PER_TON = 10**9
+
+def ton_to_nano(amount_ton) -> int:
+    return int((Decimal(str(amount_ton)) * NANOTON_PER_TON).to_integral_value(ROUND_HALF_UP))
+
+def nano_to_ton(amount_nano: int) -> float:
+    return float(Decimal(amount_nano) / NANOTON_PER_TON)
+
+def debit_ton_balance(db, user_id: int, cost_nano: int, payout_nano: int = 0, total_won_delta: Decimal | None = None) -> int | None:
+    """
+    Atomically charges cost_nano (and credits payout_nano) in one conditional UPDATE.
+    Returns the new balance in nanoTON, or None if the user does not exist or cannot afford cost_nano.
+    """
+    values = {User.ton_balance: User.ton_balance - cost_nano + payout_nano}
+    if total_won_delta:
+        values[User.total_won_ton] = func.greatest(User.total_won_ton + float(total_won_delta), 0.0)
+    conditions = [User.id == user_id]
+    if cost_nano > 0:
+        conditions.append(User.ton_balance >= cost_nano)
+    stmt = (
+        update(User)
+        .where(*conditions)
+        .values(values)
+        .returning(User.ton_balance)
+        .execution_options(synchronize_session=False)
+    )
+    return db.execute(stmt).scalar_one_or_none()
+
+def credit_ton_balance(db, user_id: int, amount_nano: int, total_won_delta: Decimal | None = None) -> int | None:
+    """Atomically credits amount_nano. Returns the new balance in nanoTON, or None if the user does not exist."""
+    return debit_ton_balance(db, user_id, 0, payout_nano=amount_nano, total_won_delta=total_won_delta)
+
+def adjust_total_won(db, user_id: int, total_won_delta: Decimal):
+    """Applies a delta to users.total_won_ton (clamped at 0) without taking a separate row lock round trip."""
+    db.execute(
+        update(User)
+        .where(User.id == user_id)
+        .values({User.total_won_ton: func.greatest(User.total_won_ton + float(total_won_delta), 0.0)})
+        .execution_options(synchronize_session=False)
+    )
 
 bot = telebot.TeleBot(BOT_TOKEN, threaded=False) if BOT_TOKEN else None
 
@@ -245,7 +786,6 @@ if bot: # Ensure bot instance exists
             logger.info(f"User {user_id} initiated start with referral code: {referral_code_found}")
             # The existing API endpoint /api/register_referral will handle the logic
             try:
-                import requests
                 api_payload = {
                     "user_id": user_id,
                     "username": username,
@@ -285,7 +825,8 @@ if bot: # Ensure bot instance exists
         markup = types.InlineKeyboardMarkup(row_width=1)
         new_promo_button = types.InlineKeyboardButton("🆕 New Promocode", callback_data="admin_new_promo")
         view_promos_button = types.InlineKeyboardButton("📋 All Promocodes", callback_data="admin_view_promos")
-        markup.add(new_promo_button, view_promos_button)
+        stats_button = types.InlineKeyboardButton("📊 Stats", callback_data="admin_stats")
+        markup.add(new_promo_button, view_promos_button, stats_button)
         bot.send_message(message.chat.id, "👑 Admin Panel 👑", reply_markup=markup)
     
     # --- Admin Callback Query Handler ---
@@ -314,6 +855,19 @@ if bot: # Ensure bot instance exists
         elif action == "admin_view_promos":
             handle_view_all_promos(call.message) # Pass message to edit
     
+        elif action.startswith(("admin_promos_before_", "admin_promos_after_")):
+            direction, _, cursor_str = action[len("admin_promos_"):].partition("_")
+            try:
+                cursor_id = int(cursor_str)
+            except ValueError:
+                logger.error(f"Invalid promo page cursor in callback: {action}")
+                bot.send_message(call.message.chat.id, "Error: Invalid page.")
+            else:
+                if direction == "before":
+                    handle_view_all_promos(call.message, before_id=cursor_id)
+                else:
+                    handle_view_all_promos(call.message, after_id=cursor_id)
+    
         elif action.startswith("admin_promo_detail_"):
             promo_code_id_str = action.split("admin_promo_detail_")[1]
             try:
@@ -324,11 +878,15 @@ if bot: # Ensure bot instance exists
                 # Inform the admin via a new message if editing fails or is not appropriate
                 bot.send_message(call.message.chat.id, "Error: Invalid promo code identifier.")
         
+        elif action == "admin_stats":
+            send_admin_stats(call.message.chat.id)
+
         elif action == "admin_back_to_menu":
             markup = types.InlineKeyboardMarkup(row_width=1)
             new_promo_button = types.InlineKeyboardButton("🆕 New Promocode", callback_data="admin_new_promo")
             view_promos_button = types.InlineKeyboardButton("📋 All Promocodes", callback_data="admin_view_promos")
-            markup.add(new_promo_button, view_promos_button)
+            stats_button = types.InlineKeyboardButton("📊 Stats", callback_data="admin_stats")
+            markup.add(new_promo_button, view_promos_button, stats_button)
             try:
                 bot.edit_message_text("👑 Admin Panel 👑", chat_id=call.message.chat.id, message_id=call.message.message_id, reply_markup=markup)
             except Exception as e:
@@ -349,7 +907,8 @@ if bot: # Ensure bot instance exists
             markup = types.InlineKeyboardMarkup(row_width=1)
             new_promo_button = types.InlineKeyboardButton("🆕 New Promocode", callback_data="admin_new_promo")
             view_promos_button = types.InlineKeyboardButton("📋 All Promocodes", callback_data="admin_view_promos")
-            markup.add(new_promo_button, view_promos_button)
+            stats_button = types.InlineKeyboardButton("📊 Stats", callback_data="admin_stats")
+            markup.add(new_promo_button, view_promos_button, stats_button)
             bot.send_message(message.chat.id, "👑 Admin Panel 👑", reply_markup=markup)
             return
     
@@ -395,6 +954,7 @@ if bot: # Ensure bot instance exists
                 )
                 db.add(new_promo)
                 db.commit()
+                promo_cache.invalidate()
                 bot.reply_to(message, 
                              f"✅ Promocode '{promo_name}' created successfully!\n"
                              f"Activations: {'Unlimited' if activations == -1 else activations}\n"
@@ -436,7 +996,8 @@ if bot: # Ensure bot instance exists
             markup = types.InlineKeyboardMarkup(row_width=1)
             new_promo_button = types.InlineKeyboardButton("🆕 New Promocode", callback_data="admin_new_promo")
             view_promos_button = types.InlineKeyboardButton("📋 All Promocodes", callback_data="admin_view_promos")
-            markup.add(new_promo_button, view_promos_button)
+            stats_button = types.InlineKeyboardButton("📊 Stats", callback_data="admin_stats")
+            markup.add(new_promo_button, view_promos_button, stats_button)
             bot.send_message(message.chat.id, "👑 Admin Panel 👑", reply_markup=markup)
         else:
             # For regular users, /cancel might not do anything specific unless defined elsewhere.
@@ -445,28 +1006,62 @@ if bot: # Ensure bot instance exists
     
     
     # --- Handle Viewing All Promocodes ---
-    def handle_view_all_promos(message_to_edit): # Takes a message object to edit
+    def promo_redemption_counts(db, promo_ids) -> dict:
+        """promo_code_id -> redemptions, from one grouped query over the given ids."""
+        if not promo_ids:
+            return {}
+        return dict(
+            db.query(UserPromoCodeRedemption.promo_code_id, func.count(UserPromoCodeRedemption.id))
+            .filter(UserPromoCodeRedemption.promo_code_id.in_(promo_ids))
+            .group_by(UserPromoCodeRedemption.promo_code_id)
+            .all()
+        )
+
+    def handle_view_all_promos(message_to_edit, before_id=None, after_id=None): # Takes a message object to edit
+        """Newest first, ADMIN_PROMO_PAGE_SIZE per page, keyset-paginated on id in either direction."""
         db = SessionLocal()
         try:
-            all_promos = db.query(PromoCode).order_by(PromoCode.created_at.desc()).all()
+            columns = db.query(PromoCode.id, PromoCode.code_text, PromoCode.activations_left)
+            if after_id is not None:
+                rows = columns.filter(PromoCode.id > after_id).order_by(PromoCode.id.asc()).limit(ADMIN_PROMO_PAGE_SIZE + 1).all()
+                has_newer, has_older = len(rows) > ADMIN_PROMO_PAGE_SIZE, True
+                page = rows[:ADMIN_PROMO_PAGE_SIZE][::-1]
+            else:
+                if before_id is not None:
+                    columns = columns.filter(PromoCode.id < before_id)
+                rows = columns.order_by(PromoCode.id.desc()).limit(ADMIN_PROMO_PAGE_SIZE + 1).all()
+                has_newer, has_older = before_id is not None, len(rows) > ADMIN_PROMO_PAGE_SIZE
+                page = rows[:ADMIN_PROMO_PAGE_SIZE]
+            if not page and (before_id is not None or after_id is not None):
+                # The page emptied (codes deleted) since the buttons were drawn; start over
+                db.close()
+                return handle_view_all_promos(message_to_edit)
+            redemption_counts = promo_redemption_counts(db, [promo.id for promo in page])
             
             markup = types.InlineKeyboardMarkup(row_width=2) # Adjust row_width as needed
             
-            if not all_promos:
+            if not page:
                 text_to_send = "No promocodes found in the database."
             else:
-                text_to_send = "Select a promocode to view details:"
+                text_to_send = "Select a promocode to view details (newest first, redemptions / activations left):"
                 promo_buttons = []
-                for promo in all_promos:
+                for promo in page:
                     # Show promo code text on the button, callback data contains ID for detail view
-                    button_text = f"{promo.code_text}" # Can add more info like (Act: X) if short enough
+                    activations_text = "∞" if promo.activations_left == -1 else str(promo.activations_left)
+                    button_text = f"{promo.code_text} ({redemption_counts.get(promo.id, 0)}/{activations_text})"
                     promo_buttons.append(types.InlineKeyboardButton(button_text, callback_data=f"admin_promo_detail_{promo.id}"))
                 
-                # Add buttons in rows
-                # Simple grouping for row_width=2, can be made more dynamic
                 grouped_buttons = [promo_buttons[i:i + 2] for i in range(0, len(promo_buttons), 2)]
                 for group in grouped_buttons:
                     markup.row(*group) # Unpack the group of buttons into the row
+                
+                page_buttons = []
+                if has_newer:
+                    page_buttons.append(types.InlineKeyboardButton("◀️ Newer", callback_data=f"admin_promos_after_{page[0].id}"))
+                if has_older:
+                    page_buttons.append(types.InlineKeyboardButton("Older ▶️", callback_data=f"admin_promos_before_{page[-1].id}"))
+                if page_buttons:
+                    markup.row(*page_buttons)
             
             markup.add(types.InlineKeyboardButton("⬅️ Back to Admin Menu", callback_data="admin_back_to_menu"))
     
@@ -480,7 +1075,7 @@ if bot: # Ensure bot instance exists
                  bot.send_message(message_to_edit.chat.id, text_to_send, reply_markup=markup) # Send as new message
     
         except SQLAlchemyError as e_sql:
-            logger.error(f"SQLAlchemyError fetching all promocodes: {e_sql}")
+            logger.error(f"SQLAlchemyError fetching promocodes page (before={before_id}, after={after_id}): {e_sql}")
             bot.send_message(message_to_edit.chat.id, "Database error fetching promocodes.")
         finally:
             db.close()
@@ -502,11 +1097,16 @@ if bot: # Ensure bot instance exists
             if not promo:
                 text_to_send = "Promocode not found."
             else:
+                redemptions, last_redeemed_at = db.query(
+                    func.count(UserPromoCodeRedemption.id), func.max(UserPromoCodeRedemption.redeemed_at)
+                ).filter(UserPromoCodeRedemption.promo_code_id == promo.id).one()
                 activations_text = "Unlimited" if promo.activations_left == -1 else str(promo.activations_left)
                 text_to_send = (
                     f"📜 Promocode Details: *{promo.code_text}*\n\n"
                     f"🎁 Prize: {promo.ton_amount:.4f} TON\n" # Using .4f for TON display
                     f"🔄 Activations Left: {activations_text}\n"
+                    f"✅ Redeemed: {redemptions} times ({redemptions * promo.ton_amount:.4f} TON)\n"
+                    f"🕒 Last Redeemed: {last_redeemed_at.strftime('%Y-%m-%d %H:%M') if last_redeemed_at else 'Never'}\n"
                     f"🗓️ Created: {promo.created_at.strftime('%Y-%m-%d %H:%M') if promo.created_at else 'N/A'}"
                 )
             
@@ -527,9 +1127,70 @@ if bot: # Ensure bot instance exists
         finally:
             db.close()
             
+    # --- /stats command: operational totals from the rollup tables ---
+    def send_admin_stats(chat_id):
+        db = SessionLocal()
+        try:
+            bot.send_message(chat_id, format_admin_stats(db))
+        except SQLAlchemyError as e_sql:
+            logger.error(f"SQLAlchemyError reading stats rollups: {e_sql}")
+            bot.send_message(chat_id, "Database error reading stats.")
+        finally:
+            db.close()
+
+    @bot.message_handler(commands=['stats'])
+    def admin_stats_command(message):
+        if message.chat.id != ADMIN_USER_ID:
+            bot.reply_to(message, "You are not authorized to use this command.")
+            logger.warning(f"Unauthorized /stats attempt by user {message.chat.id}")
+            return
+        send_admin_stats(message.chat.id)
+
+    # --- /setfloor command: update one floor price at runtime ---
+    @bot.message_handler(commands=['setfloor'])
+    def set_floor_price_command(message):
+        if message.chat.id != ADMIN_USER_ID:
+            bot.reply_to(message, "You are not authorized to use this command.")
+            logger.warning(f"Unauthorized /setfloor attempt by user {message.chat.id}")
+            return
+
+        parts = message.text.split()
+        try:
+            if len(parts) < 3:
+                raise ValueError("Expected: `/setfloor item name price`")
+            nft_name = " ".join(parts[1:-1])
+            new_price = float(parts[-1])
+            if not math.isfinite(new_price) or new_price <= 0:
+                raise ValueError("Floor price must be a positive number.")
+        except ValueError as e:
+            bot.reply_to(message, f"Error: {str(e)}\nExample: `/setfloor Plush Pepe 3100`", parse_mode="Markdown")
+            return
+
+        db = SessionLocal()
+        try:
+            updated_rows = db.query(NFT).filter(NFT.name == nft_name).update({"floor_price": new_price})
+            db.commit()
+        except SQLAlchemyError as e_sql:
+            db.rollback()
+            logger.error(f"SQLAlchemyError setting floor price for {nft_name}: {e_sql}")
+            bot.reply_to(message, "Database error while updating floor price.")
+            return
+        finally:
+            db.close()
+
+        if not updated_rows:
+            bot.reply_to(message, f"⚠️ NFT '{nft_name}' not found.")
+            return
+
+        changed = reload_floor_prices()
+        logger.info(f"Admin {message.chat.id} set floor price of {nft_name} to {new_price} TON")
+        bot.reply_to(message,
+                     f"✅ Floor price of '{nft_name}' set to {new_price:.4f} TON.\n"
+                     f"{len(changed)} price(s) reloaded on this worker; other workers pick it up within {FLOOR_PRICE_RELOAD_INTERVAL_SECONDS}s.")
+
     @bot.message_handler(func=lambda message: True)
     def echo_all(message):
-        logger.info(f"Received non-command message from {message.chat.id}: {message.text[:50]}")
+        logger.info("Received non-command message from %s: %.50s", message.chat.id, message.text)
         bot.reply_to(message, "Send /start, to open Pusik Gifts")
 
 # --- Webhook Setup Function (to be called from your main app setup) ---
@@ -642,6 +1303,18 @@ class TonnelGiftSender:
                 self._session_instance = None
 
     async def _make_request(self, method: str, url: str, headers: dict | None = None, json_payload: dict | None = None, timeout: int = 30, is_initial_get: bool = False):
+        parsed_url = urlparse(url)
+        endpoint = parsed_url.netloc + re.sub(r'/\d+(?=/|$)', '/:id', parsed_url.path)
+        request_started = time.perf_counter()
+        outcome = 'error'
+        try:
+            result = await self._send_request(method, url, headers, json_payload, timeout, is_initial_get)
+            outcome = 'ok'
+            return result
+        finally:
+            TONNEL_REQUEST_DURATION.observe(time.perf_counter() - request_started, method.upper(), endpoint, outcome)
+
+    async def _send_request(self, method: str, url: str, headers: dict | None, json_payload: dict | None, timeout: int, is_initial_get: bool):
         session = await self._get_session()
         response_obj = None
         try:
@@ -749,7 +1422,7 @@ class TonnelGiftSender:
             
             low_gift = gifts_found_response[0]
 
-            logger.info(f"Tonnel gift found for '{gift_item_name}': {json.dumps(low_gift, indent=2)}")
+            logger.info("Tonnel gift found for '%s': %s", gift_item_name, low_gift)
             
             # Step 3: Verify the receiver's Telegram ID with Tonnel (optional but good practice for robustness)
             user_info_payload = {"authData":self.authdata,"user":receiver_telegram_id}
@@ -913,10 +1586,11 @@ GIFT_NAME_TO_ID_MAP_PY = {
 }
 
 
-def generate_image_filename_from_name(name_str: str) -> str:
+def compute_image_filename_from_name(name_str: str) -> str:
     """
     Generates a filename or direct CDN URL for a gift image based on its name.
     Prioritizes Tonnel CDN, then local repo paths for special cases, then generic conversion.
+    Use generate_image_filename_from_name, which serves known names from IMAGE_URL_BY_NAME.
     """
     if not name_str: return 'placeholder.png'
 
@@ -943,6 +1617,23 @@ def generate_image_filename_from_name(name_str: str) -> str:
         filename += '.png'
     return filename
 
+IMAGE_URL_MEMO_SIZE = 4096 # Bound on memoized URLs for names outside the precomputed table
+# IMAGE_URL_BY_NAME, the frozen name -> URL table, is built once below, after every catalog and TON prize name is defined
+
+def build_image_url_table(names) -> MappingProxyType:
+    return MappingProxyType({name: compute_image_filename_from_name(name) for name in names if name})
+
+@functools.lru_cache(maxsize=IMAGE_URL_MEMO_SIZE)
+def _memoized_image_filename(name_str: str) -> str:
+    return compute_image_filename_from_name(name_str)
+
+def generate_image_filename_from_name(name_str: str) -> str:
+    """Image URL for a gift, Kissed Frog model or TON prize name."""
+    url = IMAGE_URL_BY_NAME.get(name_str)
+    if url is None:
+        url = _memoized_image_filename(name_str)
+    return url
+
 # --- Floor Prices for all known NFTs (and Kissed Frog variants) ---
 UPDATED_FLOOR_PRICES = {
     'Plush Pepe': 3024.0,       # Updated
@@ -1044,7 +1735,7 @@ def calculate_rtp_probabilities(case_data, all_floor_prices):
     for p_info in case_data['prizes']:
         prize_name = p_info['name']
         floor_price = Decimal(str(all_floor_prices.get(prize_name, 0)))
-        image_filename = p_info.get('imageFilename', generate_image_filename_from_name(prize_name)) # Preserve image filename
+        image_filename = p_info.get('imageFilename') or generate_image_filename_from_name(prize_name) # Preserve image filename
         is_ton_prize = p_info.get('is_ton_prize', False) # Preserve is_ton_prize
         prizes.append({'name': prize_name, 'probability': Decimal(str(p_info['probability'])), 'floor_price': floor_price, 'imageFilename': image_filename, 'is_ton_prize': is_ton_prize})
 
@@ -1160,7 +1851,7 @@ def calculate_rtp_probabilities_proportional_fallback(case_data, all_floor_price
     for p_info in case_data['prizes']:
         prize_name = p_info['name']
         floor_price = Decimal(str(all_floor_prices.get(prize_name, 0)))
-        image_filename = p_info.get('imageFilename', generate_image_filename_from_name(prize_name))
+        image_filename = p_info.get('imageFilename') or generate_image_filename_from_name(prize_name)
         is_ton_prize = p_info.get('is_ton_prize', False)
         prizes.append({'name': prize_name, 'probability': Decimal(str(p_info['probability'])), 'floor_price': floor_price, 'imageFilename': image_filename, 'is_ton_prize': is_ton_prize})
 
@@ -1234,7 +1925,7 @@ def calculate_rtp_probabilities_for_slots(slot_data, all_floor_prices):
         prize_name = p_info['name']
         value_source = p_info.get('value', p_info.get('floorPrice', 0))
         floor_price = Decimal(str(value_source))
-        image_filename = p_info.get('imageFilename', generate_image_filename_from_name(prize_name)) # Preserve image filename
+        image_filename = p_info.get('imageFilename') or generate_image_filename_from_name(prize_name) # Preserve image filename
         is_ton_prize = p_info.get('is_ton_prize', False) # Preserve is_ton_prize
         prizes.append({
             'name': prize_name,
@@ -1564,16 +2255,10 @@ cases_data_backend_with_fixed_prices_raw = [
         {'name':'Pet Snake', 'probability': 0.05}
     ], key=lambda p: UPDATED_FLOOR_PRICES.get(p['name'], 0), reverse=True)},
 
-    # Kissed Frog case uses the dynamically processed 'kissed_frog_processed_prizes_updated'
-    # which is derived from 'finalKissedFrogPrizesWithConsolation_Python_updated'
-    # The RTP function will take 'finalKissedFrogPrizesWithConsolation_Python_updated' as input.
-    # So, the case definition references the processed variable that your setup creates.
-    # For now, I'm providing the raw input that the RTP function would use.
+    # Kissed Frog case uses the raw 'finalKissedFrogPrizesWithConsolation_Python' template;
+    # build_case_from_template applies the RTP calculation like for every other case.
     {'id':'kissedfrog','name':'Kissed Frog Pond','priceTON':20.0,'imageFilename':'https://raw.githubusercontent.com/Vasiliy-katsyka/case/main/caseImages/Kissed-Frog.jpg',
-     'prizes': calculate_rtp_probabilities( # Simulating how backend would process it
-         {'id':'kissedfrog','name':'Kissed Frog Pond','priceTON':20.0,'prizes': finalKissedFrogPrizesWithConsolation_Python},
-         UPDATED_FLOOR_PRICES
-     )
+     'prizes': finalKissedFrogPrizesWithConsolation_Python
     },
 
     {'id':'perfumebottle','name':'Perfume Chest','imageFilename':'https://raw.githubusercontent.com/Vasiliy-katsyka/case/main/caseImages/Perfume-Bottle.jpg','priceTON': 20.0,'prizes': sorted([
@@ -1647,19 +2332,23 @@ cases_data_backend_with_fixed_prices_raw = [
     ], key=lambda p: UPDATED_FLOOR_PRICES.get(p['name'], 0), reverse=True)}
 ]
 
-cases_data_backend = []
-for case_template in cases_data_backend_with_fixed_prices_raw:
-    processed_case = {**case_template}
+def build_case_from_template(case_template, all_floor_prices):
+    """
+    Re-sorts a case template's prizes by current floor price and applies the RTP calculation.
+    Returns None if the calculation fails, so the case is left out of the catalog.
+    """
     try:
-        processed_case['prizes'] = calculate_rtp_probabilities(processed_case, UPDATED_FLOOR_PRICES)
-        cases_data_backend.append(processed_case)
+        prizes_by_value = sorted(case_template['prizes'], key=lambda p: all_floor_prices.get(p['name'], 0), reverse=True)
+        processed_case = {**case_template, 'prizes': prizes_by_value}
+        processed_case['prizes'] = calculate_rtp_probabilities(processed_case, all_floor_prices)
+        return processed_case
     except Exception as e:
         # Log the error and skip this case if RTP calculation fails
         case_id = case_template.get('id', 'N/A')
         case_name = case_template.get('name', 'Unnamed Case')
         logger.error(f"Failed to process case '{case_name}' (ID: {case_id}) for RTP. Skipping this case. Error: {e}", exc_info=True)
         # This will cause the case to be 'not found' by the API if requested.
-        # You might want to add a dummy case or a specific error message if this happens frequently.
+        return None
 
 DEFAULT_SLOT_TON_PRIZES = [
     {'name': "0.1 TON", 'value': 0.1, 'is_ton_prize': True, 'probability': 0.1},
@@ -1672,22 +2361,37 @@ PREMIUM_SLOT_TON_PRIZES = [
     {'name': "5 TON", 'value': 5.0, 'is_ton_prize': True, 'probability': 0.03}
 ]
 
-ALL_ITEMS_POOL_FOR_SLOTS = [{'name': name, 'floorPrice': price, 'imageFilename': generate_image_filename_from_name(name), 'is_ton_prize': False}
-                            for name, price in UPDATED_FLOOR_PRICES.items()]
+# Built exactly once, before the first bulk lookup (case processing below): catalog gifts, Kissed Frog models,
+# case prizes (TON prizes and any non-catalog items) and slot TON prizes
+IMAGE_URL_BY_NAME = build_image_url_table({
+    "placeholder_nothing.png", *GIFT_NAME_TO_ID_MAP_PY, *UPDATED_FLOOR_PRICES,
+    *(prize['name'] for case_template in cases_data_backend_with_fixed_prices_raw for prize in case_template['prizes']),
+    *(prize['name'] for prize in finalKissedFrogPrizesWithConsolation_Python),
+    *(prize['name'] for prize in DEFAULT_SLOT_TON_PRIZES + PREMIUM_SLOT_TON_PRIZES),
+})
 
-slots_data_backend = []
+cases_data_backend = []
+for case_template in cases_data_backend_with_fixed_prices_raw:
+    processed_case = build_case_from_template(case_template, UPDATED_FLOOR_PRICES)
+    if processed_case:
+        cases_data_backend.append(processed_case)
 
-def finalize_slot_prize_pools():
-    global slots_data_backend
-    updated_slots_data_backend = []
-    
+def build_slot_items_pool(all_floor_prices):
+    return [{'name': name, 'floorPrice': price, 'imageFilename': generate_image_filename_from_name(name), 'is_ton_prize': False}
+            for name, price in all_floor_prices.items()]
+
+ALL_ITEMS_POOL_FOR_SLOTS = build_slot_items_pool(UPDATED_FLOOR_PRICES)
+
+DEFAULT_SLOT_MAX_ITEM_PRICE = 5.0 # Items at or below this floor price go to the default slot, above it to the premium slot
+
+def build_default_slot(all_floor_prices):
     default_slot_prizes_template = []
     default_slot_prizes_template.extend([
         {'name': "0.1 TON", 'value': 0.1, 'is_ton_prize': True, 'probability': 0.1},
         {'name': "0.25 TON", 'value': 0.25, 'is_ton_prize': True, 'probability': 0.08},
         {'name': "0.5 TON", 'value': 0.5, 'is_ton_prize': True, 'probability': 0.05}
     ])
-    item_candidates_default = [item for item in ALL_ITEMS_POOL_FOR_SLOTS if item['floorPrice'] <= 5.0 and not item.get('is_ton_prize') and item['name'] not in [p['name'] for p in default_slot_prizes_template if not p.get('is_ton_prize')]]
+    item_candidates_default = [item for item in build_slot_items_pool(all_floor_prices) if item['floorPrice'] <= DEFAULT_SLOT_MAX_ITEM_PRICE and not item.get('is_ton_prize') and item['name'] not in [p['name'] for p in default_slot_prizes_template if not p.get('is_ton_prize')]]
     for item in item_candidates_default:
         default_slot_prizes_template.append({
             'name': item['name'],
@@ -1697,19 +2401,20 @@ def finalize_slot_prize_pools():
             'probability': 0.01
         })
     if len(default_slot_prizes_template) < 10:
-        default_slot_prizes_template.append({'name':'Desk Calendar', 'floorPrice':UPDATED_FLOOR_PRICES['Desk Calendar'], 'probability':0.001})
+        default_slot_prizes_template.append({'name':'Desk Calendar', 'floorPrice':all_floor_prices['Desk Calendar'], 'probability':0.001})
 
     default_slot_data = { 'id': 'default_slot', 'name': 'Default Slot', 'priceTON': 3.0, 'reels_config': 3, 'prize_pool': default_slot_prizes_template }
-    default_slot_data['prize_pool'] = calculate_rtp_probabilities_for_slots(default_slot_data, UPDATED_FLOOR_PRICES)
-    updated_slots_data_backend.append(default_slot_data)
+    default_slot_data['prize_pool'] = calculate_rtp_probabilities_for_slots(default_slot_data, all_floor_prices)
+    return default_slot_data
 
+def build_premium_slot(all_floor_prices):
     premium_slot_prizes_template = []
     premium_slot_prizes_template.extend([
         {'name': "2 TON", 'value': 2.0, 'is_ton_prize': True, 'probability': 0.08},
         {'name': "3 TON", 'value': 3.0, 'is_ton_prize': True, 'probability': 0.05},
         {'name': "5 TON", 'value': 5.0, 'is_ton_prize': True, 'probability': 0.03}
     ])
-    item_candidates_premium = [item for item in ALL_ITEMS_POOL_FOR_SLOTS if item['floorPrice'] > 5.0 and not item.get('is_ton_prize') and item['name'] not in [p['name'] for p in premium_slot_prizes_template if not p.get('is_ton_prize')]]
+    item_candidates_premium = [item for item in build_slot_items_pool(all_floor_prices) if item['floorPrice'] > DEFAULT_SLOT_MAX_ITEM_PRICE and not item.get('is_ton_prize') and item['name'] not in [p['name'] for p in premium_slot_prizes_template if not p.get('is_ton_prize')]]
     for item in item_candidates_premium:
         premium_slot_prizes_template.append({
             'name': item['name'],
@@ -1720,14 +2425,295 @@ def finalize_slot_prize_pools():
         })
 
     premium_slot_data = { 'id': 'premium_slot', 'name': 'Premium Slot', 'priceTON': 10.0, 'reels_config': 3, 'prize_pool': premium_slot_prizes_template }
-    premium_slot_data['prize_pool'] = calculate_rtp_probabilities_for_slots(premium_slot_data, UPDATED_FLOOR_PRICES)
-    updated_slots_data_backend.append(premium_slot_data)
+    premium_slot_data['prize_pool'] = calculate_rtp_probabilities_for_slots(premium_slot_data, all_floor_prices)
+    return premium_slot_data
 
-    slots_data_backend = updated_slots_data_backend
+# slot_id -> (builder, predicate telling whether an item at a given floor price belongs to that slot's pool)
+SLOT_BUILDERS = {
+    'default_slot': (build_default_slot, lambda floor_price: floor_price <= DEFAULT_SLOT_MAX_ITEM_PRICE),
+    'premium_slot': (build_premium_slot, lambda floor_price: floor_price > DEFAULT_SLOT_MAX_ITEM_PRICE),
+}
+
+slots_data_backend = []
+
+def finalize_slot_prize_pools():
+    global slots_data_backend
+    slots_data_backend = [builder(UPDATED_FLOOR_PRICES) for builder, _ in SLOT_BUILDERS.values()]
 
 finalize_slot_prize_pools()
 
 
+# --- Hot-Reloadable Game Catalog ---
+# Floor prices live in the `nfts` table; UPDATED_FLOOR_PRICES only seeds it. Every worker
+# polls the table and, when prices change, rebuilds only the cases and slots containing a
+# changed item. Routes read one GameCatalog snapshot per request, so an in-flight open
+# always finishes on a consistent version even if a reload swaps in a new one meanwhile.
+FLOOR_PRICE_RELOAD_INTERVAL_SECONDS = int(os.environ.get("FLOOR_PRICE_RELOAD_INTERVAL_SECONDS", 60))
+
+# Upgrade chance is a pure function of X = target price / item price, so it is tabulated once
+# on a fixed X grid; X is rounded up to the grid (never in the player's favour by more than
+# one step) and everything past the UPGRADE_MIN_CHANCE clamp shares the last entry.
+UPGRADE_MIN_X = Decimal('1.01')
+UPGRADE_CHANCE_STEP = Decimal('0.01')
+
+def _build_upgrade_chance_table() -> tuple:
+    chances = []
+    x = UPGRADE_MIN_X
+    while True:
+        chance = min(UPGRADE_MAX_CHANCE, max(UPGRADE_MIN_CHANCE, UPGRADE_MAX_CHANCE * (UPGRADE_RISK_FACTOR ** (x - Decimal('1')))))
+        chances.append(chance)
+        if chance <= UPGRADE_MIN_CHANCE:
+            return tuple(chances)
+        x += UPGRADE_CHANCE_STEP
+
+UPGRADE_CHANCE_TABLE = _build_upgrade_chance_table()
+
+def upgrade_chance_for_x(x: Decimal) -> Decimal:
+    """Success chance in % for an upgrade to a target worth `x` times the item."""
+    step = ((max(x, UPGRADE_MIN_X) - UPGRADE_MIN_X) / UPGRADE_CHANCE_STEP).to_integral_value(rounding=ROUND_CEILING)
+    return UPGRADE_CHANCE_TABLE[int(step)] if step < len(UPGRADE_CHANCE_TABLE) else UPGRADE_MIN_CHANCE
+
+class UpgradeTargetIndex:
+    """Upgradable NFTs sorted by floor price, for bisect range queries by item value."""
+    __slots__ = ('prices', 'names', 'by_name')
+
+    def __init__(self, floor_prices: dict, nft_ids: dict):
+        entries = sorted((Decimal(str(price)), name) for name, price in floor_prices.items() if price and price > 0)
+        self.prices = [price for price, _ in entries]
+        self.names = [name for _, name in entries]
+        self.by_name = {name: (price, nft_ids.get(name)) for price, name in entries}
+
+    def lookup(self, name: str) -> tuple | None:
+        """(floor price, nft id) of a target, or None if it is not upgradable."""
+        return self.by_name.get(name)
+
+    def targets_above(self, value: Decimal, min_chance: Decimal = UPGRADE_MIN_CHANCE, limit: int = 50) -> list:
+        """(name, price, x, chance) for targets priced above `value`, cheapest first, down to min_chance."""
+        start = bisect.bisect_right(self.prices, value)
+        targets = []
+        for idx in range(start, len(self.prices)):
+            x = self.prices[idx] / value
+            chance = upgrade_chance_for_x(x)
+            if chance < min_chance or len(targets) >= limit:
+                break
+            targets.append((self.names[idx], self.prices[idx], x, chance))
+        return targets
+
+class GameCatalog:
+    """Immutable snapshot of floor prices, RTP-adjusted case/slot tables and the upgrade target index."""
+    __slots__ = ('version', 'floor_prices', 'cases', 'slots', 'nft_ids', 'upgrade_targets')
+
+    def __init__(self, version: int, floor_prices: dict, cases: dict, slots: dict, nft_ids: dict | None = None):
+        self.version = version
+        self.floor_prices = floor_prices
+        self.cases = cases
+        self.slots = slots
+        self.nft_ids = nft_ids or {}
+        self.upgrade_targets = UpgradeTargetIndex(floor_prices, self.nft_ids)
+
+_game_catalog = GameCatalog(
+    version=1,
+    floor_prices=dict(UPDATED_FLOOR_PRICES),
+    cases={c['id']: c for c in cases_data_backend},
+    slots={s['id']: s for s in slots_data_backend}
+)
+_catalog_reload_lock = threading.Lock()
+
+def get_game_catalog() -> GameCatalog:
+    return _game_catalog
+
+def _install_game_catalog(catalog: GameCatalog):
+    """Publishes a new catalog. The single reference assignment is the atomic swap point."""
+    global _game_catalog, UPDATED_FLOOR_PRICES, ALL_ITEMS_POOL_FOR_SLOTS, cases_data_backend, slots_data_backend
+    UPDATED_FLOOR_PRICES = catalog.floor_prices
+    ALL_ITEMS_POOL_FOR_SLOTS = build_slot_items_pool(catalog.floor_prices)
+    cases_data_backend = list(catalog.cases.values())
+    slots_data_backend = list(catalog.slots.values())
+    _game_catalog = catalog
+
+def reload_floor_prices() -> dict:
+    """
+    Re-reads floor prices from the nfts table and swaps in a new catalog if any changed
+    (or new NFT rows appeared). Only cases and slots containing a changed item are recomputed.
+    Returns a dict of changed names -> (old_price, new_price).
+    """
+    with _catalog_reload_lock:
+        current = _game_catalog
+        db = SessionLocal()
+        try:
+            rows = db.query(NFT.id, NFT.name, NFT.floor_price).all()
+        finally:
+            db.close()
+
+        changed = {}
+        nft_ids = {nft_name: nft_id for nft_id, nft_name, _ in rows}
+        for _, nft_name, floor_price in rows:
+            if floor_price is None:
+                continue
+            old_price = current.floor_prices.get(nft_name)
+            if old_price != floor_price:
+                changed[nft_name] = (old_price, floor_price)
+        if not changed:
+            if nft_ids != current.nft_ids:
+                _install_game_catalog(GameCatalog(current.version + 1, current.floor_prices, current.cases, current.slots, nft_ids))
+            return {}
+
+        new_floor_prices = dict(current.floor_prices)
+        for nft_name, (_, new_price) in changed.items():
+            new_floor_prices[nft_name] = new_price
+
+        rebuilt_ids = []
+        new_cases = dict(current.cases)
+        for case_template in cases_data_backend_with_fixed_prices_raw:
+            if any(p['name'] in changed for p in case_template['prizes']):
+                rebuilt_case = build_case_from_template(case_template, new_floor_prices)
+                if rebuilt_case:
+                    new_cases[case_template['id']] = rebuilt_case
+                    rebuilt_ids.append(case_template['id'])
+
+        new_slots = dict(current.slots)
+        for slot_id, (builder, accepts_price) in SLOT_BUILDERS.items():
+            if any((old is not None and accepts_price(old)) or accepts_price(new) for old, new in changed.values()):
+                new_slots[slot_id] = builder(new_floor_prices)
+                rebuilt_ids.append(slot_id)
+
+        _install_game_catalog(GameCatalog(current.version + 1, new_floor_prices, new_cases, new_slots, nft_ids))
+        logger.info(f"Floor prices reloaded (catalog v{current.version + 1}): {len(changed)} changed {sorted(changed)}, rebuilt games: {rebuilt_ids}")
+        return changed
+
+def _floor_price_reload_worker():
+    while True:
+        time.sleep(FLOOR_PRICE_RELOAD_INTERVAL_SECONDS)
+        try:
+            reload_floor_prices()
+        except Exception as e:
+            logger.error(f"Periodic floor price reload failed: {e}", exc_info=True)
+
+def start_floor_price_reloader():
+    if FLOOR_PRICE_RELOAD_INTERVAL_SECONDS <= 0:
+        logger.info("Periodic floor price reload disabled.")
+        return
+    threading.Thread(target=_floor_price_reload_worker, name="floor-price-reloader", daemon=True).start()
+
+
+# --- Admin Stats Rollups ---
+# /stats reads stats_totals (one row) and a few stats_daily rows, never the hot tables. One
+# worker at a time (pg advisory lock) refreshes them every STATS_ROLLUP_INTERVAL_SECONDS:
+# whole-table totals are recomputed, while daily activity is folded in incrementally from
+# game_events. The daily fold only goes up to the max(id) seen by the previous run, so a
+# ledger batch that took its ids earlier but committed later is never skipped.
+STATS_ROLLUP_INTERVAL_SECONDS = int(os.environ.get("STATS_ROLLUP_INTERVAL_SECONDS", 300))
+STATS_ROLLUP_LOCK_ID = 724500002
+STATS_ROLLUP_MAX_EVENTS = 200000 # Per run, so a backlog is worked off in bounded transactions
+STATS_ACTIVE_USER_RETENTION_DAYS = 3
+STATS_GAME_TYPES = "('case', 'slot', 'upgrade', 'upgrade_v2')"
+
+def run_stats_rollup() -> bool:
+    """Refreshes the /stats rollups. Returns False if another worker holds the rollup lock."""
+    with engine.begin() as conn:
+        if not conn.execute(text("SELECT pg_try_advisory_xact_lock(:lock_id)"), {"lock_id": STATS_ROLLUP_LOCK_ID}).scalar():
+            return False
+        conn.execute(pg_insert(StatsTotals).values(id=1).on_conflict_do_nothing())
+        last_event_id, event_id_bound = conn.execute(
+            text("SELECT last_event_id, event_id_bound FROM stats_totals WHERE id = 1 FOR UPDATE")
+        ).one()
+        upto = min(event_id_bound, last_event_id + STATS_ROLLUP_MAX_EVENTS)
+        if upto > last_event_id:
+            window = {"after": last_event_id, "upto": upto}
+            conn.execute(text(f"""
+                INSERT INTO stats_daily (day, games_played, games_cost_nano, games_value_nano, deposits_count, deposits_nano, withdrawals_count)
+                SELECT (created_at AT TIME ZONE 'UTC')::date,
+                       count(*) FILTER (WHERE game_type IN {STATS_GAME_TYPES}),
+                       coalesce(sum(cost_nano) FILTER (WHERE game_type IN {STATS_GAME_TYPES}), 0),
+                       coalesce(sum(value_nano) FILTER (WHERE game_type IN {STATS_GAME_TYPES}), 0),
+                       count(*) FILTER (WHERE game_type = 'deposit'),
+                       coalesce(sum(value_nano) FILTER (WHERE game_type = 'deposit'), 0),
+                       count(*) FILTER (WHERE game_type = 'withdrawal')
+                FROM game_events WHERE id > :after AND id <= :upto
+                GROUP BY 1
+                ON CONFLICT (day) DO UPDATE SET
+                    games_played = stats_daily.games_played + EXCLUDED.games_played,
+                    games_cost_nano = stats_daily.games_cost_nano + EXCLUDED.games_cost_nano,
+                    games_value_nano = stats_daily.games_value_nano + EXCLUDED.games_value_nano,
+                    deposits_count = stats_daily.deposits_count + EXCLUDED.deposits_count,
+                    deposits_nano = stats_daily.deposits_nano + EXCLUDED.deposits_nano,
+                    withdrawals_count = stats_daily.withdrawals_count + EXCLUDED.withdrawals_count
+            """), window)
+            # Only users not yet seen that day are inserted, and only those are counted
+            conn.execute(text("""
+                WITH first_seen AS (
+                    INSERT INTO stats_daily_users (day, user_id)
+                    SELECT DISTINCT (created_at AT TIME ZONE 'UTC')::date, user_id FROM game_events WHERE id > :after AND id <= :upto
+                    ON CONFLICT DO NOTHING
+                    RETURNING day
+                )
+                INSERT INTO stats_daily (day, active_users)
+                SELECT day, count(*) FROM first_seen GROUP BY day
+                ON CONFLICT (day) DO UPDATE SET active_users = stats_daily.active_users + EXCLUDED.active_users
+            """), window)
+            conn.execute(text("DELETE FROM stats_daily_users WHERE day < (now() AT TIME ZONE 'UTC')::date - :days"),
+                         {"days": STATS_ACTIVE_USER_RETENTION_DAYS})
+        conn.execute(text("""
+            UPDATE stats_totals SET
+                users = u.users, balances_nano = u.balances_nano,
+                inventory_items = i.items, inventory_value = i.value,
+                pending_deposits = (SELECT count(*) FROM pending_deposits WHERE status = 'pending'),
+                last_event_id = :upto,
+                event_id_bound = (SELECT coalesce(max(id), 0) FROM game_events),
+                refreshed_at = now()
+            FROM (SELECT count(*) AS users, coalesce(sum(ton_balance), 0) AS balances_nano FROM users) u,
+                 (SELECT count(*) AS items, coalesce(sum(current_value), 0) AS value FROM inventory_items WHERE NOT is_ton_prize) i
+            WHERE stats_totals.id = 1
+        """), {"upto": max(upto, last_event_id)})
+    return True
+
+def _stats_rollup_worker():
+    while True:
+        try:
+            run_stats_rollup()
+        except Exception as e:
+            logger.error(f"Stats rollup failed: {e}", exc_info=True)
+        time.sleep(STATS_ROLLUP_INTERVAL_SECONDS)
+
+def start_stats_rollup_job():
+    if STATS_ROLLUP_INTERVAL_SECONDS <= 0:
+        logger.info("Stats rollup job disabled.")
+        return
+    threading.Thread(target=_stats_rollup_worker, name="stats-rollup", daemon=True).start()
+
+def format_admin_stats(db) -> str:
+    """The /stats message, built from the rollup tables only."""
+    totals = db.query(StatsTotals).filter(StatsTotals.id == 1).first()
+    if not totals or not totals.refreshed_at:
+        return "Stats are not computed yet. They refresh every few minutes."
+    today = dt.now(timezone.utc).date()
+    days = {row.day: row for row in db.query(StatsDaily).filter(StatsDaily.day > today - timedelta(days=7)).all()}
+    week = list(days.values())
+
+    def day_line(label, row):
+        if not row:
+            return f"{label}: no activity"
+        return (f"{label}: {row.games_played} games, {nano_to_ton(row.games_cost_nano):.2f} TON in, {nano_to_ton(row.games_value_nano):.2f} TON out, "
+                f"{row.active_users} active, {row.deposits_count} deposits ({nano_to_ton(row.deposits_nano):.2f} TON), {row.withdrawals_count} withdrawals")
+
+    week_cost = sum(r.games_cost_nano for r in week)
+    week_value = sum(r.games_value_nano for r in week)
+    return "\n".join([
+        "📊 Stats",
+        f"Users: {totals.users}",
+        f"Balances held: {nano_to_ton(totals.balances_nano):.2f} TON",
+        f"Inventory liability: {totals.inventory_items} items, {totals.inventory_value:.2f} TON",
+        f"Pending deposits: {totals.pending_deposits}",
+        "",
+        day_line("Today", days.get(today)),
+        day_line("Yesterday", days.get(today - timedelta(days=1))),
+        f"7 days: {sum(r.games_played for r in week)} games, realized RTP {week_value / week_cost:.1%}, "
+        f"{nano_to_ton(sum(r.deposits_nano for r in week)):.2f} TON deposited" if week_cost else "7 days: no games",
+        "",
+        f"Refreshed {totals.refreshed_at.astimezone(timezone.utc):%Y-%m-%d %H:%M} UTC",
+    ])
+
+
 def calculate_and_log_rtp():
     logger.info("--- RTP Calculations (Based on Current Fixed Prices & Probabilities) ---")
     overall_total_ev_weighted_by_price = Decimal('0')
@@ -1775,26 +2761,76 @@ def calculate_and_log_rtp():
 
 # --- Initial Data Population and Setup ---
 def populate_initial_data():
+    """
+    Upserts every known NFT in a single INSERT ... ON CONFLICT statement.
+    UPDATED_FLOOR_PRICES only seeds floor prices for new rows; existing rows keep the
+    price stored in the table (see reload_floor_prices) and only get their image refreshed.
+    Rows whose image is already current are left untouched.
+    """
+    nft_rows = [
+        {'name': nft_name, 'image_filename': generate_image_filename_from_name(nft_name), 'floor_price': floor_price}
+        for nft_name, floor_price in UPDATED_FLOOR_PRICES.items()
+    ]
+    if not nft_rows:
+        return
+
     db = SessionLocal()
     try:
-        for nft_name, floor_price in UPDATED_FLOOR_PRICES.items():
-            nft_exists = db.query(NFT).filter(NFT.name == nft_name).first()
-            img_filename_or_url = generate_image_filename_from_name(nft_name)
-            
-            if not nft_exists:
-                db.add(NFT(name=nft_name, image_filename=img_filename_or_url, floor_price=floor_price))
-            elif nft_exists.floor_price != floor_price or nft_exists.image_filename != img_filename_or_url:
-                nft_exists.floor_price = floor_price
-                nft_exists.image_filename = img_filename_or_url
+        insert_stmt = pg_insert(NFT).values(nft_rows)
+        upsert_stmt = insert_stmt.on_conflict_do_update(
+            index_elements=[NFT.name],
+            set_={'image_filename': insert_stmt.excluded.image_filename},
+            where=NFT.image_filename.is_distinct_from(insert_stmt.excluded.image_filename)
+        )
+        result = db.execute(upsert_stmt)
         db.commit()
+        logger.info(f"NFT catalog upsert complete: {result.rowcount} of {len(nft_rows)} rows inserted or changed.")
     except Exception as e:
         db.rollback()
         logger.error(f"Error populating initial NFT data: {e}", exc_info=True)
     finally:
         db.close()
 
+INVENTORY_IMAGE_URL_MIGRATION = "inventory_image_urls"
+
+def backfill_inventory_image_urls(batch_size: int = 1000):
+    """
+    One-shot migration: writes the image URL onto inventory rows created before it was always stored at insert time.
+    A schema_migrations marker commits with the backfill, so later boots skip it without scanning inventory_items.
+    """
+    with engine.begin() as conn:
+        conn.execute(text("SELECT pg_advisory_xact_lock(:lock_id)"), {"lock_id": SCHEMA_MIGRATION_LOCK_ID})
+        if conn.execute(text("SELECT 1 FROM schema_migrations WHERE name = :name"), {"name": INVENTORY_IMAGE_URL_MIGRATION}).first():
+            return
+        conn.execute(text(
+            "UPDATE inventory_items AS i SET item_image_override = n.image_filename "
+            "FROM nfts AS n WHERE i.nft_id = n.id AND i.item_image_override IS NULL AND n.image_filename IS NOT NULL"
+        ))
+        while True:
+            rows = conn.execute(text(
+                "SELECT i.id, COALESCE(i.item_name_override, n.name) AS name FROM inventory_items AS i "
+                "LEFT JOIN nfts AS n ON n.id = i.nft_id WHERE i.item_image_override IS NULL ORDER BY i.id LIMIT :limit"
+            ), {"limit": batch_size}).all()
+            if not rows:
+                break
+            conn.execute(
+                InventoryItem.__table__.update().where(InventoryItem.__table__.c.id == bindparam('row_id')).values(item_image_override=bindparam('image_url')),
+                [{'row_id': row.id, 'image_url': generate_image_filename_from_name(row.name)} for row in rows]
+            )
+            logger.info(f"Backfilled image URLs on {len(rows)} inventory rows.")
+        conn.execute(text("INSERT INTO schema_migrations (name) VALUES (:name)"), {"name": INVENTORY_IMAGE_URL_MIGRATION})
+        logger.info("Inventory image URL backfill complete; marked as applied.")
+
 def initial_setup_and_logging():
     populate_initial_data()
+    try:
+        backfill_inventory_image_urls()
+    except Exception as e:
+        logger.error(f"Error backfilling inventory image URLs: {e}", exc_info=True)
+    try:
+        reload_floor_prices() # The nfts table is the source of truth for floor prices
+    except Exception as e:
+        logger.error(f"Error loading floor prices from the database, using built-in defaults: {e}", exc_info=True)
     db = SessionLocal()
     try:
         if not db.query(PromoCode).filter(PromoCode.code_text == 'Grachev').first():
@@ -1811,7 +2847,10 @@ def initial_setup_and_logging():
     
     calculate_and_log_rtp()
 
-initial_setup_and_logging()
+if not SKIP_STARTUP_TASKS:
+    initial_setup_and_logging()
+    start_floor_price_reloader()
+    start_stats_rollup_job()
 
 
 # --- Flask App Setup ---
@@ -1821,11 +2860,223 @@ NULL_ORIGIN = "null"
 LOCAL_DEV_ORIGINS = ["http://localhost:5500","http://127.0.0.1:5500","http://localhost:8000","http://127.0.0.1:8000",]
 final_allowed_origins = list(set([PROD_ORIGIN, NULL_ORIGIN] + LOCAL_DEV_ORIGINS))
 CORS(app, resources={r"/api/*": {"origins": final_allowed_origins}})
-if BOT_TOKEN:
+if SKIP_STARTUP_TASKS:
+    pass
+elif BOT_TOKEN:
     setup_telegram_webhook(app)
 else:
     logger.error("Cannot setup Telegram webhook because BOT_TOKEN is missing.")
 
+# --- JSON Encoding & Request Schemas ---
+# jsonify() and get_json() go through this provider, so with orjson installed every response is
+# encoded straight to bytes and every body decoded in one call. Without orjson it behaves exactly
+# like Flask's default provider. Game and money routes decode their bodies into the typed request
+# schemas below, which validate and coerce while decoding; large JSON responses (inventory,
+# leaderboard) are gzipped on the way out.
+JSON_GZIP_MIN_BYTES = int(os.environ.get("JSON_GZIP_MIN_BYTES", "2048"))
+JSON_GZIP_LEVEL = 5 # Past ~5 the size gain is small and the CPU cost is not
+ORJSON_OPTIONS = (orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME) if orjson else 0
+
+class FastJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson when it is installed."""
+    def dumps(self, obj, **kwargs):
+        if orjson is None or kwargs:
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default, option=ORJSON_OPTIONS).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        if orjson is None or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        if orjson is None:
+            return super().response(*args, **kwargs)
+        if args and kwargs:
+            raise TypeError("jsonify() behavior undefined when passed both args and kwargs")
+        obj = args[0] if len(args) == 1 else (args or kwargs or None)
+        # Datetimes keep Flask's HTTP-date format via self.default; dataclasses are encoded natively
+        return self._app.response_class(orjson.dumps(obj, default=self.default, option=ORJSON_OPTIONS), mimetype=self.mimetype)
+
+app.json = FastJSONProvider(app)
+
+class RequestValidationError(ValueError):
+    """A request body that is not valid JSON or does not match its schema."""
+
+def _coerce_int(value):
+    if isinstance(value, bool):
+        raise TypeError
+    if isinstance(value, float) and not value.is_integer():
+        raise ValueError
+    return int(value)
+
+def _coerce_float(value):
+    if isinstance(value, bool):
+        raise TypeError
+    result = float(value)
+    if not math.isfinite(result):
+        raise ValueError
+    return result
+
+def _coerce_decimal(value):
+    if isinstance(value, bool):
+        raise TypeError
+    result = Decimal(str(value))
+    if not result.is_finite():
+        raise ValueError
+    return result
+
+def _coerce_str(value):
+    if not isinstance(value, str):
+        raise TypeError
+    return value.strip()
+
+def _coerce_dict(value):
+    if not isinstance(value, dict):
+        raise TypeError
+    return value
+
+def _coerce_list(value):
+    if not isinstance(value, list):
+        raise TypeError
+    return value
+
+SCHEMA_COERCERS = {int: _coerce_int, float: _coerce_float, Decimal: _coerce_decimal, str: _coerce_str, dict: _coerce_dict, list: _coerce_list}
+
+@functools.lru_cache(maxsize=None)
+def _schema_fields(schema) -> tuple:
+    """(name, coerce, required, default) per field of a request schema dataclass."""
+    specs = []
+    for f in dataclasses.fields(schema):
+        required = f.default is dataclasses.MISSING and f.default_factory is dataclasses.MISSING
+        default = f.default if f.default is not dataclasses.MISSING else None
+        specs.append((f.name, SCHEMA_COERCERS[f.type.__args__[0] if isinstance(f.type, UnionType) else f.type], required, default))
+    return tuple(specs)
+
+def parse_request_body(schema):
+    """Decodes the JSON body straight into `schema`, raising RequestValidationError on any mismatch."""
+    raw = flask_request.get_data()
+    try:
+        data = orjson.loads(raw) if orjson else json.loads(raw or b'null')
+    except ValueError:
+        raise RequestValidationError("Request body must be valid JSON.")
+    return decode_schema(schema, data)
+
+def decode_schema(schema, data):
+    """Builds `schema` from an already-decoded JSON object (also used for nested objects)."""
+    if not isinstance(data, dict):
+        raise RequestValidationError("Request body must be a JSON object.")
+    values = {}
+    for name, coerce, required, default in _schema_fields(schema):
+        value = data.get(name)
+        if value is None or value == "":
+            if required:
+                raise RequestValidationError(f"{name} required.")
+            values[name] = default
+            continue
+        try:
+            values[name] = coerce(value)
+        except (TypeError, ValueError, ArithmeticError):
+            raise RequestValidationError(f"Invalid {name} format.")
+        if required and values[name] == "":
+            raise RequestValidationError(f"{name} required.")
+    return schema(**values)
+
+@app.errorhandler(RequestValidationError)
+def handle_request_validation_error(e):
+    return jsonify({"error": str(e)}), 400
+
+@dataclasses.dataclass(slots=True, frozen=True)
+class OpenCaseRequest:
+    case_id: str
+    multiplier: int = 1
+
+@dataclasses.dataclass(slots=True, frozen=True)
+class SpinSlotRequest:
+    slot_id: str
+
+@dataclasses.dataclass(slots=True, frozen=True)
+class UpgradeItemRequest:
+    inventory_item_id: int
+    multiplier_str: Decimal
+
+@dataclasses.dataclass(slots=True, frozen=True)
+class UpgradeItemV2Request:
+    inventory_item_id: int
+    desired_item_name: str
+
+@dataclasses.dataclass(slots=True, frozen=True)
+class BatchUpgradeEntry:
+    """One item of a batch upgrade: either a target NFT (v2 rules) or a value multiplier (v1 rules)."""
+    inventory_item_id: int
+    desired_item_name: str | None = None
+    multiplier_str: Decimal | None = None
+
+@dataclasses.dataclass(slots=True, frozen=True)
+class BatchUpgradeRequest:
+    upgrades: list
+
+@dataclasses.dataclass(slots=True, frozen=True)
+class FairnessRotateRequest:
+    client_seed: str
+
+@dataclasses.dataclass(slots=True, frozen=True)
+class InventoryItemRequest:
+    inventory_item_id: int
+
+@dataclasses.dataclass(slots=True, frozen=True)
+class InitiateDepositRequest:
+    amount: float
+
+@dataclasses.dataclass(slots=True, frozen=True)
+class VerifyDepositRequest:
+    pending_deposit_id: int
+
+@dataclasses.dataclass(slots=True, frozen=True)
+class RedeemPromocodeRequest:
+    promocode_text: str
+
+@dataclasses.dataclass(slots=True, frozen=True)
+class TonnelWithdrawalRequest:
+    chosen_tonnel_gift_details: dict
+
+# Response schemas: field names are the JSON keys the Mini App reads
+@dataclasses.dataclass(slots=True)
+class InventoryItemOut:
+    id: int
+    name: str
+    imageFilename: str
+    imageVariants: dict | None
+    floorPrice: float
+    currentValue: float
+    upgradeMultiplier: float
+    variant: str | None
+    is_ton_prize: bool
+    obtained_at: str | None
+
+@dataclasses.dataclass(slots=True)
+class LeaderboardEntryOut:
+    rank: int
+    name: str
+    avatarChar: str
+    income: float
+    user_id: int
+
+@app.after_request
+def compress_json_response(response):
+    """Gzips large JSON bodies for clients that accept it. Runs after @idempotent stored the plain body."""
+    if (response.status_code != 200 or response.mimetype != 'application/json' or response.direct_passthrough
+            or 'Content-Encoding' in response.headers or 'ETag' in response.headers
+            or flask_request.accept_encodings['gzip'] <= 0):
+        return response
+    body = response.get_data()
+    if len(body) < JSON_GZIP_MIN_BYTES:
+        return response
+    response.set_data(gzip.compress(body, compresslevel=JSON_GZIP_LEVEL))
+    response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
+
 # --- Database Session Helper ---
 def get_db():
     db = SessionLocal()
@@ -1835,9 +3086,259 @@ def get_db():
         db.close()
 
 
+# --- Idempotency Keys ---
+# Clients retry game and money requests on flaky networks. A request carrying an
+# Idempotency-Key header runs at most once within the TTL; retries get the stored
+# response back without touching the database, and duplicates arriving while the first
+# is still running wait for it instead of queueing on the user row lock. With REDIS_URL
+# set the key is claimed in Redis (SET NX PX), so a retry routed to another worker is
+# caught too; without it, or while Redis is unreachable, each worker keeps its own store.
+IDEMPOTENCY_KEY_HEADER = "Idempotency-Key"
+IDEMPOTENCY_KEY_MAX_LENGTH = 128
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get("IDEMPOTENCY_TTL_SECONDS", 600))
+IDEMPOTENCY_MAX_ENTRIES = int(os.environ.get("IDEMPOTENCY_MAX_ENTRIES", 50000))
+IDEMPOTENCY_WAIT_SECONDS = 30 # How long a duplicate waits for the original request to finish
+IDEMPOTENCY_UNCACHED_STATUSES = (401, 409, 429) # Transient outcomes a retry should re-run (5xx are never stored)
+IDEMPOTENCY_REDIS_POLL_SECONDS = 0.05 # How often a duplicate re-reads a key claimed in Redis
+IDEMPOTENCY_REDIS_RETRY_SECONDS = 10 # After a Redis error, use the in-process store this long before probing Redis again
+IDEMPOTENCY_REDIS_PREFIX = "idem:"
+
+class IdempotencyStore:
+    """
+    Bounded in-process map of idempotency key -> stored response with TTL eviction.
+    Keys are claimed by the first request, then completed with its response or released on failure.
+    """
+    class Entry:
+        __slots__ = ('fingerprint', 'expires_at', 'done', 'status', 'body', 'mimetype')
+
+        def __init__(self, fingerprint: bytes, expires_at: float):
+            self.fingerprint = fingerprint
+            self.expires_at = expires_at
+            self.done = threading.Event()
+            self.status = None
+            self.body = None
+            self.mimetype = None
+
+    def __init__(self, ttl_seconds: int, max_entries: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _evict_locked(self, now: float):
+        # In-flight entries are never evicted for space (a duplicate would become a second owner);
+        # they are moved behind the completed ones and only dropped once their claim expires.
+        skipped_in_flight = 0
+        while self._entries and skipped_in_flight < len(self._entries):
+            oldest_key, oldest_entry = next(iter(self._entries.items()))
+            if oldest_entry.expires_at > now:
+                if len(self._entries) < self.max_entries:
+                    break
+                if not oldest_entry.done.is_set():
+                    self._entries.move_to_end(oldest_key)
+                    skipped_in_flight += 1
+                    continue
+            del self._entries[oldest_key]
+
+    def wait(self, key: bytes, entry: "IdempotencyStore.Entry", timeout: float) -> bool:
+        """Waits for the owner to complete or release the entry. False on timeout."""
+        return entry.done.wait(timeout)
+
+    def begin(self, key: bytes, fingerprint: bytes):
+        """Returns (entry, is_owner). The owner must call complete() or release()."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires_at > now:
+                return entry, False
+            self._evict_locked(now)
+            entry = IdempotencyStore.Entry(fingerprint, now + IDEMPOTENCY_WAIT_SECONDS * 2)
+            self._entries[key] = entry
+            return entry, True
+
+    def complete(self, key: bytes, entry: "IdempotencyStore.Entry", status: int, body: bytes, mimetype: str):
+        entry.status, entry.body, entry.mimetype = status, body, mimetype
+        with self._lock:
+            entry.expires_at = time.monotonic() + self.ttl_seconds
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+        entry.done.set()
+
+    def release(self, key: bytes, entry: "IdempotencyStore.Entry"):
+        with self._lock:
+            if self._entries.get(key) is entry:
+                del self._entries[key]
+        entry.done.set()
+
+class RedisIdempotencyStore:
+    """
+    Idempotency keys shared by all workers. The owner claims a key with SET NX PX holding
+    b"P" + fingerprint + claim token, then overwrites it with b"D" + fingerprint + the response.
+    begin() raises redis.RedisError so the caller can fall back to the in-process store.
+    """
+    RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+    RESPONSE_HEADER = struct.Struct("!HB") # status, mimetype length
+
+    class Entry:
+        __slots__ = ('fingerprint', 'claim', 'status', 'body', 'mimetype')
+
+        def __init__(self, fingerprint: bytes, claim: bytes | None):
+            self.fingerprint = fingerprint
+            self.claim = claim
+            self.status = None
+            self.body = None
+            self.mimetype = None
+
+    def __init__(self, redis_url: str, ttl_seconds: int):
+        self.ttl_seconds = ttl_seconds
+        self._client = redis.Redis.from_url(redis_url, socket_timeout=0.2, socket_connect_timeout=0.2)
+        self._release_script = self._client.register_script(self.RELEASE_SCRIPT)
+        self._down_until = 0.0
+
+    def available(self) -> bool:
+        return time.monotonic() >= self._down_until
+
+    def trip(self, error: Exception):
+        self._down_until = time.monotonic() + IDEMPOTENCY_REDIS_RETRY_SECONDS
+        logger.warning(f"Redis idempotency store unavailable, using the in-process store for {IDEMPOTENCY_REDIS_RETRY_SECONDS}s: {error}")
+
+    def _parse(self, value: bytes | None):
+        """Entry for a stored value (None when the key is free)."""
+        if value is None:
+            return None
+        fingerprint = value[1:17]
+        if value[:1] == b"P":
+            return RedisIdempotencyStore.Entry(fingerprint, value)
+        entry = RedisIdempotencyStore.Entry(fingerprint, None)
+        entry.status, mimetype_length = self.RESPONSE_HEADER.unpack_from(value, 17)
+        body_start = 17 + self.RESPONSE_HEADER.size + mimetype_length
+        entry.mimetype = value[17 + self.RESPONSE_HEADER.size:body_start].decode('ascii')
+        entry.body = value[body_start:]
+        return entry
+
+    def begin(self, key: bytes, fingerprint: bytes):
+        """Returns (entry, is_owner). The owner must call complete() or release()."""
+        redis_key = IDEMPOTENCY_REDIS_PREFIX + key.hex()
+        claim = b"P" + fingerprint + secrets.token_bytes(8)
+        while True:
+            if self._client.set(redis_key, claim, nx=True, px=IDEMPOTENCY_WAIT_SECONDS * 2 * 1000):
+                return RedisIdempotencyStore.Entry(fingerprint, claim), True
+            entry = self._parse(self._client.get(redis_key))
+            if entry is not None:
+                return entry, False
+            # Released or expired between SET and GET; try to claim again
+
+    def wait(self, key: bytes, entry: "RedisIdempotencyStore.Entry", timeout: float) -> bool:
+        """Polls until the claim in `entry` is completed or released. False on timeout or Redis error."""
+        if entry.status is not None:
+            return True
+        redis_key = IDEMPOTENCY_REDIS_PREFIX + key.hex()
+        deadline = time.monotonic() + timeout
+        try:
+            while time.monotonic() < deadline:
+                value = self._client.get(redis_key)
+                if value != entry.claim:
+                    current = self._parse(value)
+                    if current is not None and current.status is not None:
+                        entry.status, entry.body, entry.mimetype = current.status, current.body, current.mimetype
+                    return True
+                time.sleep(IDEMPOTENCY_REDIS_POLL_SECONDS)
+        except redis.RedisError as e:
+            self.trip(e)
+        return False
+
+    def complete(self, key: bytes, entry: "RedisIdempotencyStore.Entry", status: int, body: bytes, mimetype: str):
+        mimetype_bytes = (mimetype or '').encode('ascii')
+        value = b"D" + entry.fingerprint + self.RESPONSE_HEADER.pack(status, len(mimetype_bytes)) + mimetype_bytes + body
+        try:
+            self._client.set(IDEMPOTENCY_REDIS_PREFIX + key.hex(), value, px=self.ttl_seconds * 1000)
+        except redis.RedisError as e:
+            self.trip(e)
+
+    def release(self, key: bytes, entry: "RedisIdempotencyStore.Entry"):
+        try:
+            self._release_script(keys=[IDEMPOTENCY_REDIS_PREFIX + key.hex()], args=[entry.claim])
+        except redis.RedisError as e:
+            self.trip(e) # The claim expires on its own after IDEMPOTENCY_WAIT_SECONDS * 2
+
+idempotency_store = IdempotencyStore(IDEMPOTENCY_TTL_SECONDS, IDEMPOTENCY_MAX_ENTRIES)
+redis_idempotency_store = None
+if REDIS_URL and redis is not None:
+    redis_idempotency_store = RedisIdempotencyStore(REDIS_URL, IDEMPOTENCY_TTL_SECONDS)
+
+def claim_idempotency_key(store_key: bytes, fingerprint: bytes):
+    """Returns (store, entry, is_owner), preferring the shared Redis store."""
+    if redis_idempotency_store is not None and redis_idempotency_store.available():
+        try:
+            return (redis_idempotency_store, *redis_idempotency_store.begin(store_key, fingerprint))
+        except redis.RedisError as e:
+            redis_idempotency_store.trip(e)
+    return (idempotency_store, *idempotency_store.begin(store_key, fingerprint))
+
+def idempotent(view_func):
+    """Route decorator: replays the stored response for a repeated Idempotency-Key."""
+    @functools.wraps(view_func)
+    def wrapper(*args, **kwargs):
+        idem_key = flask_request.headers.get(IDEMPOTENCY_KEY_HEADER)
+        if not idem_key:
+            return view_func(*args, **kwargs)
+        if len(idem_key) > IDEMPOTENCY_KEY_MAX_LENGTH or not idem_key.isprintable():
+            return jsonify({"error": "Invalid Idempotency-Key header."}), 400
+
+        # Scoping the key by initData means a stored response is only replayed to the same authenticated session
+        init_data = flask_request.headers.get('X-Telegram-Init-Data') or ''
+        store_key = hashlib.blake2b(f"{flask_request.path}\n{idem_key}\n{init_data}".encode('utf-8'), digest_size=16).digest()
+        fingerprint = hashlib.blake2b(flask_request.get_data(), digest_size=16).digest()
+
+        deadline = time.monotonic() + IDEMPOTENCY_WAIT_SECONDS
+        while True:
+            store, entry, is_owner = claim_idempotency_key(store_key, fingerprint)
+            if is_owner:
+                break
+            if entry.fingerprint != fingerprint:
+                return jsonify({"error": "Idempotency-Key was already used with a different request body."}), 422
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not store.wait(store_key, entry, remaining):
+                return jsonify({"error": "A request with this Idempotency-Key is still being processed."}), 409
+            if entry.status is not None:
+                return Response(entry.body, status=entry.status, mimetype=entry.mimetype, headers={"Idempotent-Replayed": "true"})
+            # The original request failed and released the key; loop to claim it ourselves
+
+        try:
+            response = app.make_response(view_func(*args, **kwargs))
+        except Exception:
+            store.release(store_key, entry)
+            raise
+        if response.status_code < 500 and response.status_code not in IDEMPOTENCY_UNCACHED_STATUSES:
+            store.complete(store_key, entry, response.status_code, response.get_data(), response.mimetype)
+        else:
+            store.release(store_key, entry)
+        return response
+    return wrapper
+
+
 # --- Telegram Mini App InitData Validation ---
 def validate_init_data(init_data_str: str, bot_token_for_validation: str) -> dict | None:
-    logger.debug(f"Attempting to validate initData: {init_data_str[:200]}...")
+    """Validates initData once per request; later calls in the same request reuse the result."""
+    if not has_request_context():
+        return _validate_init_data_uncached(init_data_str, bot_token_for_validation)
+    cached = g.get('_validated_init_data')
+    if cached is not None and cached[0] == init_data_str:
+        return cached[1]
+    auth_result = _validate_init_data_uncached(init_data_str, bot_token_for_validation)
+    g._validated_init_data = (init_data_str, auth_result)
+    return auth_result
+
+def _validate_init_data_uncached(init_data_str: str, bot_token_for_validation: str) -> dict | None:
+    logger.debug("Attempting to validate initData: %.200s...", init_data_str)
     try:
         if not init_data_str:
             logger.warning("validate_init_data: init_data_str is empty or None.")
@@ -1892,12 +3393,12 @@ def validate_init_data(init_data_str: str, bot_token_for_validation: str) -> dic
                 return None
             
             user_info_dict['id'] = int(user_info_dict['id'])
-            logger.info(f"validate_init_data: Hash matched for user ID: {user_info_dict.get('id')}. Auth successful.")
+            auth_logger.info("validate_init_data: Hash matched for user ID: %s. Auth successful.", user_info_dict['id'])
             return user_info_dict
         else:
             logger.warning(f"validate_init_data: Hash mismatch.")
-            logger.debug(f"Received Hash: {hash_received}")
-            logger.debug(f"Calculated Hash: {calculated_hash_hex}")
+            logger.debug("Received Hash: %s", hash_received)
+            logger.debug("Calculated Hash: %s", calculated_hash_hex)
             logger.debug(f"Data Check String: {data_check_string[:500]}")
             logger.debug(f"BOT_TOKEN used for secret_key (first 5 chars): {bot_token_for_validation[:5]}...")
             return None
@@ -1906,12 +3407,1113 @@ def validate_init_data(init_data_str: str, bot_token_for_validation: str) -> dic
         return None
 
 
+# --- Admission Control (token buckets) ---
+# Every hot route checks two token buckets before it opens a DB session: one per Telegram
+# user (or client IP when auth fails) and one shared by all callers of the route. Buckets
+# live in Redis when REDIS_URL is set so limits hold across workers; otherwise, or while
+# Redis is unreachable, each worker falls back to in-process buckets.
+RATE_LIMIT_REDIS_RETRY_SECONDS = 10 # After a Redis error, use in-process buckets this long before probing Redis again
+RATE_LIMIT_IDLE_SECONDS = 300 # In-process buckets untouched this long are dropped (they'd be full anyway)
+RATE_LIMIT_MAX_LOCAL_BUCKETS = 100000
+
+# route: (per-user tokens/s, per-user burst, global tokens/s, global burst)
+RATE_LIMITS = {
+    'get_user_data': (2.0, 10, 500.0, 1000),
+    'open_case': (5.0, 10, 300.0, 600),
+    'spin_slot': (5.0, 10, 300.0, 600),
+    'upgrade_item': (3.0, 6, 200.0, 400),
+    'upgrade_items_batch': (0.5, 2, 40.0, 80),
+    'upgrade_item_v2': (3.0, 6, 200.0, 400),
+    'convert_to_ton': (5.0, 10, 200.0, 400),
+    'sell_all_items': (0.5, 3, 50.0, 100),
+    'initiate_deposit': (0.2, 3, 20.0, 50),
+    'verify_deposit': (0.2, 3, 10.0, 20), # Each call opens a liteserver connection
+    'redeem_promocode': (0.5, 5, 100.0, 300),
+    'tonnel_gift_listings': (0.2, 3, 5.0, 10),
+    'confirm_tonnel_withdrawal': (0.1, 2, 2.0, 5),
+    'fairness_rotate': (0.1, 3, 20.0, 40),
+    'game_history': (1.0, 5, 200.0, 400),
+}
+
+class LocalTokenBuckets:
+    """In-process token buckets, used when Redis is not configured or unavailable."""
+    def __init__(self, max_buckets: int = RATE_LIMIT_MAX_LOCAL_BUCKETS):
+        self.max_buckets = max_buckets
+        self._buckets = {} # key -> (tokens, last_refill_monotonic)
+        self._lock = threading.Lock()
+
+    def take(self, key: str, rate: float, burst: int) -> float:
+        """Takes one token. Returns 0.0 if allowed, otherwise seconds until a token is available."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, last_refill = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - last_refill) * rate)
+            retry_after = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                retry_after = (1 - tokens) / rate
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_buckets:
+                self._buckets = {k: v for k, v in self._buckets.items() if now - v[1] < RATE_LIMIT_IDLE_SECONDS}
+            return retry_after
+
+class RedisTokenBuckets:
+    """Token buckets shared across workers, refilled and consumed atomically in a Lua script."""
+    TAKE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local retry_after = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    retry_after = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+return tostring(retry_after)
+"""
+
+    def __init__(self, redis_url: str):
+        self._client = redis.Redis.from_url(redis_url, socket_timeout=0.05, socket_connect_timeout=0.2)
+        self._take_script = self._client.register_script(self.TAKE_SCRIPT)
+
+    def take(self, key: str, rate: float, burst: int) -> float:
+        return float(self._take_script(keys=[key], args=[rate, burst]))
+
+class RateLimiter:
+    def __init__(self, redis_url: str | None):
+        self.local = LocalTokenBuckets()
+        self.remote = None
+        if redis_url and redis is not None:
+            self.remote = RedisTokenBuckets(redis_url)
+        elif redis_url:
+            logger.warning("REDIS_URL is set but the 'redis' package is not installed. Using in-process rate limiting.")
+        self._remote_down_until = 0.0 # Circuit breaker: monotonic time before which Redis is not tried
+        self._decision_counts = {} # (route, decision) -> count
+        self._decision_counts_lock = threading.Lock()
+
+    def _take(self, key: str, rate: float, burst: int) -> float:
+        # While the breaker is open a dead or blackholed Redis costs nothing; one request probes it per interval
+        if self.remote is not None and time.monotonic() >= self._remote_down_until:
+            try:
+                return self.remote.take(key, rate, burst)
+            except Exception as e:
+                self._remote_down_until = time.monotonic() + RATE_LIMIT_REDIS_RETRY_SECONDS
+                logger.warning(f"Redis rate limiter unavailable, using in-process buckets for {RATE_LIMIT_REDIS_RETRY_SECONDS}s: {e}")
+        return self.local.take(key, rate, burst)
+
+    def check(self, route_name: str, client_key) -> float:
+        """Returns 0.0 if the request is admitted, otherwise the Retry-After delay in seconds."""
+        per_user_rate, per_user_burst, global_rate, global_burst = RATE_LIMITS[route_name]
+        decision = 'allowed'
+        retry_after = self._take(f"rl:{route_name}:c:{client_key}", per_user_rate, per_user_burst)
+        if retry_after > 0:
+            decision = 'rejected_user'
+        else:
+            retry_after = self._take(f"rl:{route_name}:global", global_rate, global_burst)
+            if retry_after > 0:
+                decision = 'rejected_global'
+        with self._decision_counts_lock:
+            counter_key = (route_name, decision)
+            self._decision_counts[counter_key] = self._decision_counts.get(counter_key, 0) + 1
+        return retry_after
+
+    def decision_counts(self) -> dict:
+        with self._decision_counts_lock:
+            return dict(self._decision_counts)
+
+rate_limiter = RateLimiter(REDIS_URL)
+
+def rate_limited(route_name: str):
+    """Route decorator: sheds load with 429 + Retry-After before the route takes a DB connection."""
+    def decorator(view_func):
+        @functools.wraps(view_func)
+        def wrapper(*args, **kwargs):
+            auth = validate_init_data(flask_request.headers.get('X-Telegram-Init-Data'), BOT_TOKEN)
+            client_key = auth["id"] if auth else f"ip:{flask_request.remote_addr}"
+            retry_after = rate_limiter.check(route_name, client_key)
+            if retry_after > 0:
+                response = jsonify({"error": "Too many requests. Please slow down and try again shortly."})
+                response.status_code = 429
+                response.headers["Retry-After"] = str(max(1, math.ceil(retry_after)))
+                return response
+            return view_func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# --- Metrics Endpoint ---
+# /metrics, /debug/sql_profile and /admin/rtp answer only with "Authorization: Bearer $METRICS_TOKEN"
+# and are disabled (404) while METRICS_TOKEN is unset.
+# With REDIS_URL set each worker publishes its exposition every METRICS_PUBLISH_INTERVAL_SECONDS and
+# /metrics returns every live worker's series (each labelled worker="host:pid"), so one scrape through
+# the load balancer sees the whole deployment. Without Redis a scrape returns only the worker that
+# answered it; scrape each worker directly (one target per instance/process) in that setup.
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+METRICS_PUBLISH_INTERVAL_SECONDS = int(os.environ.get("METRICS_PUBLISH_INTERVAL_SECONDS", 15))
+METRICS_REDIS_KEY = "metrics:workers"
+
+def metrics_request_status() -> int | None:
+    """None if the request carries the metrics token, else the status to refuse it with."""
+    if not METRICS_TOKEN:
+        return 404
+    if not hmac.compare_digest(flask_request.headers.get('Authorization', ''), f"Bearer {METRICS_TOKEN}"):
+        return 401
+    return None
+
+class MetricsPublisher:
+    """Shares this worker's exposition through Redis so any worker can serve the whole deployment's metrics."""
+    def __init__(self):
+        self._pid = None
+        self.worker_id = None
+        self._redis = redis.Redis.from_url(REDIS_URL, socket_timeout=0.2, socket_connect_timeout=0.2) if REDIS_URL and redis is not None else None
+
+    def ensure_started(self):
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self.worker_id = f"{socket.gethostname()}:{self._pid}"
+            if self._redis is not None:
+                threading.Thread(target=self._run, name="metrics-publisher", daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                self._redis.hset(METRICS_REDIS_KEY, self.worker_id, json.dumps({"at": time.time(), "text": metrics.render(self.worker_id)}))
+                self._redis.expire(METRICS_REDIS_KEY, 3 * METRICS_PUBLISH_INTERVAL_SECONDS)
+            except redis.RedisError as e:
+                logger.warning(f"Metrics: could not publish this worker's exposition: {e}")
+            time.sleep(METRICS_PUBLISH_INTERVAL_SECONDS)
+
+    def render_cluster(self) -> str:
+        self.ensure_started()
+        texts = [metrics.render(self.worker_id)]
+        if self._redis is not None:
+            try:
+                stale_before = time.time() - 3 * METRICS_PUBLISH_INTERVAL_SECONDS
+                for worker_id, raw in self._redis.hgetall(METRICS_REDIS_KEY).items():
+                    published = json.loads(raw)
+                    if worker_id.decode() != self.worker_id and published["at"] >= stale_before:
+                        texts.append(published["text"])
+            except (redis.RedisError, ValueError) as e:
+                logger.warning(f"Metrics: Redis unavailable, serving this worker only: {e}")
+        return MetricsRegistry.merge_expositions(texts)
+
+metrics_publisher = MetricsPublisher()
+
+@app.before_request
+def start_request_timer():
+    metrics_publisher.ensure_started()
+    g._metrics_request_started = time.perf_counter()
+    if SQL_PROFILING_ENABLED:
+        g._sql_profile = RequestQueryProfile()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop('_metrics_request_started', None)
+    if started is not None and flask_request.path.startswith('/api/'):
+        route = flask_request.url_rule.rule if flask_request.url_rule else 'unmatched'
+        HTTP_REQUESTS_TOTAL.inc(route, flask_request.method, str(response.status_code))
+        HTTP_REQUEST_DURATION.observe(time.perf_counter() - started, route, flask_request.method)
+    profile = g.pop('_sql_profile', None)
+    if profile is not None and profile.query_count:
+        route = flask_request.url_rule.rule if flask_request.url_rule else 'unmatched'
+        repeated = profile.repeated_shapes()
+        sql_profile_report.add(route, profile, repeated)
+        response.headers['X-SQL-Query-Count'] = str(profile.query_count)
+        response.headers['X-SQL-Query-Time-Ms'] = f"{profile.total_seconds * 1000:.2f}"
+        for shape, (count, seconds) in repeated.items():
+            logger.warning(f"Possible N+1 on {flask_request.method} {route}: {count} queries ({seconds * 1000:.1f} ms) of shape: {shape[:300]}")
+    return response
+
+_telegram_http = threading.local()
+
+def _timed_telegram_request(method, url, **kwargs):
+    """telebot CUSTOM_REQUEST_SENDER: sends through a per-thread requests.Session, timed by Bot API method."""
+    session = getattr(_telegram_http, 'session', None)
+    if session is None:
+        session = _telegram_http.session = requests.Session()
+    api_method = url.rsplit('/', 1)[-1]
+    call_started = time.perf_counter()
+    outcome = 'error'
+    try:
+        result = session.request(method, url, **kwargs)
+        outcome = 'ok' if result.status_code < 400 else 'http_error'
+        return result
+    finally:
+        TELEGRAM_API_DURATION.observe(time.perf_counter() - call_started, api_method, outcome)
+
+telebot.apihelper.CUSTOM_REQUEST_SENDER = _timed_telegram_request
+
+metrics.gauge('db_pool_connections_checked_out', 'DB connections currently checked out of the pool.', lambda: engine.pool.checkedout())
+metrics.gauge('db_pool_size', 'Configured DB pool size.', lambda: engine.pool.size())
+metrics.gauge('idempotency_store_entries', 'Idempotency keys currently held in memory.', lambda: len(idempotency_store))
+metrics.gauge('rate_limiter_local_buckets', 'In-process token buckets currently tracked.', lambda: len(rate_limiter.local._buckets))
+metrics.gauge('log_records_dropped_total', 'Log records dropped because the logging queue was full.', lambda: DroppingQueueHandler.dropped_records, metric_type='counter')
+metrics.gauge('game_catalog_version', 'Version of the installed game catalog snapshot.', lambda: get_game_catalog().version)
+metrics.gauge('game_catalog_floor_prices', 'Number of floor prices in the installed game catalog.', lambda: len(get_game_catalog().floor_prices))
+metrics.gauge('rate_limit_decisions_total', 'Admission control decisions by route.',
+              lambda: [((route, decision), count) for (route, decision), count in rate_limiter.decision_counts().items()],
+              label_names=('route', 'decision'), metric_type='counter')
+
+@app.route('/metrics')
+def metrics_route():
+    refused = metrics_request_status()
+    if refused:
+        return Response("Not Found\n" if refused == 404 else "Unauthorized\n", status=refused, mimetype='text/plain')
+    return Response(metrics_publisher.render_cluster(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/debug/sql_profile')
+def sql_profile_route():
+    if not SQL_PROFILING_ENABLED:
+        return jsonify({"error": "SQL profiling is disabled. Set SQL_PROFILING_ENABLED=1."}), 404
+    refused = metrics_request_status()
+    if refused:
+        return jsonify({"error": "Not found" if refused == 404 else "Unauthorized"}), refused
+    return jsonify({"repeat_threshold": SQL_PROFILE_REPEAT_THRESHOLD, "routes": sql_profile_report.snapshot()})
+
+
+# --- Static Assets (built by build_assets.py) ---
+ASSET_BUILD_DIR = os.environ.get("ASSET_BUILD_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "static_build"))
+ASSET_BASE_URL = os.environ.get("ASSET_BASE_URL", f"{API_BASE_URL}/assets").rstrip('/')
+ASSET_SOURCE_URL_PREFIX = "https://raw.githubusercontent.com/Vasiliy-katsyka/case/main/"
+IMMUTABLE_CACHE_SECONDS = 365 * 24 * 3600
+
+def load_asset_manifest() -> tuple[dict, dict]:
+    """Returns (manifest, image_ref -> variant URLs). Both are empty if the build step has not run."""
+    manifest_path = os.path.join(ASSET_BUILD_DIR, "asset_manifest.json")
+    try:
+        with open(manifest_path, encoding='utf-8') as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        logger.warning(f"No asset manifest at {manifest_path}; payloads will reference original image URLs. Run build_assets.py.")
+        return {}, {}
+    except (OSError, json.JSONDecodeError) as e:
+        logger.error(f"Could not read asset manifest {manifest_path}: {e}")
+        return {}, {}
+
+    variants_by_ref = {}
+    for rel_path, entry in manifest.get("assets", {}).items():
+        full, thumb = entry["variants"]["full"], entry["variants"]["thumb"]
+        urls = {"webp": f"{ASSET_BASE_URL}/{full['webp']['path']}", "thumb": f"{ASSET_BASE_URL}/{thumb['webp']['path']}"}
+        if "avif" in full:
+            urls["avif"] = f"{ASSET_BASE_URL}/{full['avif']['path']}"
+        # Payloads refer to these images by repo URL, by repo path, or (gift images and backgrounds) by bare file name
+        variants_by_ref[rel_path] = urls
+        variants_by_ref[ASSET_SOURCE_URL_PREFIX + rel_path] = urls
+        directory, file_name = os.path.split(rel_path)
+        if directory in ("GiftImages", "bgs"):
+            variants_by_ref.setdefault(file_name, urls)
+            variants_by_ref.setdefault(file_name.replace('-', '_'), urls)
+    logger.info(f"Loaded asset manifest with {len(manifest.get('assets', {}))} images.")
+    return manifest, variants_by_ref
+
+asset_manifest, _asset_variants_by_ref = load_asset_manifest()
+ASSET_MANIFEST_BODY = json.dumps(asset_manifest, separators=(',', ':')).encode('utf-8')
+ASSET_MANIFEST_ETAG = hashlib.sha256(ASSET_MANIFEST_BODY).hexdigest()[:16]
+
+def image_variants(image_ref: str | None) -> dict | None:
+    """Optimized variant URLs for an image referenced in a payload, or None if it has none."""
+    return _asset_variants_by_ref.get(image_ref) if image_ref else None
+
+# Gift name -> GiftGifs file stem where the generic "spaces to dashes" rule does not apply
+ANIMATION_STEM_ALIASES = {
+    "Hypno Lollipop": "Hynpo-Lollipop",
+    "Happy Pepe": "Happy-Pepe-Kissed-Frog",
+}
+
+def animation_stem_for_name(name: str) -> str:
+    return ANIMATION_STEM_ALIASES.get(name) or re.sub(r'\s+', '-', name.replace("'", "").strip())
+
+def animation_entries_for_names(names) -> dict:
+    """name -> {url, bytes, frames, firstFrame} for every name that has a built animation."""
+    animations = asset_manifest.get("animations", {})
+    entries = {}
+    for name in names:
+        animation = animations.get(animation_stem_for_name(name))
+        if animation:
+            entries[name] = {
+                "url": f"{ASSET_BASE_URL}/{animation['path']}",
+                "bytes": animation['bytes'],
+                "frames": animation['frames'],
+                "frameRate": animation['frame_rate'],
+                "firstFrame": animation.get('first_frame'),
+            }
+    return entries
+
+@app.route('/assets/<path:filename>')
+def static_asset_route(filename):
+    # File names carry a content hash, so a URL never changes content and can be cached forever
+    if filename.endswith('.tgs'):
+        response = serve_tgs_asset(filename)
+    else:
+        response = send_precompressed(os.path.join(ASSET_BUILD_DIR, "assets"), filename, max_age=IMMUTABLE_CACHE_SECONDS)
+    response.headers['Cache-Control'] = f"public, max-age={IMMUTABLE_CACHE_SECONDS}, immutable"
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    return response
+
+PRECOMPRESSED_ENCODINGS = (('br', '.br'), ('gzip', '.gz')) # Preference order
+
+def send_precompressed(directory: str, filename: str, max_age: int) -> Response:
+    """Sends the .br or .gz sibling written by the build step when the client accepts it, else the file itself."""
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    for encoding, suffix in PRECOMPRESSED_ENCODINGS:
+        if flask_request.accept_encodings[encoding] > 0 and os.path.isfile(os.path.join(directory, filename + suffix)):
+            response = send_from_directory(directory, filename + suffix, mimetype=mimetype, max_age=max_age)
+            if response.status_code in (200, 206):
+                response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_from_directory(directory, filename, mimetype=mimetype, max_age=max_age)
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+@app.route('/webapp')
+def webapp_shell_route():
+    """Built Mini App shell (build_frontend.py). Revalidated on every load; unchanged builds answer 304 via the ETag."""
+    response = send_precompressed(os.path.join(ASSET_BUILD_DIR, "web"), "index.html", max_age=0)
+    response.headers['Cache-Control'] = "no-cache"
+    return response
+
+def serve_tgs_asset(filename: str) -> Response:
+    """.tgs files are gzipped Lottie JSON: sent as-is with Content-Encoding: gzip, or inflated for clients without gzip."""
+    response = send_from_directory(os.path.join(ASSET_BUILD_DIR, "assets"), filename, mimetype='application/json', max_age=IMMUTABLE_CACHE_SECONDS)
+    response.headers['Vary'] = 'Accept-Encoding'
+    if response.status_code == 200 and 'gzip' not in flask_request.accept_encodings:
+        response.direct_passthrough = False
+        response.set_data(gzip.decompress(response.get_data()))
+    elif response.status_code in (200, 206):
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+@app.route('/api/animation_manifest', methods=['GET'])
+def animation_manifest_api():
+    """Animations (and first-frame sprite cells) for one case or slot's prizes, or all of them."""
+    catalog = get_game_catalog()
+    case_id = flask_request.args.get('case_id')
+    slot_id = flask_request.args.get('slot_id')
+    if case_id:
+        game = catalog.cases.get(case_id)
+        prize_names = [p['name'] for p in game['prizes']] if game else None
+    elif slot_id:
+        game = catalog.slots.get(slot_id)
+        prize_names = [p['name'] for p in game['prize_pool'] if not p.get('is_ton_prize')] if game else None
+    else:
+        prize_names = list(catalog.floor_prices)
+    if prize_names is None:
+        return jsonify({"error": "Game not found"}), 404
+
+    sprite = asset_manifest.get("first_frame_sprite")
+    response = jsonify({
+        "firstFrameSprite": {"url": f"{ASSET_BASE_URL}/{sprite['path']}", "cell": sprite['cell']} if sprite else None,
+        "animations": animation_entries_for_names(dict.fromkeys(prize_names)),
+    })
+    response.set_etag(f"{ASSET_MANIFEST_ETAG}-{catalog.version}-{case_id or ''}-{slot_id or ''}")
+    response.headers['Cache-Control'] = "public, max-age=300"
+    return response.make_conditional(flask_request)
+
+@app.route('/api/asset_manifest', methods=['GET'])
+def asset_manifest_api():
+    response = Response(ASSET_MANIFEST_BODY, mimetype='application/json')
+    response.set_etag(ASSET_MANIFEST_ETAG)
+    response.headers['Cache-Control'] = "public, max-age=300"
+    return response.make_conditional(flask_request)
+
+
+# --- Game RNG ---
+# Every game roll comes from a per-thread buffer filled from the OS CSPRNG in bulk, so draws
+# are unpredictable, never contend on a shared generator and cost one struct unpack each.
+# A request sent with X-Provably-Fair: 1 instead draws from the user's committed seed pair,
+# which players can replay once the server seed is revealed by /api/fairness/rotate.
+GAME_RNG_BUFFER_BYTES = int(os.environ.get("GAME_RNG_BUFFER_BYTES", 4096))
+PROVABLY_FAIR_ENABLED = os.environ.get("PROVABLY_FAIR_ENABLED", "1").lower() in ("1", "true", "yes")
+FAIRNESS_CLIENT_SEED_MAX_LENGTH = 64
+_UINT64 = struct.Struct('>Q')
+_FLOAT53_SCALE = 2.0 ** -53
+
+class ByteStreamRNG(abc.ABC):
+    """Uniform draws consumed in order from a byte stream; subclasses supply the blocks."""
+    __slots__ = ('_block', '_offset')
+
+    def __init__(self):
+        self._block = b''
+        self._offset = 0
+
+    @abc.abstractmethod
+    def _next_block(self) -> bytes:
+        """The next chunk of the stream; any non-empty length."""
+
+    def _reserve(self, nbytes: int) -> int:
+        """Offset of the next nbytes in self._block, refilling (and keeping any unread tail) when short."""
+        if self._offset + nbytes > len(self._block):
+            block = self._block[self._offset:]
+            while len(block) < nbytes:
+                block += self._next_block()
+            self._block, self._offset = block, 0
+        offset = self._offset
+        self._offset += nbytes
+        return offset
+
+    def random(self) -> float:
+        """Float in [0, 1) from the top 53 bits of the next 8 bytes (big-endian)."""
+        offset = self._reserve(8)
+        return (_UINT64.unpack_from(self._block, offset)[0] >> 11) * _FLOAT53_SCALE
+
+    def randoms(self, n: int) -> list:
+        """n floats in one unpack; the same values n calls to random() would return."""
+        offset = self._reserve(8 * n)
+        return [(v >> 11) * _FLOAT53_SCALE for v in struct.unpack_from(f'>{n}Q', self._block, offset)]
+
+    def uniform(self, a: float, b: float) -> float:
+        return a + (b - a) * self.random()
+
+    def randbelow(self, n: int) -> int:
+        """Integer in [0, n) by rejection sampling, so there is no modulo bias."""
+        limit = (1 << 64) - (1 << 64) % n
+        while True:
+            offset = self._reserve(8)
+            value = _UINT64.unpack_from(self._block, offset)[0]
+            if value < limit:
+                return value % n
+
+    def choice(self, seq):
+        return seq[self.randbelow(len(seq))]
+
+class BufferedCSPRNG(ByteStreamRNG):
+    """os.urandom read GAME_RNG_BUFFER_BYTES at a time. Not thread-safe: use game_rng()."""
+    __slots__ = ()
+
+    def _next_block(self) -> bytes:
+        return os.urandom(GAME_RNG_BUFFER_BYTES)
+
+class ProvablyFairRNG(ByteStreamRNG):
+    """
+    Deterministic stream for one game: HMAC-SHA256(key=server_seed, msg=f"{client_seed}:{nonce}:{round}")
+    for round = 0, 1, 2, ... concatenated. Draws consume it exactly as ByteStreamRNG describes.
+    """
+    __slots__ = ('_key', '_prefix', '_round')
+
+    def __init__(self, server_seed: str, client_seed: str, nonce: int):
+        super().__init__()
+        self._key = server_seed.encode('utf-8')
+        self._prefix = f"{client_seed}:{nonce}:".encode('utf-8')
+        self._round = 0
+
+    def _next_block(self) -> bytes:
+        block = hmac.new(self._key, self._prefix + str(self._round).encode('ascii'), hashlib.sha256).digest()
+        self._round += 1
+        return block
+
+_thread_rng = threading.local()
+# A forked worker must never replay bytes buffered in the parent
+os.register_at_fork(after_in_child=_thread_rng.__dict__.clear)
+
+def game_rng() -> BufferedCSPRNG:
+    rng = getattr(_thread_rng, 'rng', None)
+    if rng is None:
+        rng = _thread_rng.rng = BufferedCSPRNG()
+    return rng
+
+def game_rng_for_request(db, user_id: int) -> tuple:
+    """
+    (rng, fairness) for a game request. fairness is None for the CSPRNG, or the seed hash,
+    client seed and nonce that reproduce this game once the server seed is revealed.
+    The nonce is bumped in the game's own transaction (db): a game that does not commit
+    releases its nonce, so the sequence the player audits has no gaps.
+    """
+    if not PROVABLY_FAIR_ENABLED or flask_request.headers.get('X-Provably-Fair') != '1':
+        return game_rng(), None
+    seed = db.execute(
+        update(FairnessSeed)
+        .where(FairnessSeed.user_id == user_id, FairnessSeed.is_active.is_(True))
+        .values({FairnessSeed.nonce: FairnessSeed.nonce + 1})
+        .returning(FairnessSeed.server_seed, FairnessSeed.server_seed_hash, FairnessSeed.client_seed, FairnessSeed.nonce)
+    ).first()
+    if seed is None:
+        raise RequestValidationError("No active provably-fair seed. Set one with /api/fairness/rotate first.")
+    return ProvablyFairRNG(seed.server_seed, seed.client_seed, seed.nonce), {
+        "serverSeedHash": seed.server_seed_hash, "clientSeed": seed.client_seed, "nonce": seed.nonce,
+    }
+
+def fairness_seed_payload(seed, reveal: bool = False) -> dict:
+    payload = {"serverSeedHash": seed.server_seed_hash, "clientSeed": seed.client_seed, "nonce": seed.nonce}
+    if reveal:
+        payload["serverSeed"] = seed.server_seed
+    return payload
+
+
+# --- Game Event Ledger ---
+# Routes record one event per game after their transaction commits; record() only appends a
+# tuple to an in-process deque. A background thread per worker drains it with COPY (or one
+# multi-row INSERT when the driver has no COPY support) every GAME_EVENT_FLUSH_INTERVAL_SECONDS,
+# or sooner once GAME_EVENT_FLUSH_BATCH events are waiting. Analytics read game_events only.
+# A batch the database rejects for its data is split in halves until the bad events are isolated;
+# those are logged at ERROR and counted as dead-lettered, the rest are written. Any other failure
+# (connection lost, database down) puts the unwritten events back at the front of the buffer.
+GAME_EVENT_FLUSH_INTERVAL_SECONDS = float(os.environ.get("GAME_EVENT_FLUSH_INTERVAL_SECONDS", 1.0))
+GAME_EVENT_FLUSH_BATCH = int(os.environ.get("GAME_EVENT_FLUSH_BATCH", 1000))
+GAME_EVENT_BUFFER_MAX = int(os.environ.get("GAME_EVENT_BUFFER_MAX", 100000)) # Oldest events are dropped past this if the DB is down
+GAME_HISTORY_PAGE_SIZE = 20
+GAME_HISTORY_MAX_PAGE_SIZE = 100
+GAME_EVENT_TYPES = ('case', 'slot', 'upgrade', 'upgrade_v2', 'convert', 'withdrawal', 'deposit')
+NO_RNG_REFERENCE = "none" # Conversions and withdrawals involve no roll
+GAME_EVENT_COLUMNS = ('created_at', 'user_id', 'game_type', 'game_id', 'cost_nano', 'value_nano', 'outcome', 'rng_ref', 'details')
+GAME_EVENT_TEXT_COLUMNS = ('game_type', 'game_id', 'outcome', 'rng_ref') # COPY csv would read an empty string as NULL
+
+def rng_reference(fairness: dict | None) -> str:
+    return f"pf:{fairness['serverSeedHash']}:{fairness['nonce']}" if fairness else "csprng"
+
+class GameEventLedger:
+    """Buffers game events in process and writes them in batches off the request path."""
+
+    def __init__(self):
+        self._buffer = deque() # append/popleft are atomic, so record() takes no lock
+        self._wake = threading.Event()
+        self._start_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pid = None
+        self.flushed_events = 0
+        self.dropped_events = 0
+        self.dead_lettered_events = 0
+        self.failed_flushes = 0
+        self._dropping = False # Set from the first overflow drop until the buffer drains
+
+    def record(self, user_id: int, game_type: str, game_id, cost_ton, value_ton, outcome: str, rng_ref: str, details: dict | None = None):
+        """Queues one event. Amounts are in TON (Decimal or float); conversion happens at flush time."""
+        if self._pid != os.getpid():
+            self._start()
+        self._buffer.append((dt.now(timezone.utc), user_id, game_type, str(game_id), cost_ton, value_ton, outcome, rng_ref, details))
+        if len(self._buffer) > GAME_EVENT_BUFFER_MAX:
+            dropped = self._buffer.popleft()
+            self.dropped_events += 1
+            if not self._dropping:
+                self._dropping = True
+                logger.error(f"Game event ledger buffer is full ({GAME_EVENT_BUFFER_MAX} events); dropping the oldest events "
+                             f"until it drains. First dropped: {dropped!r}")
+        if len(self._buffer) >= GAME_EVENT_FLUSH_BATCH:
+            self._wake.set()
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def _start(self):
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._buffer.clear() # A forked worker must not write events its parent still holds
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name="game-ledger-writer", daemon=True).start()
+
+    def _run(self):
+        while True:
+            self._wake.wait(GAME_EVENT_FLUSH_INTERVAL_SECONDS)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Game event ledger flush failed ({len(self._buffer)} events buffered): {e}", exc_info=True)
+
+    def flush(self) -> int:
+        """
+        Writes everything buffered so far. Events rejected for their data are dead-lettered; on any
+        other error the unwritten events go back to the front of the buffer and the error is raised.
+        """
+        written = 0
+        with self._flush_lock:
+            while self._buffer:
+                batch = []
+                while self._buffer and len(batch) < GAME_EVENT_FLUSH_BATCH:
+                    batch.append(self._buffer.popleft())
+                pending = [batch]
+                while pending:
+                    chunk = pending.pop(0)
+                    try:
+                        self._write(chunk)
+                    except Exception as e:
+                        if not self._is_data_error(e):
+                            for unwritten in reversed(pending):
+                                self._buffer.extendleft(reversed(unwritten))
+                            self._buffer.extendleft(reversed(chunk))
+                            self.failed_flushes += 1
+                            raise
+                        if len(chunk) > 1:
+                            middle = len(chunk) // 2
+                            pending[:0] = [chunk[:middle], chunk[middle:]]
+                        else:
+                            self.dead_lettered_events += 1
+                            logger.error(f"Game event ledger dead-lettered an event the database rejected ({e}): {chunk[0]!r}")
+                        continue
+                    written += len(chunk)
+                    self.flushed_events += len(chunk)
+            if self._dropping:
+                self._dropping = False
+                logger.warning(f"Game event ledger buffer drained; {self.dropped_events} events dropped on overflow so far.")
+        return written
+
+    @staticmethod
+    def _is_data_error(e: Exception) -> bool:
+        """True when retrying the same events can never succeed: bad values or a constraint violation."""
+        if isinstance(e, DBAPIError):
+            e = e.orig
+        dbapi = engine.dialect.dbapi
+        return isinstance(e, (ValueError, TypeError, ArithmeticError)) or (
+            dbapi is not None and isinstance(e, (dbapi.DataError, dbapi.IntegrityError)))
+
+    @staticmethod
+    def _write(batch: list):
+        rows = [(created_at, user_id, game_type, game_id, ton_to_nano(cost_ton), ton_to_nano(value_ton), outcome, rng_ref, details)
+                for created_at, user_id, game_type, game_id, cost_ton, value_ton, outcome, rng_ref, details in batch]
+        raw = engine.raw_connection()
+        try:
+            cursor = raw.cursor()
+            if not hasattr(cursor, 'copy_expert'):
+                with engine.begin() as conn:
+                    conn.execute(GameEvent.__table__.insert().values([dict(zip(GAME_EVENT_COLUMNS, row)) for row in rows]))
+                return
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            for row in rows:
+                details = row[-1]
+                writer.writerow(row[:-1] + (json.dumps(details, separators=(',', ':'), default=str) if details is not None else None,))
+            buffer.seek(0)
+            cursor.copy_expert(f"COPY {GameEvent.__tablename__} ({', '.join(GAME_EVENT_COLUMNS)}) FROM STDIN "
+                               f"WITH (FORMAT csv, FORCE_NOT_NULL ({', '.join(GAME_EVENT_TEXT_COLUMNS)}))", buffer)
+            raw.commit()
+        except Exception:
+            raw.rollback()
+            raise
+        finally:
+            raw.close()
+
+game_ledger = GameEventLedger()
+atexit.register(lambda: game_ledger.flush() if game_ledger._pid == os.getpid() else None)
+
+metrics.gauge('game_ledger_buffered_events', 'Game events waiting to be written.', lambda: len(game_ledger))
+metrics.gauge('game_ledger_events_written_total', 'Game events written to game_events.', lambda: game_ledger.flushed_events, metric_type='counter')
+metrics.gauge('game_ledger_events_dropped_total', 'Game events dropped because the buffer was full.', lambda: game_ledger.dropped_events, metric_type='counter')
+metrics.gauge('game_ledger_events_dead_lettered_total', 'Game events the database rejected; logged at ERROR and not retried.', lambda: game_ledger.dead_lettered_events, metric_type='counter')
+metrics.gauge('game_ledger_flush_failures_total', 'Failed game event batch writes.', lambda: game_ledger.failed_flushes, metric_type='counter')
+
+
+# --- RTP Telemetry ---
+# Realized return-to-player per case and slot. Each worker keeps running sums per game (lifetime
+# totals, per-prize hits, and RTP_BUCKET_SECONDS buckets covering the last RTP_WINDOW_SECONDS);
+# every field is a plain sum, so workers merge by addition. With REDIS_URL set each worker
+# publishes its snapshot every RTP_CHECK_INTERVAL_SECONDS and /admin/rtp merges all live ones.
+# A game alerts when its window RTP leaves RTP_TARGET +/- RTP_ALERT_Z standard errors.
+RTP_WINDOW_SECONDS = int(os.environ.get("RTP_WINDOW_SECONDS", 3600))
+RTP_BUCKET_SECONDS = 60
+RTP_CHECK_INTERVAL_SECONDS = int(os.environ.get("RTP_CHECK_INTERVAL_SECONDS", 60))
+RTP_ALERT_MIN_PLAYS = int(os.environ.get("RTP_ALERT_MIN_PLAYS", 200)) # Below this the band is too wide to mean anything
+RTP_ALERT_Z = float(os.environ.get("RTP_ALERT_Z", 3.0))
+RTP_ALERT_COOLDOWN_SECONDS = int(os.environ.get("RTP_ALERT_COOLDOWN_SECONDS", 1800))
+RTP_REDIS_KEY = "rtp_telemetry:workers"
+
+class RtpTelemetry:
+    """Per-game streaming aggregates for this worker."""
+
+    def __init__(self):
+        self._games = {} # game_id -> {"plays", "cost", "value", "hits", "buckets": {bucket_start: [plays, cost, value, sum_r, sum_r2]}}
+        self._lock = threading.Lock()
+        self._pid = None
+        self._worker_id = None
+        self._alerted_at = {} # game_id -> monotonic time of the last alert (when Redis is not shared)
+        self._redis = redis.Redis.from_url(REDIS_URL, socket_timeout=0.2, socket_connect_timeout=0.2) if REDIS_URL and redis is not None else None
+
+    def record(self, game_id: str, cost_ton, value_ton, prize_names):
+        """Adds one paid play. Called after the game's transaction commits."""
+        if self._pid != os.getpid():
+            self._start()
+        cost, value = float(cost_ton), float(value_ton)
+        ratio = value / cost if cost else 0.0
+        bucket_start = int(time.time()) // RTP_BUCKET_SECONDS * RTP_BUCKET_SECONDS
+        with self._lock:
+            game = self._games.get(game_id)
+            if game is None:
+                game = self._games[game_id] = {"plays": 0, "cost": 0.0, "value": 0.0, "hits": {}, "buckets": {}}
+            game["plays"] += 1
+            game["cost"] += cost
+            game["value"] += value
+            hits = game["hits"]
+            for name in prize_names:
+                hits[name] = hits.get(name, 0) + 1
+            bucket = game["buckets"].get(bucket_start)
+            if bucket is None:
+                bucket = game["buckets"][bucket_start] = [0, 0.0, 0.0, 0.0, 0.0]
+                for expired in [b for b in game["buckets"] if b <= bucket_start - RTP_WINDOW_SECONDS]:
+                    del game["buckets"][expired]
+            bucket[0] += 1
+            bucket[1] += cost
+            bucket[2] += value
+            bucket[3] += ratio
+            bucket[4] += ratio * ratio
+
+    def snapshot(self) -> dict:
+        """This worker's sums with the window already folded: game_id -> {plays, cost, value, hits, window: [...]}."""
+        cutoff = time.time() - RTP_WINDOW_SECONDS
+        with self._lock:
+            return {
+                game_id: {
+                    "plays": game["plays"], "cost": game["cost"], "value": game["value"], "hits": dict(game["hits"]),
+                    "window": [sum(values) for values in zip([0, 0.0, 0.0, 0.0, 0.0], *(b for start, b in game["buckets"].items() if start > cutoff))],
+                }
+                for game_id, game in self._games.items()
+            }
+
+    @staticmethod
+    def merge(snapshots: list) -> dict:
+        merged = {}
+        for snapshot in snapshots:
+            for game_id, game in snapshot.items():
+                into = merged.setdefault(game_id, {"plays": 0, "cost": 0.0, "value": 0.0, "hits": {}, "window": [0, 0.0, 0.0, 0.0, 0.0]})
+                into["plays"] += game["plays"]
+                into["cost"] += game["cost"]
+                into["value"] += game["value"]
+                for name, count in game["hits"].items():
+                    into["hits"][name] = into["hits"].get(name, 0) + count
+                into["window"] = [a + b for a, b in zip(into["window"], game["window"])]
+        return merged
+
+    @staticmethod
+    def summarize(game: dict) -> dict:
+        """Realized RTP (lifetime and window) and where the window sits against the RTP_TARGET band."""
+        target = float(RTP_TARGET)
+        plays, cost, value, sum_r, sum_r2 = game["window"]
+        summary = {
+            "plays": game["plays"],
+            "rtp": round(game["value"] / game["cost"], 4) if game["cost"] else None,
+            "window_plays": plays,
+            "window_rtp": round(value / cost, 4) if cost else None,
+            "band": None,
+            "status": "insufficient_data",
+            "hits": game["hits"],
+        }
+        if plays >= RTP_ALERT_MIN_PLAYS and cost:
+            variance = max(0.0, (sum_r2 - sum_r * sum_r / plays) / (plays - 1))
+            margin = RTP_ALERT_Z * math.sqrt(variance / plays)
+            summary["band"] = [round(target - margin, 4), round(target + margin, 4)]
+            window_rtp = value / cost
+            summary["status"] = "high" if window_rtp > target + margin else "low" if window_rtp < target - margin else "ok"
+        return summary
+
+    def cluster_view(self) -> tuple:
+        """(merged snapshot, number of workers, scope). Falls back to this worker alone without Redis."""
+        local = self.snapshot()
+        if self._redis is None:
+            return local, 1, "worker"
+        try:
+            stale_before = time.time() - 3 * RTP_CHECK_INTERVAL_SECONDS
+            snapshots = [local]
+            for worker_id, raw in self._redis.hgetall(RTP_REDIS_KEY).items():
+                published = json.loads(raw)
+                if worker_id.decode() != self._worker_id and published["at"] >= stale_before:
+                    snapshots.append(published["games"])
+            return self.merge(snapshots), len(snapshots), "cluster"
+        except (redis.RedisError, ValueError) as e:
+            logger.warning(f"RTP telemetry: Redis unavailable, reporting this worker only: {e}")
+            return local, 1, "worker"
+
+    def _start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._games.clear() # A forked worker starts from zero; its parent reports its own plays
+            self._pid = os.getpid()
+            self._worker_id = f"{socket.gethostname()}:{self._pid}"
+        threading.Thread(target=self._run, name="rtp-telemetry", daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(RTP_CHECK_INTERVAL_SECONDS)
+            try:
+                self.publish_and_check()
+            except Exception as e:
+                logger.error(f"RTP telemetry check failed: {e}", exc_info=True)
+
+    def publish_and_check(self):
+        if self._redis is not None:
+            try:
+                self._redis.hset(RTP_REDIS_KEY, self._worker_id, json.dumps({"at": time.time(), "games": self.snapshot()}))
+                self._redis.expire(RTP_REDIS_KEY, 3 * RTP_CHECK_INTERVAL_SECONDS)
+            except redis.RedisError as e:
+                logger.warning(f"RTP telemetry: could not publish snapshot: {e}")
+        merged, workers, scope = self.cluster_view()
+        for game_id, game in merged.items():
+            summary = self.summarize(game)
+            if summary["status"] in ("high", "low") and self._claim_alert(game_id):
+                self._alert(game_id, summary, workers, scope)
+
+    def _claim_alert(self, game_id: str) -> bool:
+        """True for exactly one worker per game per RTP_ALERT_COOLDOWN_SECONDS."""
+        if self._redis is not None:
+            try:
+                return bool(self._redis.set(f"rtp_alert:{game_id}", self._worker_id, nx=True, ex=RTP_ALERT_COOLDOWN_SECONDS))
+            except redis.RedisError:
+                pass
+        now = time.monotonic()
+        if now - self._alerted_at.get(game_id, -RTP_ALERT_COOLDOWN_SECONDS) < RTP_ALERT_COOLDOWN_SECONDS:
+            return False
+        self._alerted_at[game_id] = now
+        return True
+
+    @staticmethod
+    def _alert(game_id: str, summary: dict, workers: int, scope: str):
+        text_message = (f"RTP drift: {game_id} realized {summary['window_rtp']:.2%} over the last {RTP_WINDOW_SECONDS // 60} min "
+                        f"({summary['window_plays']} plays, {workers} {scope} worker(s)); target {float(RTP_TARGET):.0%}, "
+                        f"band {summary['band'][0]:.2%}-{summary['band'][1]:.2%}.")
+        logger.warning(text_message)
+        if bot and ADMIN_USER_ID:
+            try:
+                bot.send_message(ADMIN_USER_ID, f"⚠️ {text_message}")
+            except Exception as e:
+                logger.error(f"Failed to send RTP drift alert to admin: {e}")
+
+rtp_telemetry = RtpTelemetry()
+
+metrics.gauge('game_rtp_window', 'Realized RTP per game over RTP_WINDOW_SECONDS (this worker).',
+              lambda: [((game_id,), game["window"][2] / game["window"][1]) for game_id, game in rtp_telemetry.snapshot().items() if game["window"][1]],
+              label_names=('game_id',))
+
+@app.route('/admin/rtp')
+def rtp_telemetry_route():
+    """Realized vs target RTP per case and slot, merged across workers when Redis is configured. Needs METRICS_TOKEN."""
+    refused = metrics_request_status()
+    if refused:
+        return jsonify({"error": "Not found" if refused == 404 else "Unauthorized"}), refused
+    merged, workers, scope = rtp_telemetry.cluster_view()
+    return jsonify({
+        "target": float(RTP_TARGET),
+        "window_seconds": RTP_WINDOW_SECONDS,
+        "scope": scope,
+        "workers": workers,
+        "games": {game_id: RtpTelemetry.summarize(game) for game_id, game in sorted(merged.items())},
+    })
+
+
+# --- Game Draw & Serialization Helpers ---
+def draw_case_prizes(prizes_in_case: list, multiplier: int, rng: ByteStreamRNG | None = None) -> list:
+    """Draws `multiplier` prizes from a case's cumulative probability table."""
+    rng = rng or game_rng()
+    chosen_prizes = []
+    for rv in rng.randoms(multiplier): # One draw per item in a multi-open
+        cprob = 0
+        chosen_prize_info = None
+
+        for p_info in prizes_in_case:
+            cprob += p_info['probability']
+            if rv <= cprob:
+                chosen_prize_info = p_info
+                break
+
+        if not chosen_prize_info: # Fallback if somehow no prize is chosen by probability
+            chosen_prize_info = rng.choice(prizes_in_case) if prizes_in_case else \
+                                {'name': "Error Prize", 'floor_price': 0, 'imageFilename': 'placeholder.png', 'is_ton_prize': False}
+        chosen_prizes.append(chosen_prize_info)
+    return chosen_prizes
+
+def spin_slot_reels(slot_pool: list, num_reels: int, rng: ByteStreamRNG | None = None) -> list:
+    """Lands one symbol per reel from a slot's prize pool."""
+    rng = rng or game_rng()
+    reel_results_data = []
+    for rv in rng.randoms(num_reels):
+        cprob = 0
+        landed_symbol_spec = None
+        for p_info_slot in slot_pool:
+            cprob += p_info_slot.get('probability', 0)
+            if rv <= cprob:
+                landed_symbol_spec = p_info_slot
+                break
+
+        if not landed_symbol_spec:
+            landed_symbol_spec = rng.choice(slot_pool) if slot_pool else {"name":"Error Symbol","imageFilename":"placeholder.png","is_ton_prize":False,"currentValue":0,"floorPrice":0,"value":0}
+
+        reel_results_data.append({
+            "name": landed_symbol_spec['name'],
+            "imageFilename": landed_symbol_spec.get('imageFilename') or generate_image_filename_from_name(landed_symbol_spec['name']),
+            "is_ton_prize": landed_symbol_spec.get('is_ton_prize', False),
+            "currentValue": landed_symbol_spec.get('value', landed_symbol_spec.get('floorPrice', 0))
+        })
+        reel_results_data[-1]["imageVariants"] = image_variants(reel_results_data[-1]["imageFilename"])
+    return reel_results_data
+
+def serialize_inventory_item(i) -> InventoryItemOut:
+    """Inventory row as returned by get_user_data."""
+    item_name = i.nft.name if i.nft else i.item_name_override
+    # The URL is written on the row at insert time (and backfilled for older rows), so it is never recomputed here
+    item_image = i.item_image_override or (i.nft.image_filename if i.nft else generate_image_filename_from_name(item_name))
+    return InventoryItemOut(
+        id=i.id,
+        name=item_name,
+        imageFilename=item_image,
+        imageVariants=image_variants(item_image),
+        floorPrice=i.nft.floor_price if i.nft else i.current_value,
+        currentValue=i.current_value,
+        upgradeMultiplier=i.upgrade_multiplier,
+        variant=i.variant,
+        is_ton_prize=i.is_ton_prize,
+        obtained_at=i.obtained_at.isoformat() if i.obtained_at else None
+    )
+
+
+# --- Promo Code Redemption ---
+# Each worker keeps a snapshot of every code_text -> (id, exhausted). A code missing from the snapshot is
+# unknown, so guesses are answered without touching the database and cost no memory of their own; the
+# snapshot is the bounded negative cache. Codes seen at 0 activations are served from the snapshot too.
+# It is reloaded every PROMO_CACHE_TTL_SECONDS and right after invalidate(); with REDIS_URL set, invalidate()
+# also bumps a shared generation that other workers poll, so a new code is redeemable everywhere within seconds.
+# Without Redis only the worker that created the code hears about it, so there a miss on a snapshot older
+# than PROMO_CACHE_MISS_REFRESH_SECONDS reloads it first: a code posted in a giveaway works on every worker
+# within that many seconds, and a flood of guesses still costs at most one query per interval per worker.
+PROMO_CACHE_TTL_SECONDS = int(os.environ.get("PROMO_CACHE_TTL_SECONDS", "30"))
+PROMO_CACHE_MISS_REFRESH_SECONDS = 3.0
+PROMO_CACHE_GENERATION_CHECK_SECONDS = 1.0
+PROMO_CACHE_GENERATION_KEY = "promo_cache:generation"
+
+class PromoCodeCache:
+    def __init__(self):
+        self._codes = None # code_text -> (promo_id, exhausted)
+        self._loaded_at = 0.0
+        self._generation = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self._redis = redis.Redis.from_url(REDIS_URL, socket_timeout=0.2, socket_connect_timeout=0.2) if REDIS_URL and redis is not None else None
+
+    def lookup(self, code_text: str) -> tuple[int, bool] | None:
+        """(promo_id, exhausted) for a known code, None for an unknown one."""
+        codes = self._current()
+        entry = codes.get(code_text)
+        if entry is None and self._redis is None and time.monotonic() - self._loaded_at >= PROMO_CACHE_MISS_REFRESH_SECONDS:
+            entry = self._reload_if_unchanged(codes).get(code_text)
+        return entry
+
+    def mark_exhausted(self, code_text: str):
+        codes = self._codes
+        if codes is not None and code_text in codes:
+            codes[code_text] = (codes[code_text][0], True)
+
+    def forget(self, code_text: str):
+        codes = self._codes
+        if codes is not None:
+            codes.pop(code_text, None)
+
+    def invalidate(self):
+        """Call after creating a code or changing its activations outside the redemption path."""
+        self._loaded_at = 0.0
+        if self._redis is not None:
+            try:
+                self._redis.incr(PROMO_CACHE_GENERATION_KEY)
+            except redis.RedisError as e:
+                logger.warning(f"Could not publish promo cache invalidation: {e}")
+
+    def size(self) -> int:
+        return len(self._codes or ())
+
+    def _current(self) -> dict:
+        codes = self._codes
+        now = time.monotonic()
+        if codes is not None and now - self._loaded_at < PROMO_CACHE_TTL_SECONDS and not self._generation_changed(now):
+            return codes
+        return self._reload_if_unchanged(codes)
+
+    def _reload_if_unchanged(self, codes: dict | None) -> dict:
+        with self._lock:
+            if self._codes is codes: # Not reloaded by another thread while this one waited
+                try:
+                    self._reload()
+                except SQLAlchemyError as e:
+                    if codes is None:
+                        raise
+                    logger.error(f"Promo cache reload failed, serving the previous snapshot: {e}")
+                    self._loaded_at = time.monotonic()
+            return self._codes
+
+    def _read_generation(self):
+        try:
+            return self._redis.get(PROMO_CACHE_GENERATION_KEY)
+        except redis.RedisError:
+            return self._generation
+
+    def _generation_changed(self, now: float) -> bool:
+        if self._redis is None or now - self._checked_at < PROMO_CACHE_GENERATION_CHECK_SECONDS:
+            return False
+        self._checked_at = now
+        return self._read_generation() != self._generation
+
+    def _reload(self):
+        # The generation is read first so a bump racing with the query triggers one more reload, never a missed one
+        generation = self._read_generation() if self._redis is not None else None
+        db = SessionLocal()
+        try:
+            rows = db.query(PromoCode.code_text, PromoCode.id, PromoCode.activations_left).all()
+        finally:
+            db.close()
+        self._codes = {r.code_text: (r.id, r.activations_left == 0) for r in rows}
+        self._generation = generation
+        self._loaded_at = time.monotonic()
+        logger.debug("Promo cache loaded %d codes", len(self._codes))
+
+promo_cache = PromoCodeCache()
+metrics.gauge('promo_cache_codes', "Promo codes held in this worker's lookup snapshot.", lambda: promo_cache.size())
+
+# One statement per redemption: the promo row is only locked for the duration of the UPDATE and the commit that
+# follows it, and the user row is never locked. A concurrent second redemption by the same user fails on
+# uq_user_promo_redemption, which rolls the whole statement back, decrement included.
+PROMO_REDEEM_SQL = text("""
+    WITH promo AS (
+        UPDATE promo_codes SET
+            activations_left = CASE WHEN activations_left = -1 THEN -1 ELSE activations_left - 1 END,
+            updated_at = now()
+        WHERE id = :promo_id
+          AND (activations_left > 0 OR activations_left = -1)
+          AND EXISTS (SELECT 1 FROM users WHERE id = :user_id)
+          AND NOT EXISTS (SELECT 1 FROM user_promo_code_redemptions r WHERE r.user_id = :user_id AND r.promo_code_id = promo_codes.id)
+        RETURNING id, ton_amount, activations_left, round(ton_amount::numeric * 1000000000)::bigint AS credit_nano
+    ), redemption AS (
+        INSERT INTO user_promo_code_redemptions (user_id, promo_code_id, redeemed_at)
+        SELECT :user_id, id, now() FROM promo
+        RETURNING promo_code_id
+    ), credit AS (
+        UPDATE users SET ton_balance = users.ton_balance + promo.credit_nano
+        FROM promo, redemption
+        WHERE users.id = :user_id
+        RETURNING users.ton_balance
+    )
+    SELECT promo.id, promo.ton_amount, promo.activations_left, credit.ton_balance FROM promo, credit
+""")
+PROMO_INVALID_RESPONSE = ({"status":"error","message":"Invalid promocode."}, 404)
+PROMO_EXHAUSTED_RESPONSE = ({"status":"error","message":"This promocode has no activations left."}, 400)
+
+def redeem_promo_code(db, user_id: int, promo_id: int):
+    """Redeems promo_id for user_id in one round trip. Returns (id, ton_amount, activations_left, ton_balance) or None."""
+    return db.execute(PROMO_REDEEM_SQL, {"promo_id": promo_id, "user_id": user_id}).first()
+
+def promo_redemption_failure(db, user_id: int, code_text: str, promo_id: int) -> tuple[dict, int]:
+    """Explains why redeem_promo_code matched nothing, using plain reads only, and corrects the promo cache."""
+    promo = db.query(PromoCode.activations_left).filter(PromoCode.id == promo_id).first()
+    if not promo:
+        promo_cache.forget(code_text)
+        return PROMO_INVALID_RESPONSE
+    if not db.query(User.id).filter(User.id == user_id).first():
+        return {"status":"error","message":"User not found."}, 404
+    if db.query(UserPromoCodeRedemption.id).filter(UserPromoCodeRedemption.user_id == user_id, UserPromoCodeRedemption.promo_code_id == promo_id).first():
+        return {"status":"error","message":"You have already redeemed this promocode."}, 400
+    promo_cache.mark_exhausted(code_text)
+    return PROMO_EXHAUSTED_RESPONSE
+
+
 # --- API Routes ---
 @app.route('/')
 def index_route():
     return "Pusik Gifts API Backend is Running!"
 
 @app.route('/api/get_user_data', methods=['POST'])
+@rate_limited('get_user_data')
 def get_user_data_api():
     auth = validate_init_data(flask_request.headers.get('X-Telegram-Init-Data'), BOT_TOKEN)
     if not auth:
@@ -1952,22 +4554,7 @@ def get_user_data_api():
             db.commit()
             db.refresh(user)
 
-        inv = []
-        for i in user.inventory:
-            item_name = i.nft.name if i.nft else i.item_name_override
-            item_image = i.nft.image_filename if i.nft else i.item_image_override or generate_image_filename_from_name(item_name)
-            
-            inv.append({
-                "id":i.id,
-                "name":item_name,
-                "imageFilename":item_image,
-                "floorPrice":i.nft.floor_price if i.nft else i.current_value,
-                "currentValue":i.current_value,
-                "upgradeMultiplier":i.upgrade_multiplier,
-                "variant":i.variant,
-                "is_ton_prize":i.is_ton_prize,
-                "obtained_at":i.obtained_at.isoformat() if i.obtained_at else None
-            })
+        inv = [serialize_inventory_item(i) for i in user.inventory]
 
         refs_count = db.query(User).filter(User.referred_by_id == uid).count()
 
@@ -1976,7 +4563,7 @@ def get_user_data_api():
             "username":user.username,
             "first_name":user.first_name,
             "last_name":user.last_name,
-            "tonBalance":user.ton_balance,
+            "tonBalance":nano_to_ton(user.ton_balance),
             "starBalance":user.star_balance,
             "inventory":inv,
             "referralCode":user.referral_code,
@@ -2116,6 +4703,7 @@ def register_referral_api():
 
 # NEW API Endpoint to fetch gift listings
 @app.route('/api/tonnel_gift_listings/<int:inventory_item_id>', methods=['GET'])
+@rate_limited('tonnel_gift_listings')
 def get_tonnel_gift_listings_api(inventory_item_id):
     auth_user_data = validate_init_data(flask_request.headers.get('X-Telegram-Init-Data'), BOT_TOKEN)
     if not auth_user_data:
@@ -2180,62 +4768,50 @@ def get_tonnel_gift_listings_api(inventory_item_id):
         db.close()
 
 @app.route('/api/open_case', methods=['POST'])
+@rate_limited('open_case')
+@idempotent
 def open_case_api():
     auth = validate_init_data(flask_request.headers.get('X-Telegram-Init-Data'), BOT_TOKEN)
     if not auth:
         return jsonify({"error": "Auth failed"}), 401
     
     uid = auth["id"]
-    data = flask_request.get_json()
-    cid = data.get('case_id')
-    multiplier = int(data.get('multiplier', 1))
+    body = parse_request_body(OpenCaseRequest)
+    cid = body.case_id
+    multiplier = body.multiplier
 
-    if not cid:
-        return jsonify({"error": "case_id required"}), 400
     if multiplier not in [1, 2, 3]: # Assuming only 1x, 2x, 3x multipliers are allowed
         return jsonify({"error": "Invalid multiplier. Must be 1, 2, or 3."}), 400
     
+    tcase = get_game_catalog().cases.get(cid)
+    if not tcase:
+        return jsonify({"error": "Case not found"}), 404
+
+    base_cost = Decimal(str(tcase['priceTON'])) # Cost of a single case opening
+    total_cost = base_cost * Decimal(multiplier)
+    prizes_in_case = tcase['prizes']
+
+    won_prizes_list = []
+    big_win_messages = []
     db = next(get_db())
     try:
-        user = db.query(User).filter(User.id == uid).with_for_update().first()
-        if not user:
-            return jsonify({"error": "User not found"}), 404
-        
-        tcase = next((c for c in cases_data_backend if c['id'] == cid), None)
-        if not tcase:
-            return jsonify({"error": "Case not found"}), 404
-        
-        base_cost = Decimal(str(tcase['priceTON'])) # Cost of a single case opening
-        total_cost = base_cost * Decimal(multiplier)
-
-        if Decimal(str(user.ton_balance)) < total_cost:
+        # Draw all prizes before the debit so the user row is only locked for the writes
+        rng, fairness = game_rng_for_request(db, uid)
+        chosen_prizes = draw_case_prizes(prizes_in_case, multiplier, rng)
+
+        # Use floor_price from the processed case data for consistency
+        total_value_this_spin_from_all_multiplied_opens = sum((Decimal(str(p.get('floor_price', 0))) for p in chosen_prizes), Decimal('0'))
+
+        # Single conditional UPDATE: charges the case and bumps total_won_ton, or matches no row
+        new_balance_nano = debit_ton_balance(db, uid, ton_to_nano(total_cost), total_won_delta=total_value_this_spin_from_all_multiplied_opens)
+        if new_balance_nano is None:
+            if not db.query(User.id).filter(User.id == uid).first():
+                return jsonify({"error": "User not found"}), 404
             return jsonify({"error": f"Not enough TON. Need {total_cost:.2f} TON"}), 400
-        
-        user.ton_balance = float(Decimal(str(user.ton_balance)) - total_cost)
-        
-        prizes_in_case = tcase['prizes']
-        won_prizes_list = []
-        total_value_this_spin_from_all_multiplied_opens = Decimal('0') # To update user.total_won_ton
-
-        for i in range(multiplier): # Loop for each item in a multi-open
-            rv = random.random()
-            cprob = 0
-            chosen_prize_info = None
-
-            for p_info in prizes_in_case:
-                cprob += p_info['probability']
-                if rv <= cprob:
-                    chosen_prize_info = p_info
-                    break
-            
-            if not chosen_prize_info: # Fallback if somehow no prize is chosen by probability
-                chosen_prize_info = random.choice(prizes_in_case) if prizes_in_case else \
-                                    {'name': "Error Prize", 'floor_price': 0, 'imageFilename': 'placeholder.png', 'is_ton_prize': False}
-
 
+        for chosen_prize_info in chosen_prizes:
             dbnft = db.query(NFT).filter(NFT.name == chosen_prize_info['name']).first()
             
-            # Use floor_price from the processed case data for consistency
             actual_val_of_this_prize = Decimal(str(chosen_prize_info.get('floor_price', 0))) 
             
             variant_name = chosen_prize_info['name'] if chosen_prize_info['name'] in KISSED_FROG_VARIANT_FLOORS else None
@@ -2245,7 +4821,7 @@ def open_case_api():
                 user_id=uid,
                 nft_id=dbnft.id if dbnft else None,
                 item_name_override=chosen_prize_info['name'],
-                item_image_override=chosen_prize_info.get('imageFilename', generate_image_filename_from_name(chosen_prize_info['name'])),
+                item_image_override=chosen_prize_info.get('imageFilename') or generate_image_filename_from_name(chosen_prize_info['name']),
                 current_value=float(actual_val_of_this_prize.quantize(Decimal('0.01'), ROUND_HALF_UP)),
                 variant=variant_name,
                 is_ton_prize=chosen_prize_info.get('is_ton_prize', False)
@@ -2257,15 +4833,14 @@ def open_case_api():
                 "id": item.id,
                 "name": chosen_prize_info['name'],
                 "imageFilename": item.item_image_override,
+                "imageVariants": image_variants(item.item_image_override),
                 "floorPrice": float(actual_val_of_this_prize), # The actual value it was won at
                 "currentValue": item.current_value,
                 "variant": item.variant,
                 "is_ton_prize": item.is_ton_prize
             })
-            
-            total_value_this_spin_from_all_multiplied_opens += actual_val_of_this_prize
 
-            # --- Big Win Notification Logic ---
+            # --- Big Win Notification Logic (sent after commit, outside the transaction) ---
             if base_cost > 0 and actual_val_of_this_prize > (base_cost * Decimal('1.5')):
                 win_rate_x = (actual_val_of_this_prize / base_cost).quantize(Decimal('0.1'), ROUND_HALF_UP)
                 
@@ -2285,25 +4860,13 @@ def open_case_api():
                     f"Win rate: 🚀 *{win_rate_x}x*\n\n"
                     f"@{BOT_USERNAME_FOR_LINK}"
                 )
-                try:
-                    if bot: # Ensure bot instance is available
-                        bot.send_message(BIG_WIN_CHANNEL_ID, message_to_channel, parse_mode="Markdown")
-                        logger.info(f"Sent big win notification to channel {BIG_WIN_CHANNEL_ID} for user {uid}, prize {prize_name_display} (value {actual_val_of_this_prize}), case {case_name_display} (cost {base_cost})")
-                    else:
-                        logger.warning("Bot instance not available, cannot send big win notification.")
-                except Exception as e_channel_msg:
-                    logger.error(f"Failed to send big win message to channel {BIG_WIN_CHANNEL_ID}: {e_channel_msg}")
+                big_win_messages.append((message_to_channel, prize_name_display, actual_val_of_this_prize))
             # --- End Big Win Notification Logic ---
 
-        # Update user's total winnings metric
-        user.total_won_ton = float(Decimal(str(user.total_won_ton)) + total_value_this_spin_from_all_multiplied_opens)
-        
         db.commit()
-        return jsonify({
-            "status": "success",
-            "won_prizes": won_prizes_list,
-            "new_balance_ton": user.ton_balance
-        })
+    except RequestValidationError:
+        db.rollback()
+        raise
     except Exception as e:
         db.rollback()
         logger.error(f"Error in open_case for user {uid}: {e}", exc_info=True)
@@ -2311,69 +4874,64 @@ def open_case_api():
     finally:
         db.close()
 
+    rtp_telemetry.record(cid, total_cost, total_value_this_spin_from_all_multiplied_opens, [p['name'] for p in chosen_prizes])
+    game_ledger.record(uid, 'case', cid, total_cost, total_value_this_spin_from_all_multiplied_opens,
+                       'win' if total_value_this_spin_from_all_multiplied_opens >= total_cost else 'loss', rng_reference(fairness),
+                       {"multiplier": multiplier, "prizes": [p['name'] for p in chosen_prizes]})
+
+    for message_to_channel, prize_name_display, prize_value in big_win_messages:
+        try:
+            if bot: # Ensure bot instance is available
+                bot.send_message(BIG_WIN_CHANNEL_ID, message_to_channel, parse_mode="Markdown")
+                logger.info(f"Sent big win notification to channel {BIG_WIN_CHANNEL_ID} for user {uid}, prize {prize_name_display} (value {prize_value}), case {tcase['name']} (cost {base_cost})")
+            else:
+                logger.warning("Bot instance not available, cannot send big win notification.")
+        except Exception as e_channel_msg:
+            logger.error(f"Failed to send big win message to channel {BIG_WIN_CHANNEL_ID}: {e_channel_msg}")
+
+    return jsonify({
+        "status": "success",
+        "won_prizes": won_prizes_list,
+        "new_balance_ton": nano_to_ton(new_balance_nano),
+        "fairness": fairness
+    })
+
 @app.route('/api/spin_slot', methods=['POST'])
+@rate_limited('spin_slot')
+@idempotent
 def spin_slot_api():
     auth = validate_init_data(flask_request.headers.get('X-Telegram-Init-Data'), BOT_TOKEN)
     if not auth:
         return jsonify({"error": "Auth failed"}), 401
     
     uid = auth["id"]
-    data = flask_request.get_json()
-    slot_id = data.get('slot_id')
+    slot_id = parse_request_body(SpinSlotRequest).slot_id
+    
+    target_slot = get_game_catalog().slots.get(slot_id)
+    if not target_slot:
+        return jsonify({"error": "Slot not found"}), 404
+    
+    cost = Decimal(str(target_slot['priceTON']))
+    num_reels = target_slot.get('reels_config', 3)
+    slot_pool = target_slot['prize_pool']
 
-    if not slot_id:
-        return jsonify({"error": "slot_id required"}), 400
+    if not slot_pool:
+        return jsonify({"error": "Slot prize pool is empty or not configured."}), 500
     
     db = next(get_db())
     try:
-        user = db.query(User).filter(User.id == uid).with_for_update().first()
-        if not user:
-            return jsonify({"error": "User not found"}), 404
-        
-        target_slot = next((s for s in slots_data_backend if s['id'] == slot_id), None)
-        if not target_slot:
-            return jsonify({"error": "Slot not found"}), 404
-        
-        cost = Decimal(str(target_slot['priceTON']))
-        if Decimal(str(user.ton_balance)) < cost:
-            return jsonify({"error": f"Not enough TON. Need {cost:.2f}"}), 400
-        
-        user.ton_balance = float(Decimal(str(user.ton_balance)) - cost)
-        
-        num_reels = target_slot.get('reels_config', 3)
-        slot_pool = target_slot['prize_pool']
+        # Spin the reels before the debit so the user row is only locked for the writes
+        rng, fairness = game_rng_for_request(db, uid)
+        reel_results_data = spin_slot_reels(slot_pool, num_reels, rng)
 
-        if not slot_pool:
-            return jsonify({"error": "Slot prize pool is empty or not configured."}), 500
-        
-        reel_results_data = []
-        for _ in range(num_reels):
-            rv = random.random()
-            cprob = 0
-            landed_symbol_spec = None
-            for p_info_slot in slot_pool:
-                cprob += p_info_slot.get('probability', 0)
-                if rv <= cprob:
-                    landed_symbol_spec = p_info_slot
-                    break
-            
-            if not landed_symbol_spec:
-                landed_symbol_spec = random.choice(slot_pool) if slot_pool else {"name":"Error Symbol","imageFilename":"placeholder.png","is_ton_prize":False,"currentValue":0,"floorPrice":0,"value":0}
-            
-            reel_results_data.append({
-                "name": landed_symbol_spec['name'],
-                "imageFilename": landed_symbol_spec.get('imageFilename', generate_image_filename_from_name(landed_symbol_spec['name'])),
-                "is_ton_prize": landed_symbol_spec.get('is_ton_prize', False),
-                "currentValue": landed_symbol_spec.get('value', landed_symbol_spec.get('floorPrice', 0))
-            })
-            
         won_prizes_from_slot = []
         total_value_this_spin = Decimal('0')
-        
+        ton_payout_this_spin = Decimal('0')
+    
         for landed_item_data in reel_results_data:
             if landed_item_data.get('is_ton_prize'):
                 ton_val = Decimal(str(landed_item_data['currentValue']))
-                user.ton_balance = float(Decimal(str(user.ton_balance)) + ton_val)
+                ton_payout_this_spin += ton_val
                 total_value_this_spin += ton_val
 
                 won_prizes_from_slot.append({
@@ -2383,52 +4941,69 @@ def spin_slot_api():
                     "currentValue": float(ton_val),
                     "is_ton_prize": True
                 })
-        
+
+        won_item_name = None
         if num_reels == 3 and len(reel_results_data) == 3:
             first_symbol = reel_results_data[0]
             if not first_symbol.get('is_ton_prize') and \
                first_symbol['name'] == reel_results_data[1]['name'] and \
                first_symbol['name'] == reel_results_data[2]['name']:
-                
                 won_item_name = first_symbol['name']
-                db_nft = db.query(NFT).filter(NFT.name == won_item_name).first()
-                
-                if db_nft:
-                    actual_val = Decimal(str(db_nft.floor_price))
-                    inv_item = InventoryItem(
-                        user_id=uid,
-                        nft_id=db_nft.id,
-                        item_name_override=db_nft.name,
-                        item_image_override=db_nft.image_filename,
-                        current_value=float(actual_val.quantize(Decimal('0.01'))),
-                        variant=None,
-                        is_ton_prize=False
-                    )
-                    db.add(inv_item)
-                    db.flush()
-                    
-                    won_prizes_from_slot.append({
-                        "id": inv_item.id,
-                        "name": inv_item.item_name_override,
-                        "imageFilename": inv_item.item_image_override,
-                        "floorPrice": float(db_nft.floor_price),
-                        "currentValue": inv_item.current_value,
-                        "is_ton_prize": False,
-                        "variant": inv_item.variant
-                    })
-                    total_value_this_spin += actual_val
-                else:
-                    logger.error(f"Slot win: NFT '{won_item_name}' not found in DB! Cannot add to inventory.")
+    
+        db_nft = None
+        if won_item_name:
+            db_nft = db.query(NFT).filter(NFT.name == won_item_name).first()
+            if db_nft:
+                total_value_this_spin += Decimal(str(db_nft.floor_price))
+            else:
+                logger.error(f"Slot win: NFT '{won_item_name}' not found in DB! Cannot add to inventory.")
+
+        # Single conditional UPDATE: charges the spin, pays out TON symbols and bumps total_won_ton
+        new_balance_nano = debit_ton_balance(db, uid, ton_to_nano(cost), payout_nano=ton_to_nano(ton_payout_this_spin), total_won_delta=total_value_this_spin)
+        if new_balance_nano is None:
+            if not db.query(User.id).filter(User.id == uid).first():
+                return jsonify({"error": "User not found"}), 404
+            return jsonify({"error": f"Not enough TON. Need {cost:.2f}"}), 400
 
-        user.total_won_ton = float(Decimal(str(user.total_won_ton)) + total_value_this_spin)
+        if db_nft:
+            actual_val = Decimal(str(db_nft.floor_price))
+            inv_item = InventoryItem(
+                user_id=uid,
+                nft_id=db_nft.id,
+                item_name_override=db_nft.name,
+                item_image_override=db_nft.image_filename or generate_image_filename_from_name(db_nft.name),
+                current_value=float(actual_val.quantize(Decimal('0.01'))),
+                variant=None,
+                is_ton_prize=False
+            )
+            db.add(inv_item)
+            db.flush()
+            
+            won_prizes_from_slot.append({
+                "id": inv_item.id,
+                "name": inv_item.item_name_override,
+                "imageFilename": inv_item.item_image_override,
+                "imageVariants": image_variants(inv_item.item_image_override),
+                "floorPrice": float(db_nft.floor_price),
+                "currentValue": inv_item.current_value,
+                "is_ton_prize": False,
+                "variant": inv_item.variant
+            })
         
         db.commit()
+        rtp_telemetry.record(slot_id, cost, total_value_this_spin, [p['name'] for p in won_prizes_from_slot])
+        game_ledger.record(uid, 'slot', slot_id, cost, total_value_this_spin, 'win' if total_value_this_spin >= cost else 'loss',
+                           rng_reference(fairness), {"reels": [r['name'] for r in reel_results_data], "won_item": won_item_name if db_nft else None})
         return jsonify({
             "status":"success",
             "reel_results":reel_results_data,
             "won_prizes":won_prizes_from_slot,
-            "new_balance_ton":user.ton_balance
+            "new_balance_ton":nano_to_ton(new_balance_nano),
+            "fairness":fairness
         })
+    except RequestValidationError:
+        db.rollback()
+        raise
     except Exception as e:
         db.rollback()
         logger.error(f"Error in spin_slot for user {uid}: {e}", exc_info=True)
@@ -2437,35 +5012,28 @@ def spin_slot_api():
         db.close()
 
 
+UPGRADE_MULTIPLIER_CHANCES = { # Value multiplier -> success chance in %, for v1 upgrades
+    Decimal("1.5"):50,
+    Decimal("2.0"):35,
+    Decimal("3.0"):25,
+    Decimal("5.0"):15,
+    Decimal("10.0"):8,
+    Decimal("20.0"):3
+}
+
 @app.route('/api/upgrade_item', methods=['POST'])
+@rate_limited('upgrade_item')
 def upgrade_item_api():
     auth = validate_init_data(flask_request.headers.get('X-Telegram-Init-Data'), BOT_TOKEN)
     if not auth:
         return jsonify({"error": "Auth failed"}), 401
     
     uid = auth["id"]
-    data = flask_request.get_json()
-    iid = data.get('inventory_item_id')
-    mult_str = data.get('multiplier_str')
-
-    if not all([iid, mult_str]):
-        return jsonify({"error": "Missing inventory_item_id or multiplier_str parameter."}), 400
+    body = parse_request_body(UpgradeItemRequest)
+    mult = body.multiplier_str
+    iid_int = body.inventory_item_id
     
-    try:
-        mult = Decimal(mult_str)
-        iid_int = int(iid)
-    except (ValueError, TypeError):
-        return jsonify({"error": "Invalid data format for multiplier or item ID."}), 400
-    
-    chances = {
-        Decimal("1.5"):50,
-        Decimal("2.0"):35,
-        Decimal("3.0"):25,
-        Decimal("5.0"):15,
-        Decimal("10.0"):8,
-        Decimal("20.0"):3
-    }
-    if mult not in chances:
+    if mult not in UPGRADE_MULTIPLIER_CHANCES:
         return jsonify({"error": "Invalid multiplier value provided."}), 400
     
     db = next(get_db())
@@ -2474,11 +5042,8 @@ def upgrade_item_api():
         if not item or item.is_ton_prize:
             return jsonify({"error": "Item not found in your inventory or cannot be upgraded."}), 404
         
-        user = db.query(User).filter(User.id == uid).with_for_update().first()
-        if not user:
-            return jsonify({"error": "User not found."}), 404
-
-        if random.uniform(0,100) < chances[mult]:
+        rng, fairness = game_rng_for_request(db, uid)
+        if rng.uniform(0,100) < UPGRADE_MULTIPLIER_CHANCES[mult]:
             orig_val = Decimal(str(item.current_value))
             new_val = (orig_val * mult).quantize(Decimal('0.01'), ROUND_HALF_UP)
             
@@ -2487,9 +5052,10 @@ def upgrade_item_api():
             item.current_value = float(new_val)
             item.upgrade_multiplier = float(Decimal(str(item.upgrade_multiplier)) * mult)
             
-            user.total_won_ton = float(Decimal(str(user.total_won_ton)) + increase_in_value)
+            adjust_total_won(db, uid, increase_in_value)
             
             db.commit()
+            game_ledger.record(uid, 'upgrade', mult, orig_val, new_val, 'success', rng_reference(fairness), {"inventory_item_id": iid_int})
             return jsonify({
                 "status":"success",
                 "message":f"Upgrade successful! Your {item.item_name_override} is now worth {new_val:.2f} TON.",
@@ -2500,17 +5066,22 @@ def upgrade_item_api():
                     "imageFilename":item.nft.image_filename if item.nft else item.item_image_override,
                     "upgradeMultiplier":item.upgrade_multiplier,
                     "variant":item.variant
-                }
+                },
+                "fairness":fairness
             })
         else:
             name_lost = item.nft.name if item.nft else item.item_name_override
             value_lost = Decimal(str(item.current_value))
             
-            user.total_won_ton = float(max(Decimal('0'), Decimal(str(user.total_won_ton)) - value_lost))
+            adjust_total_won(db, uid, -value_lost)
             
             db.delete(item)
             db.commit()
-            return jsonify({"status":"failed","message":f"Upgrade failed! You lost your {name_lost}.", "item_lost":True})
+            game_ledger.record(uid, 'upgrade', mult, value_lost, 0, 'failed', rng_reference(fairness), {"inventory_item_id": iid_int, "item_name": name_lost})
+            return jsonify({"status":"failed","message":f"Upgrade failed! You lost your {name_lost}.", "item_lost":True, "fairness":fairness})
+    except RequestValidationError:
+        db.rollback()
+        raise
     except Exception as e:
         db.rollback()
         logger.error(f"Error in upgrade_item for user {uid}: {e}", exc_info=True)
@@ -2518,31 +5089,50 @@ def upgrade_item_api():
     finally:
         db.close()
 
+UPGRADE_TARGETS_MAX_LIMIT = 200
+
+@app.route('/api/upgrade_targets', methods=['GET'])
+def upgrade_targets_api():
+    """Targets an item worth `value` TON can be upgraded to, cheapest first, with their success chances."""
+    try:
+        value = Decimal(flask_request.args.get('value', ''))
+        min_chance = Decimal(flask_request.args.get('min_chance', str(UPGRADE_MIN_CHANCE)))
+        limit = min(int(flask_request.args.get('limit', 50)), UPGRADE_TARGETS_MAX_LIMIT)
+    except (ValueError, ArithmeticError):
+        return jsonify({"error": "value, min_chance and limit must be numbers."}), 400
+    if not (value.is_finite() and min_chance.is_finite()) or value <= 0 or limit <= 0:
+        return jsonify({"error": "value and limit must be positive."}), 400
+
+    catalog = get_game_catalog()
+    response = jsonify({
+        "catalogVersion": catalog.version,
+        "targets": [{
+            "name": name,
+            "floorPrice": float(price),
+            "x": float(x.quantize(Decimal('0.01'))),
+            "chance": float(chance.quantize(Decimal('0.01'))),
+            "imageFilename": generate_image_filename_from_name(name),
+            "imageVariants": image_variants(generate_image_filename_from_name(name)),
+        } for name, price, x, chance in catalog.upgrade_targets.targets_above(value, min_chance, limit)]
+    })
+    response.headers['Cache-Control'] = "public, max-age=30"
+    return response
+
 @app.route('/api/upgrade_item_v2', methods=['POST'])
+@rate_limited('upgrade_item_v2')
+@idempotent
 def upgrade_item_v2_api():
     auth_user_data = validate_init_data(flask_request.headers.get('X-Telegram-Init-Data'), BOT_TOKEN)
     if not auth_user_data:
         return jsonify({"error": "Authentication failed"}), 401
     
     player_user_id = auth_user_data["id"]
-    data = flask_request.get_json()
-    inventory_item_id_str = data.get('inventory_item_id')
-    desired_item_name_str = data.get('desired_item_name')
-
-    if not inventory_item_id_str or not desired_item_name_str:
-        return jsonify({"error": "Missing inventory_item_id or desired_item_name."}), 400
-
-    try:
-        inventory_item_id = int(inventory_item_id_str)
-    except ValueError:
-        return jsonify({"error": "Invalid inventory_item_id format."}), 400
+    body = parse_request_body(UpgradeItemV2Request)
+    inventory_item_id = body.inventory_item_id
+    desired_item_name_str = body.desired_item_name
 
     db = next(get_db())
     try:
-        user = db.query(User).filter(User.id == player_user_id).with_for_update().first()
-        if not user:
-            return jsonify({"error": "User not found."}), 404
-
         item_to_upgrade = db.query(InventoryItem).filter(
             InventoryItem.id == inventory_item_id,
             InventoryItem.user_id == player_user_id
@@ -2557,34 +5147,24 @@ def upgrade_item_v2_api():
         if value_of_item_to_upgrade <= Decimal('0'):
             return jsonify({"error": "Item to upgrade has no value or invalid value."}), 400
 
-        # Fetch desired NFT data from the NFT table (source of truth for floor prices)
-        desired_nft_data = db.query(NFT).filter(NFT.name == desired_item_name_str).first()
-        if not desired_nft_data:
+        # Target price and NFT id come from the catalog snapshot (the nfts table as of the last reload)
+        desired_target = get_game_catalog().upgrade_targets.lookup(desired_item_name_str)
+        if not desired_target:
             return jsonify({"error": f"Desired item '{desired_item_name_str}' not found as an upgradable NFT."}), 404
-        
-        value_of_desired_item = Decimal(str(desired_nft_data.floor_price))
+        value_of_desired_item, desired_nft_id = desired_target
+        if desired_nft_id is None: # Catalog not yet loaded from the database
+            desired_nft_id = db.query(NFT.id).filter(NFT.name == desired_item_name_str).scalar()
 
         if value_of_desired_item <= value_of_item_to_upgrade:
             return jsonify({"error": "Desired item must have a higher value than your current item."}), 400
 
-        # Server-side calculation of multiplier (X) and chance
-        # X represents how many times more valuable the desired item is
+        # X represents how many times more valuable the desired item is; the chance comes from UPGRADE_CHANCE_TABLE
         calculated_x = value_of_desired_item / value_of_item_to_upgrade
+        server_calculated_chance = upgrade_chance_for_x(calculated_x)
         
-        # Effective X for chance calculation, must be > 1
-        # (e.g., if desired is 1.0001 times more, X_eff is 1.01 to ensure some risk factor application)
-        x_effective = max(Decimal('1.01'), calculated_x) 
-
-        # Chance formula: MaxChance * (RiskFactor ^ (X_effective - 1))
-        # The -1 ensures that if X_effective is 1 (meaning same value, though filtered out), RiskFactor isn't applied, giving MaxChance.
-        # For X_effective > 1, RiskFactor is applied exponentially.
-        chance_decimal_raw = UPGRADE_MAX_CHANCE * (UPGRADE_RISK_FACTOR ** (x_effective - Decimal('1')))
-        
-        # Clamp the chance between MinChance and MaxChance
-        server_calculated_chance = min(UPGRADE_MAX_CHANCE, max(UPGRADE_MIN_CHANCE, chance_decimal_raw))
-        
-        # Perform the roll
-        roll = Decimal(str(random.uniform(0, 100)))
+        # Perform the roll, claiming the provably-fair nonce only now that the upgrade is known to be valid
+        rng, fairness = game_rng_for_request(db, player_user_id)
+        roll = Decimal(str(rng.uniform(0, 100)))
         is_success = roll < server_calculated_chance
         
         name_of_item_being_upgraded = item_to_upgrade.item_name_override or \
@@ -2593,7 +5173,7 @@ def upgrade_item_v2_api():
         if is_success:
             # Calculate net change in value for total_won_ton
             net_value_increase = value_of_desired_item - value_of_item_to_upgrade
-            user.total_won_ton = float(Decimal(str(user.total_won_ton)) + net_value_increase)
+            adjust_total_won(db, player_user_id, net_value_increase)
 
             # Delete old item
             db.delete(item_to_upgrade)
@@ -2601,10 +5181,10 @@ def upgrade_item_v2_api():
 
             # Create new upgraded item
             new_upgraded_item = InventoryItem(
-                user_id=user.id,
-                nft_id=desired_nft_data.id,
-                item_name_override=desired_nft_data.name,
-                item_image_override=desired_nft_data.image_filename or generate_image_filename_from_name(desired_nft_data.name),
+                user_id=player_user_id,
+                nft_id=desired_nft_id,
+                item_name_override=desired_item_name_str,
+                item_image_override=generate_image_filename_from_name(desired_item_name_str),
                 current_value=float(value_of_desired_item), # New item starts at its base floor price
                 upgrade_multiplier=1.0, # Reset upgrade multiplier for the new item
                 is_ton_prize=False, # Upgraded items are not TON prizes
@@ -2613,43 +5193,55 @@ def upgrade_item_v2_api():
             db.add(new_upgraded_item)
             db.commit()
             db.refresh(new_upgraded_item) # Get ID and other defaults
+            game_ledger.record(player_user_id, 'upgrade_v2', desired_item_name_str, value_of_item_to_upgrade, value_of_desired_item, 'success',
+                               rng_reference(fairness), {"inventory_item_id": inventory_item_id, "item_name": name_of_item_being_upgraded,
+                                                         "chance": float(server_calculated_chance), "roll": float(roll)})
 
-            logger.info(f"User {player_user_id} UPGRADED item ID {inventory_item_id} ({name_of_item_being_upgraded} @ {value_of_item_to_upgrade} TON) "
-                        f"to {desired_nft_data.name} (@ {value_of_desired_item} TON). "
-                        f"X={calculated_x:.2f}, Chance={server_calculated_chance:.2f}%, Roll={roll:.2f}%. SUCCESS.")
+            games_logger.info("User %s UPGRADED item ID %s (%s @ %s TON) to %s (@ %s TON). X=%.2f, Chance=%.2f%%, Roll=%.2f%%. SUCCESS.",
+                              player_user_id, inventory_item_id, name_of_item_being_upgraded, value_of_item_to_upgrade,
+                              desired_item_name_str, value_of_desired_item, calculated_x, server_calculated_chance, roll)
 
             return jsonify({
                 "status": "success",
-                "message": f"Upgrade successful! Your {name_of_item_being_upgraded} became {desired_nft_data.name}.",
+                "message": f"Upgrade successful! Your {name_of_item_being_upgraded} became {desired_item_name_str}.",
                 "item": {
                     "id": new_upgraded_item.id,
                     "name": new_upgraded_item.item_name_override,
                     "imageFilename": new_upgraded_item.item_image_override,
+                    "imageVariants": image_variants(new_upgraded_item.item_image_override),
                     "currentValue": new_upgraded_item.current_value,
                     "is_ton_prize": new_upgraded_item.is_ton_prize,
                     "variant": new_upgraded_item.variant,
                     # Add other fields frontend might expect for consistency
-                }
+                },
+                "fairness": fairness
             })
         else: # Upgrade failed
             # Item is lost, adjust total_won_ton by subtracting its value
-            user.total_won_ton = float(max(Decimal('0'), Decimal(str(user.total_won_ton)) - value_of_item_to_upgrade))
+            adjust_total_won(db, player_user_id, -value_of_item_to_upgrade)
             
             db.delete(item_to_upgrade)
             db.commit()
+            game_ledger.record(player_user_id, 'upgrade_v2', desired_item_name_str, value_of_item_to_upgrade, 0, 'failed',
+                               rng_reference(fairness), {"inventory_item_id": inventory_item_id, "item_name": name_of_item_being_upgraded,
+                                                         "chance": float(server_calculated_chance), "roll": float(roll)})
 
-            logger.info(f"User {player_user_id} FAILED to upgrade item ID {inventory_item_id} ({name_of_item_being_upgraded} @ {value_of_item_to_upgrade} TON) "
-                        f"to {desired_nft_data.name} (@ {value_of_desired_item} TON). "
-                        f"X={calculated_x:.2f}, Chance={server_calculated_chance:.2f}%, Roll={roll:.2f}%. FAILED.")
+            games_logger.info("User %s FAILED to upgrade item ID %s (%s @ %s TON) to %s (@ %s TON). X=%.2f, Chance=%.2f%%, Roll=%.2f%%. FAILED.",
+                              player_user_id, inventory_item_id, name_of_item_being_upgraded, value_of_item_to_upgrade,
+                              desired_item_name_str, value_of_desired_item, calculated_x, server_calculated_chance, roll)
 
             return jsonify({
                 "status": "failed",
                 "message": f"Upgrade failed! Your {name_of_item_being_upgraded} was lost.",
                 "item_lost": True,
                 "lost_item_name": name_of_item_being_upgraded,
-                "lost_item_value": float(value_of_item_to_upgrade)
+                "lost_item_value": float(value_of_item_to_upgrade),
+                "fairness": fairness
             })
 
+    except RequestValidationError:
+        db.rollback()
+        raise
     except SQLAlchemyError as sqla_e:
         db.rollback()
         logger.error(f"SQLAlchemyError during upgrade_item_v2 for user {player_user_id}: {sqla_e}", exc_info=True)
@@ -2661,48 +5253,268 @@ def upgrade_item_v2_api():
     finally:
         db.close()
 
+UPGRADE_BATCH_MAX_ITEMS = 50
+
+@app.route('/api/upgrade_items_batch', methods=['POST'])
+@rate_limited('upgrade_items_batch')
+@idempotent
+def upgrade_items_batch_api():
+    """
+    Upgrades several inventory items in one transaction. Each entry names either a target NFT
+    (upgrade_item_v2 rules) or a value multiplier (upgrade_item rules); results come back per item.
+    """
+    auth = validate_init_data(flask_request.headers.get('X-Telegram-Init-Data'), BOT_TOKEN)
+    if not auth:
+        return jsonify({"error": "Auth failed"}), 401
+
+    uid = auth["id"]
+    entries = [decode_schema(BatchUpgradeEntry, entry) for entry in parse_request_body(BatchUpgradeRequest).upgrades]
+    if not 1 <= len(entries) <= UPGRADE_BATCH_MAX_ITEMS:
+        return jsonify({"error": f"upgrades must list between 1 and {UPGRADE_BATCH_MAX_ITEMS} items."}), 400
+    if len({e.inventory_item_id for e in entries}) != len(entries):
+        return jsonify({"error": "Each inventory item can appear only once."}), 400
+
+    catalog = get_game_catalog()
+    results = {}
+    planned = []
+    for entry in entries:
+        if (entry.desired_item_name is None) == (entry.multiplier_str is None):
+            results[entry.inventory_item_id] = {"status": "error", "error": "Give exactly one of desired_item_name or multiplier_str."}
+        elif entry.multiplier_str is not None and entry.multiplier_str not in UPGRADE_MULTIPLIER_CHANCES:
+            results[entry.inventory_item_id] = {"status": "error", "error": "Invalid multiplier value provided."}
+        elif entry.desired_item_name is not None and not catalog.upgrade_targets.lookup(entry.desired_item_name):
+            results[entry.inventory_item_id] = {"status": "error", "error": f"Desired item '{entry.desired_item_name}' not found as an upgradable NFT."}
+        else:
+            planned.append(entry)
+
+    db = next(get_db())
+    try:
+        items = {}
+        if planned:
+            # One statement locks every item, in id order so concurrent batches cannot deadlock
+            items = {item.id: item for item in db.query(InventoryItem)
+                     .options(joinedload(InventoryItem.nft))
+                     .filter(InventoryItem.id.in_([e.inventory_item_id for e in planned]), InventoryItem.user_id == uid)
+                     .order_by(InventoryItem.id)
+                     .with_for_update(of=InventoryItem)
+                     .all()}
+        missing_nft_names = [e.desired_item_name for e in planned if e.desired_item_name and catalog.upgrade_targets.lookup(e.desired_item_name)[1] is None]
+        fallback_nft_ids = dict(db.query(NFT.name, NFT.id).filter(NFT.name.in_(missing_nft_names)).all()) if missing_nft_names else {}
+
+        total_won_delta = Decimal('0')
+        deleted_ids = []
+        new_items = []
+        ledger_events = [] # (game_type, game_id, staked value, value received, outcome, details), recorded after commit
+        rollable = [] # (entry, item, item_name, item_value, target_value, target_nft_id) in request order
+        for entry in planned:
+            iid = entry.inventory_item_id
+            item = items.get(iid)
+            if not item or item.is_ton_prize:
+                results[iid] = {"status": "error", "error": "Item not found in your inventory or cannot be upgraded."}
+                continue
+            item_value = Decimal(str(item.current_value))
+            target_value = target_nft_id = None
+            if entry.multiplier_str is None:
+                target_value, target_nft_id = catalog.upgrade_targets.lookup(entry.desired_item_name)
+                if item_value <= 0 or target_value <= item_value:
+                    results[iid] = {"status": "error", "error": "Desired item must have a higher value than your current item."}
+                    continue
+            rollable.append((entry, item, item.nft.name if item.nft else item.item_name_override, item_value, target_value, target_nft_id))
+
+        # One RNG claim (one provably-fair nonce) per batch; rolls are drawn in a single call, in the
+        # order of the validated entries, so a batch replays as random() calls 0..k-1 of that nonce.
+        # A batch where nothing validates claims no nonce.
+        rng = fairness = None
+        rolls = []
+        if rollable:
+            rng, fairness = game_rng_for_request(db, uid)
+            rolls = [Decimal(str(value * 100)) for value in rng.randoms(len(rollable))]
+
+        for (entry, item, item_name, item_value, target_value, target_nft_id), roll in zip(rollable, rolls):
+            iid = entry.inventory_item_id
+            if entry.multiplier_str is not None:
+                mult = entry.multiplier_str
+                if roll < UPGRADE_MULTIPLIER_CHANCES[mult]:
+                    new_val = (item_value * mult).quantize(Decimal('0.01'), ROUND_HALF_UP)
+                    item.current_value = float(new_val)
+                    item.upgrade_multiplier = float(Decimal(str(item.upgrade_multiplier)) * mult)
+                    total_won_delta += new_val - item_value
+                    results[iid] = {"status": "success", "item": serialize_inventory_item(item)}
+                    ledger_events.append(('upgrade', mult, item_value, new_val, 'success', {"inventory_item_id": iid}))
+                    continue
+                ledger_events.append(('upgrade', mult, item_value, 0, 'failed', {"inventory_item_id": iid, "item_name": item_name}))
+            else:
+                chance = upgrade_chance_for_x(target_value / item_value)
+                roll_details = {"inventory_item_id": iid, "item_name": item_name, "chance": float(chance), "roll": float(roll)}
+                if roll < chance:
+                    deleted_ids.append(iid)
+                    new_item = InventoryItem(
+                        user_id=uid,
+                        nft_id=target_nft_id if target_nft_id is not None else fallback_nft_ids.get(entry.desired_item_name),
+                        item_name_override=entry.desired_item_name,
+                        item_image_override=generate_image_filename_from_name(entry.desired_item_name),
+                        current_value=float(target_value),
+                        upgrade_multiplier=1.0,
+                        is_ton_prize=False,
+                        variant=None
+                    )
+                    new_items.append((iid, new_item))
+                    total_won_delta += target_value - item_value
+                    results[iid] = {"status": "success"}
+                    ledger_events.append(('upgrade_v2', entry.desired_item_name, item_value, target_value, 'success', roll_details))
+                    continue
+                ledger_events.append(('upgrade_v2', entry.desired_item_name, item_value, 0, 'failed', roll_details))
+
+            deleted_ids.append(iid)
+            total_won_delta -= item_value
+            results[iid] = {"status": "failed", "item_lost": True, "lost_item_name": item_name, "lost_item_value": float(item_value)}
+
+        if deleted_ids:
+            db.execute(delete(InventoryItem).where(InventoryItem.id.in_(deleted_ids)).execution_options(synchronize_session=False))
+        if new_items:
+            db.add_all([new_item for _, new_item in new_items])
+            db.flush() # Batched INSERT ... RETURNING fills in the new ids
+        for iid, new_item in new_items:
+            results[iid]["item"] = {
+                "id": new_item.id,
+                "name": new_item.item_name_override,
+                "imageFilename": new_item.item_image_override,
+                "imageVariants": image_variants(new_item.item_image_override),
+                "currentValue": new_item.current_value,
+                "is_ton_prize": new_item.is_ton_prize,
+                "variant": new_item.variant,
+            }
+        if total_won_delta:
+            adjust_total_won(db, uid, total_won_delta)
+        db.commit()
+        rng_ref = rng_reference(fairness)
+        for game_type, game_id, staked_value, received_value, outcome, details in ledger_events:
+            game_ledger.record(uid, game_type, game_id, staked_value, received_value, outcome, rng_ref, details)
+
+        succeeded = sum(1 for r in results.values() if r["status"] == "success")
+        failed = sum(1 for r in results.values() if r["status"] == "failed")
+        games_logger.info("User %s batch upgrade: %d items, %d succeeded, %d failed, total_won delta %s TON.",
+                          uid, len(entries), succeeded, failed, total_won_delta)
+        return jsonify({
+            "status": "success",
+            "succeeded": succeeded,
+            "failed": failed,
+            "results": [{"inventory_item_id": e.inventory_item_id, **results[e.inventory_item_id]} for e in entries],
+            "fairness": fairness
+        })
+    except RequestValidationError:
+        db.rollback()
+        raise
+    except SQLAlchemyError as sqla_e:
+        db.rollback()
+        logger.error(f"SQLAlchemyError during upgrade_items_batch for user {uid}: {sqla_e}", exc_info=True)
+        return jsonify({"error": "Database operation failed during upgrade."}), 500
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Unexpected error during upgrade_items_batch for user {uid}: {e}", exc_info=True)
+        return jsonify({"error": "An unexpected server error occurred during upgrade."}), 500
+    finally:
+        db.close()
+
+@app.route('/api/fairness', methods=['GET'])
+def fairness_api():
+    """The user's active provably-fair commitment (server seed hash, client seed, games played)."""
+    auth = validate_init_data(flask_request.headers.get('X-Telegram-Init-Data'), BOT_TOKEN)
+    if not auth:
+        return jsonify({"error": "Auth failed"}), 401
+    db = next(get_db())
+    try:
+        seed = db.query(FairnessSeed).filter(FairnessSeed.user_id == auth["id"], FairnessSeed.is_active.is_(True)).first()
+        return jsonify({"enabled": PROVABLY_FAIR_ENABLED, "current": fairness_seed_payload(seed) if seed else None})
+    except Exception as e:
+        logger.error(f"Error in fairness for user {auth['id']}: {e}", exc_info=True)
+        return jsonify({"error": "Could not load fairness seed."}), 500
+    finally:
+        db.close()
+
+@app.route('/api/fairness/rotate', methods=['POST'])
+@rate_limited('fairness_rotate')
+def fairness_rotate_api():
+    """Reveals the active server seed (so its games can be verified) and commits to a new one."""
+    auth = validate_init_data(flask_request.headers.get('X-Telegram-Init-Data'), BOT_TOKEN)
+    if not auth:
+        return jsonify({"error": "Auth failed"}), 401
+    if not PROVABLY_FAIR_ENABLED:
+        return jsonify({"error": "Provably-fair mode is disabled."}), 503
+
+    uid = auth["id"]
+    client_seed = parse_request_body(FairnessRotateRequest).client_seed
+    if len(client_seed) > FAIRNESS_CLIENT_SEED_MAX_LENGTH:
+        return jsonify({"error": f"client_seed must be at most {FAIRNESS_CLIENT_SEED_MAX_LENGTH} characters."}), 400
+
+    db = next(get_db())
+    try:
+        if not db.query(User.id).filter(User.id == uid).first():
+            return jsonify({"error": "User not found."}), 404
+        previous = db.query(FairnessSeed).filter(FairnessSeed.user_id == uid, FairnessSeed.is_active.is_(True)).with_for_update().first()
+        if previous:
+            previous.is_active = False
+            previous.revealed_at = dt.now(timezone.utc)
+            db.flush() # Frees the one-active-seed-per-user index slot before the insert
+        server_seed = secrets.token_hex(32)
+        current = FairnessSeed(
+            user_id=uid,
+            server_seed=server_seed,
+            server_seed_hash=hashlib.sha256(server_seed.encode('utf-8')).hexdigest(),
+            client_seed=client_seed,
+            nonce=0
+        )
+        db.add(current)
+        payload = {
+            "previous": fairness_seed_payload(previous, reveal=True) if previous else None,
+            "current": fairness_seed_payload(current)
+        }
+        db.commit()
+        return jsonify(payload)
+    except IntegrityError:
+        db.rollback()
+        return jsonify({"error": "Seed rotation already in progress, please retry."}), 409
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Error in fairness_rotate for user {uid}: {e}", exc_info=True)
+        return jsonify({"error": "Could not rotate fairness seed."}), 500
+    finally:
+        db.close()
+
 @app.route('/api/convert_to_ton', methods=['POST'])
+@rate_limited('convert_to_ton')
+@idempotent
 def convert_to_ton_api():
     auth = validate_init_data(flask_request.headers.get('X-Telegram-Init-Data'), BOT_TOKEN)
     if not auth:
         return jsonify({"error": "Auth failed"}), 401
     
     uid = auth["id"]
-    data = flask_request.get_json()
-    iid_convert = data.get('inventory_item_id')
-
-    if not iid_convert:
-        return jsonify({"error": "inventory_item_id required."}), 400
-    try:
-        iid_convert_int = int(iid_convert)
-    except ValueError:
-        return jsonify({"error": "Invalid inventory_item_id format."}), 400
+    iid_convert_int = parse_request_body(InventoryItemRequest).inventory_item_id
     
     db = next(get_db())
     try:
-        user = db.query(User).filter(User.id == uid).with_for_update().first()
-        item = db.query(InventoryItem).filter(InventoryItem.id == iid_convert_int, InventoryItem.user_id == uid).first()
+        item = db.query(InventoryItem).filter(InventoryItem.id == iid_convert_int, InventoryItem.user_id == uid).with_for_update().first()
         
-        if not user:
-            return jsonify({"error": "User not found."}), 404
         if not item:
             return jsonify({"error": "Item not found in your inventory."}), 404
         if item.is_ton_prize:
             return jsonify({"error": "Cannot convert a TON prize item (it's already TON)."}), 400
             
         val_to_add = Decimal(str(item.current_value))
-        user.ton_balance = float(Decimal(str(user.ton_balance)) + val_to_add)
-        
         item_name_converted = item.nft.name if item.nft else item.item_name_override
         
-        user.total_won_ton = float(max(Decimal('0'), Decimal(str(user.total_won_ton)) - val_to_add))
-        
         db.delete(item)
+        new_balance_nano = credit_ton_balance(db, uid, ton_to_nano(val_to_add), total_won_delta=-val_to_add)
+        if new_balance_nano is None:
+            db.rollback()
+            return jsonify({"error": "User not found."}), 404
         db.commit()
+        game_ledger.record(uid, 'convert', item_name_converted, val_to_add, val_to_add, 'converted', NO_RNG_REFERENCE, {"inventory_item_id": iid_convert_int})
         return jsonify({
             "status":"success",
             "message":f"Item '{item_name_converted}' converted to {val_to_add:.2f} TON.",
-            "new_balance_ton":user.ton_balance
+            "new_balance_ton":nano_to_ton(new_balance_nano)
         })
     except Exception as e:
         db.rollback()
@@ -2712,6 +5524,7 @@ def convert_to_ton_api():
         db.close()
 
 @app.route('/api/sell_all_items', methods=['POST'])
+@rate_limited('sell_all_items')
 def sell_all_items_api():
     auth = validate_init_data(flask_request.headers.get('X-Telegram-Init-Data'), BOT_TOKEN)
     if not auth:
@@ -2720,29 +5533,31 @@ def sell_all_items_api():
     uid = auth["id"]
     db = next(get_db())
     try:
-        user = db.query(User).filter(User.id == uid).with_for_update().first()
-        if not user:
-            return jsonify({"error": "User not found"}), 404
-        
-        items_to_sell = [item_obj for item_obj in user.inventory if not item_obj.is_ton_prize]
-        if not items_to_sell:
+        # One bulk DELETE claims every sellable item; concurrent sells see the rows already gone
+        sold_values = db.execute(
+            delete(InventoryItem)
+            .where(InventoryItem.user_id == uid, InventoryItem.is_ton_prize == False)
+            .returning(InventoryItem.current_value)
+            .execution_options(synchronize_session=False)
+        ).scalars().all()
+        if not sold_values:
+            db.rollback()
             return jsonify({"status":"no_items","message":"No sellable items in your collection to convert."})
             
-        total_value_from_sell = sum(Decimal(str(i_sell.current_value)) for i_sell in items_to_sell)
-        user.ton_balance = float(Decimal(str(user.ton_balance)) + total_value_from_sell)
-        
-        num_items_sold = len(items_to_sell)
+        total_value_from_sell = sum((Decimal(str(v)) for v in sold_values), Decimal('0'))
+        num_items_sold = len(sold_values)
 
-        user.total_won_ton = float(max(Decimal('0'), Decimal(str(user.total_won_ton)) - total_value_from_sell))
-        
-        for i_del in items_to_sell:
-            db.delete(i_del)
+        new_balance_nano = credit_ton_balance(db, uid, ton_to_nano(total_value_from_sell), total_won_delta=-total_value_from_sell)
+        if new_balance_nano is None:
+            db.rollback()
+            return jsonify({"error": "User not found"}), 404
         
         db.commit()
+        game_ledger.record(uid, 'convert', 'sell_all', total_value_from_sell, total_value_from_sell, 'converted', NO_RNG_REFERENCE, {"items": num_items_sold})
         return jsonify({
             "status":"success",
             "message":f"All {num_items_sold} sellable items converted for a total of {total_value_from_sell:.2f} TON.",
-            "new_balance_ton":user.ton_balance
+            "new_balance_ton":nano_to_ton(new_balance_nano)
         })
     except Exception as e:
         db.rollback()
@@ -2752,21 +5567,14 @@ def sell_all_items_api():
         db.close()
 
 @app.route('/api/initiate_deposit', methods=['POST'])
+@rate_limited('initiate_deposit')
 def initiate_deposit_api():
     auth = validate_init_data(flask_request.headers.get('X-Telegram-Init-Data'), BOT_TOKEN)
     if not auth:
         return jsonify({"error": "Auth failed"}), 401
     
     uid = auth["id"]
-    data = flask_request.get_json()
-    amt_str = data.get('amount')
-
-    if amt_str is None:
-        return jsonify({"error": "Amount required."}), 400
-    try:
-        orig_amt = float(amt_str)
-    except ValueError:
-        return jsonify({"error": "Invalid amount format."}), 400
+    orig_amt = parse_request_body(InitiateDepositRequest).amount
     
     if not (0.1 <= orig_amt <= 10000):
         return jsonify({"error": "Amount must be between 0.1 and 10000 TON."}), 400
@@ -2819,6 +5627,16 @@ def initiate_deposit_api():
     finally:
         db.close()
 
+async def timed_liteserver_call(operation: str, awaitable):
+    call_started = time.perf_counter()
+    outcome = 'error'
+    try:
+        result = await awaitable
+        outcome = 'ok'
+        return result
+    finally:
+        LITESERVER_CALL_DURATION.observe(time.perf_counter() - call_started, operation, outcome)
+
 async def check_blockchain_for_deposit(pdep: PendingDeposit, db_sess: SessionLocal):
     """
     Asynchronously checks the blockchain for a matching deposit transaction based on comment and amount.
@@ -2826,9 +5644,9 @@ async def check_blockchain_for_deposit(pdep: PendingDeposit, db_sess: SessionLoc
     prov = None
     try:
         prov = LiteBalancer.from_mainnet_config(trust_level=2)
-        await prov.start_up()
+        await timed_liteserver_call('start_up', prov.start_up())
 
-        txs = await prov.get_transactions(DEPOSIT_RECIPIENT_ADDRESS_RAW, count=50)
+        txs = await timed_liteserver_call('get_transactions', prov.get_transactions(DEPOSIT_RECIPIENT_ADDRESS_RAW, count=50))
         
         deposit_found = False
         for tx in txs:
@@ -2856,23 +5674,25 @@ async def check_blockchain_for_deposit(pdep: PendingDeposit, db_sess: SessionLoc
 
         if deposit_found:
             # Credit user logic (same as before)
-            usr = db_sess.query(User).filter(User.id == pdep.user_id).with_for_update().first()
-            if not usr:
+            # Credit exactly the nanoTON amount that was matched on-chain
+            new_balance_nano = credit_ton_balance(db_sess, pdep.user_id, pdep.final_amount_nano_ton)
+            if new_balance_nano is None:
                 pdep.status = 'failed_user_not_found'
                 db_sess.commit()
                 return {"status":"error","message":"User for deposit not found."}
             
-            usr.ton_balance = float(Decimal(str(usr.ton_balance)) + Decimal(str(pdep.original_amount_ton)))
-            
-            if usr.referred_by_id:
-                referrer = db_sess.query(User).filter(User.id == usr.referred_by_id).with_for_update().first()
+            referred_by_id = db_sess.query(User.referred_by_id).filter(User.id == pdep.user_id).scalar()
+            if referred_by_id:
+                referrer = db_sess.query(User).filter(User.id == referred_by_id).with_for_update().first()
                 if referrer:
                     referral_bonus = (Decimal(str(pdep.original_amount_ton)) * Decimal('0.10')).quantize(Decimal('0.01'),ROUND_HALF_UP)
                     referrer.referral_earnings_pending = float(Decimal(str(referrer.referral_earnings_pending)) + referral_bonus)
             
             pdep.status = 'completed'
             db_sess.commit()
-            return {"status":"success","message":"Deposit confirmed and credited!","new_balance_ton":usr.ton_balance}
+            game_ledger.record(pdep.user_id, 'deposit', pdep.expected_comment, 0, Decimal(pdep.final_amount_nano_ton) / NANOTON_PER_TON,
+                               'credited', NO_RNG_REFERENCE)
+            return {"status":"success","message":"Deposit confirmed and credited!","new_balance_ton":nano_to_ton(new_balance_nano)}
         else:
             # Pending/expired logic (same as before)
             if pdep.expires_at <= dt.now(timezone.utc) and pdep.status == 'pending':
@@ -2889,17 +5709,14 @@ async def check_blockchain_for_deposit(pdep: PendingDeposit, db_sess: SessionLoc
             await prov.close_all()
 
 @app.route('/api/verify_deposit', methods=['POST'])
+@rate_limited('verify_deposit')
 def verify_deposit_api():
     auth = validate_init_data(flask_request.headers.get('X-Telegram-Init-Data'), BOT_TOKEN)
     if not auth:
         return jsonify({"error": "Auth failed"}), 401
     
     uid = auth["id"]
-    data = flask_request.get_json()
-    pid = data.get('pending_deposit_id')
-
-    if not pid:
-        return jsonify({"error": "Pending deposit ID required."}), 400
+    pid = parse_request_body(VerifyDepositRequest).pending_deposit_id
     
     db = next(get_db())
     try:
@@ -2909,7 +5726,7 @@ def verify_deposit_api():
         
         if pdep.status == 'completed':
             usr = db.query(User).filter(User.id == uid).first()
-            return jsonify({"status":"success","message":"Deposit was already confirmed and credited.","new_balance_ton":usr.ton_balance if usr else 0})
+            return jsonify({"status":"success","message":"Deposit was already confirmed and credited.","new_balance_ton":nano_to_ton(usr.ton_balance) if usr else 0})
         
         if pdep.status == 'pending' and pdep.expires_at <= dt.now(timezone.utc):
             pdep.status = 'expired'
@@ -2944,11 +5761,7 @@ def request_manual_withdrawal_api():
         return jsonify({"error": "Auth failed"}), 401
 
     uid = auth["id"]
-    data = flask_request.get_json()
-    inventory_item_id = data.get('inventory_item_id')
-
-    if not inventory_item_id:
-        return jsonify({"error": "inventory_item_id required"}), 400
+    inventory_item_id = parse_request_body(InventoryItemRequest).inventory_item_id
 
     db = next(get_db())
     try:
@@ -2972,8 +5785,11 @@ def request_manual_withdrawal_api():
             try:
                 bot.send_message(TARGET_WITHDRAWER_ID, message)
                 # After successfully sending the message, remove the item from inventory
+                withdrawn_value = item.current_value
                 db.delete(item)
                 db.commit()
+                game_ledger.record(uid, 'withdrawal', item_name, withdrawn_value, 0, 'requested', NO_RNG_REFERENCE,
+                                   {"inventory_item_id": inventory_item_id, "method": "manual"})
                 return jsonify({"status": "success"})
             except Exception as e:
                 logger.error(f"Failed to send withdrawal message: {e}")
@@ -2989,6 +5805,60 @@ def request_manual_withdrawal_api():
         db.close()
 
 
+GAME_HISTORY_COLUMNS = ["id", "at", "type", "game", "cost", "value", "outcome", "details"]
+
+@app.route('/api/game_history', methods=['GET'])
+@rate_limited('game_history')
+def game_history_api():
+    """
+    The user's opens, spins, upgrades, conversions and withdrawals, newest first, as compact rows.
+    Pass the returned next_before_id as before_id for the next page; type filters to one game type.
+    Events appear once the ledger flushes them (GAME_EVENT_FLUSH_INTERVAL_SECONDS).
+    """
+    auth = validate_init_data(flask_request.headers.get('X-Telegram-Init-Data'), BOT_TOKEN)
+    if not auth:
+        return jsonify({"error": "Auth failed"}), 401
+
+    uid = auth["id"]
+    game_type = flask_request.args.get('type')
+    try:
+        limit = min(int(flask_request.args.get('limit', GAME_HISTORY_PAGE_SIZE)), GAME_HISTORY_MAX_PAGE_SIZE)
+        before_id = int(flask_request.args['before_id']) if flask_request.args.get('before_id') else None
+    except ValueError:
+        return jsonify({"error": "limit and before_id must be integers."}), 400
+    if limit <= 0:
+        return jsonify({"error": "limit must be positive."}), 400
+    if game_type is not None and game_type not in GAME_EVENT_TYPES:
+        return jsonify({"error": f"type must be one of: {', '.join(GAME_EVENT_TYPES)}."}), 400
+
+    db = next(get_db())
+    try:
+        query = db.query(
+            GameEvent.id, GameEvent.created_at, GameEvent.game_type, GameEvent.game_id,
+            GameEvent.cost_nano, GameEvent.value_nano, GameEvent.outcome, GameEvent.details
+        ).filter(GameEvent.user_id == uid)
+        if game_type is not None:
+            query = query.filter(GameEvent.game_type == game_type)
+        if before_id is not None:
+            query = query.filter(GameEvent.id < before_id)
+        # One row past the page tells whether another page exists
+        events = query.order_by(GameEvent.id.desc()).limit(limit + 1).all()
+        has_more = len(events) > limit
+        events = events[:limit]
+        return jsonify({
+            "columns": GAME_HISTORY_COLUMNS,
+            "rows": [
+                [e.id, int(e.created_at.timestamp()), e.game_type, e.game_id, nano_to_ton(e.cost_nano), nano_to_ton(e.value_nano), e.outcome, e.details]
+                for e in events
+            ],
+            "next_before_id": events[-1].id if has_more else None
+        })
+    except Exception as e:
+        logger.error(f"Error in game_history for user {uid}: {e}", exc_info=True)
+        return jsonify({"error": "Could not load game history."}), 500
+    finally:
+        db.close()
+
 @app.route('/api/get_leaderboard', methods=['GET'])
 def get_leaderboard_api():
     db = next(get_db())
@@ -3000,13 +5870,13 @@ def get_leaderboard_api():
             display_name = u_leader.first_name or u_leader.username or f"User_{str(u_leader.id)[:6]}"
             avatar_char = (u_leader.first_name or u_leader.username or "U")[0].upper()
             
-            leaderboard_data.append({
-                "rank": r_idx + 1,
-                "name": display_name,
-                "avatarChar": avatar_char,
-                "income": u_leader.total_won_ton,
-                "user_id": u_leader.id
-            })
+            leaderboard_data.append(LeaderboardEntryOut(
+                rank=r_idx + 1,
+                name=display_name,
+                avatarChar=avatar_char,
+                income=u_leader.total_won_ton,
+                user_id=u_leader.id
+            ))
         return jsonify(leaderboard_data)
     except Exception as e:
         logger.error(f"Error in get_leaderboard: {e}", exc_info=True)
@@ -3029,14 +5899,14 @@ def withdraw_referral_earnings_api():
         
         if user.referral_earnings_pending > 0:
             withdrawn_amount = Decimal(str(user.referral_earnings_pending))
-            user.ton_balance = float(Decimal(str(user.ton_balance)) + withdrawn_amount)
+            user.ton_balance = user.ton_balance + ton_to_nano(withdrawn_amount)
             user.referral_earnings_pending = 0.0
             
             db.commit()
             return jsonify({
                 "status":"success",
                 "message":f"{withdrawn_amount:.2f} TON referral earnings withdrawn to your main balance.",
-                "new_balance_ton":user.ton_balance,
+                "new_balance_ton":nano_to_ton(user.ton_balance),
                 "new_referral_earnings_pending":0.0
             })
         else:
@@ -3049,54 +5919,45 @@ def withdraw_referral_earnings_api():
         db.close()
 
 @app.route('/api/redeem_promocode', methods=['POST'])
+@rate_limited('redeem_promocode')
+@idempotent
 def redeem_promocode_api():
     auth = validate_init_data(flask_request.headers.get('X-Telegram-Init-Data'), BOT_TOKEN)
     if not auth:
         return jsonify({"error": "Auth failed"}), 401
     
     uid = auth["id"]
-    data = flask_request.get_json()
-    code_txt = data.get('promocode_text', "").strip()
-
-    if not code_txt:
+    try:
+        code_txt = parse_request_body(RedeemPromocodeRequest).promocode_text
+    except RequestValidationError:
         return jsonify({"status":"error","message":"Promocode text cannot be empty."}), 400
     
     db = next(get_db())
     try:
-        user = db.query(User).filter(User.id == uid).with_for_update().first()
-        if not user:
-            return jsonify({"status":"error","message":"User not found."}), 404
-            
-        promo = db.query(PromoCode).filter(PromoCode.code_text == code_txt).with_for_update().first()
-        if not promo:
-            return jsonify({"status":"error","message":"Invalid promocode."}), 404
-            
-        if promo.activations_left != -1 and promo.activations_left <= 0:
-            return jsonify({"status":"error","message":"This promocode has no activations left."}), 400
-            
-        existing_redemption = db.query(UserPromoCodeRedemption).filter(
-            UserPromoCodeRedemption.user_id == user.id,
-            UserPromoCodeRedemption.promo_code_id == promo.id
-        ).first()
-        if existing_redemption:
-            return jsonify({"status":"error","message":"You have already redeemed this promocode."}), 400
-            
-        if promo.activations_left != -1:
-            promo.activations_left -= 1
-        
-        user.ton_balance = float(Decimal(str(user.ton_balance)) + Decimal(str(promo.ton_amount)))
-        
-        new_redemption = UserPromoCodeRedemption(user_id=user.id, promo_code_id=promo.id)
-        db.add(new_redemption)
+        cached = promo_cache.lookup(code_txt)
+        if cached is None:
+            return jsonify(PROMO_INVALID_RESPONSE[0]), PROMO_INVALID_RESPONSE[1]
+        promo_id, exhausted = cached
+        if exhausted:
+            return jsonify(PROMO_EXHAUSTED_RESPONSE[0]), PROMO_EXHAUSTED_RESPONSE[1]
+        redeemed = redeem_promo_code(db, uid, promo_id)
+        if redeemed is None:
+            db.rollback()
+            body, status = promo_redemption_failure(db, uid, code_txt, promo_id)
+            return jsonify(body), status
         db.commit()
+        if redeemed.activations_left == 0:
+            promo_cache.mark_exhausted(code_txt)
         
         return jsonify({
             "status":"success",
-            "message":f"Promocode '{code_txt}' redeemed successfully! You received {promo.ton_amount:.2f} TON.",
-            "new_balance_ton":user.ton_balance
+            "message":f"Promocode '{code_txt}' redeemed successfully! You received {redeemed.ton_amount:.2f} TON.",
+            "new_balance_ton":nano_to_ton(redeemed.ton_balance)
         })
     except IntegrityError as ie:
         db.rollback()
+        if 'uq_user_promo_redemption' in str(ie.orig):
+            return jsonify({"status":"error","message":"You have already redeemed this promocode."}), 400
         logger.error(f"IntegrityError redeeming promocode '{code_txt}' for user {uid}: {ie}", exc_info=True)
         return jsonify({"status":"error","message":"Promocode redemption failed due to a conflict. Please try again."}), 409
     except Exception as e:
@@ -3107,17 +5968,19 @@ def redeem_promocode_api():
         db.close()
 
 @app.route('/api/confirm_tonnel_withdrawal/<int:inventory_item_id>', methods=['POST'])
+@rate_limited('confirm_tonnel_withdrawal')
 def confirm_tonnel_withdrawal_api(inventory_item_id):
     auth_user_data = validate_init_data(flask_request.headers.get('X-Telegram-Init-Data'), BOT_TOKEN)
     if not auth_user_data:
         return jsonify({"status": "error", "message": "Authentication failed"}), 401
     
     player_user_id = auth_user_data["id"]
-    data = flask_request.get_json()
-    chosen_gift_details = data.get('chosen_tonnel_gift_details')
+    try:
+        chosen_gift_details = parse_request_body(TonnelWithdrawalRequest).chosen_tonnel_gift_details
+    except RequestValidationError:
+        chosen_gift_details = None
 
-    if not chosen_gift_details or not isinstance(chosen_gift_details, dict) or \
-       'gift_id' not in chosen_gift_details or 'price' not in chosen_gift_details:
+    if not chosen_gift_details or 'gift_id' not in chosen_gift_details or 'price' not in chosen_gift_details:
         return jsonify({"status": "error", "message": "Chosen Tonnel gift details are missing or invalid."}), 400
 
     if not TONNEL_SENDER_INIT_DATA or not TONNEL_GIFT_SECRET:
@@ -3153,12 +6016,12 @@ def confirm_tonnel_withdrawal_api(inventory_item_id):
 
         if tonnel_result and tonnel_result.get("status") == "success":
             value_deducted_from_winnings = Decimal(str(item_to_withdraw.current_value))
-            player = db.query(User).filter(User.id == player_user_id).with_for_update().first()
-            if player:
-                player.total_won_ton = float(max(Decimal('0'), Decimal(str(player.total_won_ton)) - value_deducted_from_winnings))
+            adjust_total_won(db, player_user_id, -value_deducted_from_winnings)
             
             db.delete(item_to_withdraw)
             db.commit()
+            game_ledger.record(player_user_id, 'withdrawal', item_name_withdrawn, value_deducted_from_winnings, 0, 'sent', NO_RNG_REFERENCE,
+                               {"inventory_item_id": inventory_item_id, "method": "tonnel", "gift_id": chosen_gift_details['gift_id']})
             logger.info(f"Item '{item_name_withdrawn}' (Inv ID: {inventory_item_id}, Tonnel Gift ID: {chosen_gift_details['gift_id']}) withdrawn via Tonnel for user {player_user_id}.")
             return jsonify({
                 "status": "success",
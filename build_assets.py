@@ -0,0 +1,201 @@
+"""
+Builds optimized, content-hashed variants of the repo's images for the backend to serve.
+
+For every image in GiftImages/, caseImages/, bgs/ and the root *.png files this writes
+resized WebP (and AVIF, when the installed Pillow can encode it) variants:
+
+  full   longest side capped at FULL_MAX_SIDE
+  thumb  longest side capped at THUMB_MAX_SIDE
+
+into static_build/assets/<dir>/<stem>.<hash>.<variant>.<ext>, plus static_build/asset_manifest.json
+mapping each source path to its variants. The hash covers the encoded bytes, so a file name never
+changes meaning and the app serves them with immutable cache headers (see /assets in app.py).
+Sources whose content hash matches the previous manifest are not re-encoded.
+
+The Lottie animations in GiftGifs/*.tgs are re-gzipped from minified JSON (when that is smaller)
+into content-hashed copies that the app serves with Content-Encoding: gzip. If rlottie-python is
+installed, each animation's first frame is also rendered into one WebP sprite sheet, so low-end
+devices can show a static prize with a single request.
+
+Build-only dependencies are listed in requirements-build.txt (pip install -r requirements-build.txt).
+
+  python build_assets.py [--out static_build]
+"""
+import argparse
+import gzip
+import hashlib
+import io
+import json
+import os
+import sys
+
+try:
+    from PIL import Image, features
+except ImportError:
+    sys.exit("build_assets.py needs Pillow: pip install -r requirements-build.txt")
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+SOURCE_DIRS = ["GiftImages", "caseImages", "bgs"]
+SOURCE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp")
+FULL_MAX_SIDE = 512
+THUMB_MAX_SIDE = 128
+VARIANTS = {"full": FULL_MAX_SIDE, "thumb": THUMB_MAX_SIDE}
+WEBP_QUALITY = 80
+AVIF_QUALITY = 55
+MANIFEST_VERSION = 1
+ANIMATION_DIR = "GiftGifs"
+FIRST_FRAME_CELL = 128 # Sprite sheet cell size in px
+FIRST_FRAME_COLUMNS = 8
+
+try:
+    from rlottie_python import LottieAnimation
+except ImportError:
+    LottieAnimation = None
+
+
+def source_files() -> list:
+    """Repo-relative paths of every source image, in a stable order."""
+    paths = []
+    for directory in SOURCE_DIRS:
+        full_dir = os.path.join(ROOT, directory)
+        if os.path.isdir(full_dir):
+            paths.extend(f"{directory}/{name}" for name in sorted(os.listdir(full_dir)) if name.lower().endswith(SOURCE_EXTENSIONS))
+    paths.extend(name for name in sorted(os.listdir(ROOT)) if name.lower().endswith(".png") and os.path.isfile(os.path.join(ROOT, name)))
+    return paths
+
+def avif_supported() -> bool:
+    try:
+        return bool(features.check("avif"))
+    except (ValueError, AttributeError):
+        return ".avif" in Image.registered_extensions()
+
+def encode(image, fmt: str) -> bytes:
+    buffer = io.BytesIO()
+    if fmt == "webp":
+        image.save(buffer, "WEBP", quality=WEBP_QUALITY, method=6)
+    else:
+        image.save(buffer, "AVIF", quality=AVIF_QUALITY)
+    return buffer.getvalue()
+
+def resized(image, max_side: int):
+    if max(image.size) <= max_side:
+        return image
+    copy = image.copy()
+    copy.thumbnail((max_side, max_side), Image.LANCZOS)
+    return copy
+
+def build_entry(rel_path: str, source_hash: str, out_dir: str, formats: list) -> dict:
+    with Image.open(os.path.join(ROOT, rel_path)) as original:
+        original.load()
+        image = original.convert("RGBA") if original.mode in ("P", "LA", "RGBA") or "transparency" in original.info else original.convert("RGB")
+    directory, file_name = os.path.split(rel_path)
+    stem = os.path.splitext(file_name)[0]
+    entry = {"source_hash": source_hash, "width": image.width, "height": image.height, "variants": {}}
+    for variant_name, max_side in VARIANTS.items():
+        variant_image = resized(image, max_side)
+        entry["variants"][variant_name] = {}
+        for fmt in formats:
+            data = encode(variant_image, fmt)
+            digest = hashlib.sha256(data).hexdigest()[:12]
+            out_rel = "/".join(filter(None, [directory, f"{stem}.{digest}.{variant_name}.{fmt}"]))
+            out_path = os.path.join(out_dir, "assets", out_rel)
+            os.makedirs(os.path.dirname(out_path), exist_ok=True)
+            if not os.path.exists(out_path):
+                with open(out_path, "wb") as f:
+                    f.write(data)
+            entry["variants"][variant_name][fmt] = {"path": out_rel, "bytes": len(data), "width": variant_image.width, "height": variant_image.height}
+    return entry
+
+def outputs_exist(entry: dict, out_dir: str) -> bool:
+    return all(os.path.exists(os.path.join(out_dir, "assets", fmt_info["path"]))
+               for formats in entry.get("variants", {}).values() for fmt_info in formats.values())
+
+def build_animation(rel_path: str, raw: bytes, out_dir: str) -> dict:
+    lottie_json = json.loads(gzip.decompress(raw))
+    recompressed = gzip.compress(json.dumps(lottie_json, separators=(",", ":")).encode("utf-8"), compresslevel=9, mtime=0)
+    data = recompressed if len(recompressed) < len(raw) else raw
+    digest = hashlib.sha256(data).hexdigest()[:12]
+    stem = os.path.splitext(os.path.basename(rel_path))[0]
+    out_rel = f"{ANIMATION_DIR}/{stem}.{digest}.tgs"
+    out_path = os.path.join(out_dir, "assets", out_rel)
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    if not os.path.exists(out_path):
+        with open(out_path, "wb") as f:
+            f.write(data)
+    return {
+        "path": out_rel, "bytes": len(data), "json_bytes": len(gzip.decompress(data)),
+        "width": lottie_json.get("w"), "height": lottie_json.get("h"),
+        "frame_rate": lottie_json.get("fr"), "frames": int(lottie_json.get("op", 0) - lottie_json.get("ip", 0)),
+    }
+
+def build_first_frame_sprite(animations: dict, out_dir: str) -> dict | None:
+    """Renders frame 0 of every animation into one sprite sheet; records each cell on its animation entry."""
+    if LottieAnimation is None:
+        print("rlottie-python not installed; skipping the first-frame sprite sheet.")
+        return None
+    stems = sorted(animations)
+    rows = (len(stems) + FIRST_FRAME_COLUMNS - 1) // FIRST_FRAME_COLUMNS
+    sheet = Image.new("RGBA", (FIRST_FRAME_COLUMNS * FIRST_FRAME_CELL, max(1, rows) * FIRST_FRAME_CELL), (0, 0, 0, 0))
+    for index, stem in enumerate(stems):
+        animation = LottieAnimation.from_tgs(os.path.join(ROOT, ANIMATION_DIR, f"{stem}.tgs"))
+        frame = animation.render_pillow_frame(frame_num=0, width=FIRST_FRAME_CELL, height=FIRST_FRAME_CELL)
+        x, y = (index % FIRST_FRAME_COLUMNS) * FIRST_FRAME_CELL, (index // FIRST_FRAME_COLUMNS) * FIRST_FRAME_CELL
+        sheet.paste(frame, (x, y))
+        animations[stem]["first_frame"] = {"x": x, "y": y, "w": FIRST_FRAME_CELL, "h": FIRST_FRAME_CELL}
+    data = encode(sheet, "webp")
+    out_rel = f"{ANIMATION_DIR}/first-frames.{hashlib.sha256(data).hexdigest()[:12]}.webp"
+    out_path = os.path.join(out_dir, "assets", out_rel)
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    with open(out_path, "wb") as f:
+        f.write(data)
+    return {"path": out_rel, "bytes": len(data), "cell": FIRST_FRAME_CELL, "width": sheet.width, "height": sheet.height}
+
+def build_animations(out_dir: str) -> tuple[dict, dict | None]:
+    animations = {}
+    animation_dir = os.path.join(ROOT, ANIMATION_DIR)
+    if not os.path.isdir(animation_dir):
+        return animations, None
+    for name in sorted(os.listdir(animation_dir)):
+        if name.endswith(".tgs"):
+            with open(os.path.join(animation_dir, name), "rb") as f:
+                animations[os.path.splitext(name)[0]] = build_animation(f"{ANIMATION_DIR}/{name}", f.read(), out_dir)
+    return animations, build_first_frame_sprite(animations, out_dir)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--out", default=os.path.join(ROOT, "static_build"))
+    args = parser.parse_args()
+
+    formats = ["webp"] + (["avif"] if avif_supported() else [])
+    manifest_path = os.path.join(args.out, "asset_manifest.json")
+    previous = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            previous = json.load(f).get("assets", {})
+
+    assets, source_bytes, built_bytes, reused = {}, 0, 0, 0
+    for rel_path in source_files():
+        with open(os.path.join(ROOT, rel_path), "rb") as f:
+            raw = f.read()
+        source_hash = hashlib.sha256(raw).hexdigest()[:16]
+        source_bytes += len(raw)
+        prev_entry = previous.get(rel_path)
+        if prev_entry and prev_entry.get("source_hash") == source_hash and set(formats) <= set(prev_entry["variants"]["full"]) and outputs_exist(prev_entry, args.out):
+            assets[rel_path] = prev_entry
+            reused += 1
+        else:
+            assets[rel_path] = build_entry(rel_path, source_hash, args.out, formats)
+        built_bytes += assets[rel_path]["variants"]["full"]["webp"]["bytes"]
+
+    animations, first_frame_sprite = build_animations(args.out)
+
+    os.makedirs(args.out, exist_ok=True)
+    with open(manifest_path, "w") as f:
+        json.dump({"version": MANIFEST_VERSION, "formats": formats, "assets": assets,
+                   "animations": animations, "first_frame_sprite": first_frame_sprite}, f, indent=1, sort_keys=True)
+    print(f"{len(assets)} images ({reused} unchanged), formats: {', '.join(formats)}. "
+          f"Originals {source_bytes / 1024:.0f} KiB -> full WebP {built_bytes / 1024:.0f} KiB. "
+          f"{len(animations)} animations, {sum(a['bytes'] for a in animations.values()) / 1024:.0f} KiB gzipped. Manifest: {manifest_path}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+Builds the Mini App front end (index.html) into a small HTML shell plus content-hashed CSS and JS chunks.
+
+  static_build/web/index.html              shell: markup, the tiny gtag snippet, links to the chunks
+  static_build/assets/web/app.<hash>.css   the inline <style> blocks
+  static_build/assets/web/app.<hash>.js    the inline application <script> blocks, loaded with defer
+
+Every output also gets .br (when the brotli package is installed) and .gz siblings. The app serves the
+shell at /webapp with an ETag and the chunks from /assets with immutable caching, picking the best
+precompressed variant the client accepts.
+
+Blocking third-party <script src> tags in <head> are switched to defer so they no longer hold up first
+render; deferred scripts still run in document order, before the application chunk.
+
+CSS and JS are minified with rcssmin / rjsmin when installed. Without them CSS gets a conservative
+comment/whitespace pass and JS is left as is (gzip and Brotli recover most of the difference).
+
+Brotli is listed in requirements-build.txt (pip install -r requirements-build.txt); the minifiers are
+optional extras.
+
+  python build_frontend.py [--asset-base-url /assets] [--out static_build]
+"""
+import argparse
+import gzip
+import hashlib
+import os
+import re
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import rcssmin
+except ImportError:
+    rcssmin = None
+try:
+    import rjsmin
+except ImportError:
+    rjsmin = None
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+SOURCE_HTML = os.path.join(ROOT, "index.html")
+# Inline scripts shorter than this stay inline (e.g. the gtag bootstrap)
+INLINE_SCRIPT_MAX_BYTES = 1024
+
+STYLE_RE = re.compile(r"<style[^>]*>(.*?)</style>", re.S | re.I)
+INLINE_SCRIPT_RE = re.compile(r"<script>(.*?)</script>", re.S | re.I)
+BLOCKING_SCRIPT_SRC_RE = re.compile(r"<script src=(\"[^\"]+\"|'[^']+')></script>", re.I)
+HTML_COMMENT_RE = re.compile(r"<!--(?!\[if).*?-->", re.S)
+INTER_TAG_WHITESPACE_RE = re.compile(r">\s+<")
+
+
+def minify_css(css: str) -> str:
+    if rcssmin is not None:
+        return rcssmin.cssmin(css)
+    css = re.sub(r"/\*.*?\*/", "", css, flags=re.S)
+    css = re.sub(r"\s+", " ", css)
+    css = re.sub(r"\s*([{};,])\s*", r"\1", css)
+    return css.replace(";}", "}").strip()
+
+def minify_js(js: str) -> str:
+    if rjsmin is not None:
+        return rjsmin.jsmin(js)
+    return js.strip()
+
+def minify_html(html: str) -> str:
+    html = HTML_COMMENT_RE.sub("", html)
+    return INTER_TAG_WHITESPACE_RE.sub("> <", html).strip()
+
+def write_with_precompressed(path: str, data: bytes) -> dict:
+    """Writes data plus .gz/.br siblings; returns their sizes."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    sizes = {"identity": len(data)}
+    with open(path, "wb") as f:
+        f.write(data)
+    gz = gzip.compress(data, compresslevel=9, mtime=0)
+    with open(path + ".gz", "wb") as f:
+        f.write(gz)
+    sizes["gzip"] = len(gz)
+    if brotli is not None:
+        br = brotli.compress(data, quality=11)
+        with open(path + ".br", "wb") as f:
+            f.write(br)
+        sizes["br"] = len(br)
+    return sizes
+
+def hashed_name(stem: str, ext: str, data: bytes) -> str:
+    return f"{stem}.{hashlib.sha256(data).hexdigest()[:12]}.{ext}"
+
+def build(asset_base_url: str, out_dir: str) -> dict:
+    with open(SOURCE_HTML, encoding="utf-8") as f:
+        html = f.read()
+
+    css = minify_css("\n".join(STYLE_RE.findall(html))).encode("utf-8")
+    css_name = hashed_name("app", "css", css)
+    html = STYLE_RE.sub("", html)
+    html = html.replace("</head>", f'<link rel="stylesheet" href="{asset_base_url}/web/{css_name}"></head>', 1)
+
+    app_scripts = []
+    def extract_script(match):
+        if len(match.group(1).encode("utf-8")) < INLINE_SCRIPT_MAX_BYTES:
+            return f"<script>{minify_js(match.group(1))}</script>"
+        app_scripts.append(match.group(1))
+        return ""
+    html = INLINE_SCRIPT_RE.sub(extract_script, html)
+    # Blocks keep document order; top-level let/const already shared one global scope across classic scripts
+    js = minify_js(";\n".join(app_scripts)).encode("utf-8")
+    js_name = hashed_name("app", "js", js)
+    html = BLOCKING_SCRIPT_SRC_RE.sub(lambda m: f"<script defer src={m.group(1)}></script>", html)
+    html = html.replace("</body>", f'<script defer src="{asset_base_url}/web/{js_name}"></script></body>', 1)
+
+    shell = minify_html(html).encode("utf-8")
+    return {
+        "shell": write_with_precompressed(os.path.join(out_dir, "web", "index.html"), shell),
+        css_name: write_with_precompressed(os.path.join(out_dir, "assets", "web", css_name), css),
+        js_name: write_with_precompressed(os.path.join(out_dir, "assets", "web", js_name), js),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--asset-base-url", default="/assets", help="URL prefix the chunks are served under")
+    parser.add_argument("--out", default=os.path.join(ROOT, "static_build"))
+    args = parser.parse_args()
+
+    source_bytes = os.path.getsize(SOURCE_HTML)
+    outputs = build(args.asset_base_url.rstrip("/"), args.out)
+    print(f"index.html: {source_bytes / 1024:.1f} KiB source")
+    for name, sizes in outputs.items():
+        print(f"  {name:<28} " + ", ".join(f"{encoding} {size / 1024:.1f} KiB" for encoding, size in sizes.items()))
+
+if __name__ == "__main__":
+    main()